@@ -1,7 +1,9 @@
 from common import *
+import argparse
 
 #plotting
 import folium, random
+from fast_map import add_category_circles
 
 OUTPUT_FILENAME="cities_map.html"
 
@@ -12,7 +14,7 @@ QUERY="""
     """
 
 
-def plot():
+def plot(fast : bool = False):
     generated_colors = set()
     def generate_color() -> str:
         while True:
@@ -35,20 +37,23 @@ def plot():
     m = folium.Map(tiles=None,location=(51.1657, 10.4515),zoom_start=7,control_scale=True)
     folium.TileLayer("CartoDB Positron",control=False).add_to(m)
 
-    for idx, row in df.iterrows():
-        color = get_city_color(row['city'])
-        marker = folium.CircleMarker(
-            location=[row['latitude'], row['longitude']],
-            tooltip=row['city'],
-            fill=True,
-            fill_opacity=1,
-            opacity=1,
-            fill_color=color,
-            color=color,
-            radius=2,
-            popup=f"id:{row['station_id']}\ncity:{row['city']})"
-        )
-        marker.add_to(m)
+    if fast:
+        add_category_circles(m, df, 'city', get_city_color, popup={'id': 'station_id', 'city': 'city'})
+    else:
+        for idx, row in df.iterrows():
+            color = get_city_color(row['city'])
+            marker = folium.CircleMarker(
+                location=[row['latitude'], row['longitude']],
+                tooltip=row['city'],
+                fill=True,
+                fill_opacity=1,
+                opacity=1,
+                fill_color=color,
+                color=color,
+                radius=2,
+                popup=f"id:{row['station_id']}\ncity:{row['city']})"
+            )
+            marker.add_to(m)
 
     print("Plotting done")
     m.save(os.path.join(OUTPUT_FOLDER,OUTPUT_FILENAME))
@@ -56,7 +61,12 @@ def plot():
 
 
 def main():  
+    parser = argparse.ArgumentParser(description="Plots the stations of the top cities")
+    parser.add_argument('-f', '--fast', action='store_true', help='Draw the markers in the browser from one compact payload')
+    args = parser.parse_args()
+
     os.makedirs(OUTPUT_FOLDER, exist_ok=True)
-    plot()
+    plot(args.fast)
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,211 @@
+from common import *
+import json
+from dataclasses import dataclass, field
+
+
+DST_THRESHOLD = 30 #km, same as ClusterStations.sql
+MIN_CITY_SIZE = 40 #top cities have more stations than this
+SHORT_NAME_LEN = 20
+NAME_SEP = ", "
+MOVED_TOLERANCE = 1e-9 #degrees, a top city whose center moved less keeps the assignments of the previous run
+
+DEFAULT_STATE_FILE = get_real_path("../../data/stations_clusters_state.json")
+
+
+#----------------------------------------------------------
+# same formula as haversine_dst (HaversineDst.sql), vectorized
+def haversine_dst(lat1 : np.ndarray, lon1 : np.ndarray, lat2 : np.ndarray, lon2 : np.ndarray) -> np.ndarray:
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    cos_angle = np.cos(lat2) * np.cos(lat1) * np.cos(lon1 - lon2) + np.sin(lat2) * np.sin(lat1)
+    return EARTH_RADIUS_KM * np.arccos(np.clip(cos_angle, -1, 1))
+
+
+class UnionFind:
+    def __init__(self, n : int):
+        self.parent = list(range(n))
+
+    def find(self, x : int) -> int:
+        while self.parent[x] != x:
+            self.parent[x] = self.parent[self.parent[x]]
+            x = self.parent[x]
+        return x
+
+    def union(self, a : int, b : int) -> int:
+        a, b = self.find(a), self.find(b)
+        self.parent[b] = a
+        return a
+
+
+@dataclass
+class ClusterState:
+    """What a run leaves behind for the next incremental one: the top cities it used and the city of every station."""
+    dst_threshold : float
+    min_city_size : int
+    cities : dict[str, list[float]] = field(default_factory=dict) #city -> [lat, lon]
+    leaders : dict[str, str | None] = field(default_factory=dict) #station_id -> city (None if too far from all)
+
+    def save(self, file : str):
+        with open(file, "w") as f:
+            json.dump(self.__dict__, f)
+
+    @staticmethod
+    def load(file : str) -> 'ClusterState | None':
+        if not os.path.exists(file):
+            return None
+        with open(file, "r") as f:
+            return ClusterState(**json.load(f))
+
+
+#----------------------------------------------------------
+# stations with columns id, city, latitude, longitude (from the db or from stations.csv)
+def read_stations(stations_csv : str | None = None) -> pd.DataFrame:
+    if stations_csv is None:
+        return run_query("SELECT id, city, latitude, longitude FROM stations;").astype({'id': str})
+    return pd.read_csv(stations_csv, usecols=['uuid', 'city', 'latitude', 'longitude']).rename(columns={'uuid': 'id'})
+
+
+def top_cities(stations : pd.DataFrame, min_city_size : int) -> pd.DataFrame:
+    cities = stations.groupby('city').agg(lat=('latitude', 'mean'), lon=('longitude', 'mean'), size=('id', 'count'))
+    return cities[cities['size'] > min_city_size].reset_index()
+
+
+# chord of the unit sphere a bit longer than dst_threshold, the exact distance is checked after the KD-tree
+def search_chord(dst_threshold : float) -> float:
+    return 2 * np.sin((dst_threshold + 1) / EARTH_RADIUS_KM / 2)
+
+
+# closest top city within dst_threshold of every station (None if there is none)
+def assign_to_cities(stations : pd.DataFrame, cities : pd.DataFrame, dst_threshold : float) -> list[str | None]:
+    if len(stations) == 0 or len(cities) == 0:
+        return [None] * len(stations)
+
+    lat, lon = stations['latitude'].to_numpy(), stations['longitude'].to_numpy()
+    tree = cKDTree(to_unit_vectors(cities['lat'].to_numpy(), cities['lon'].to_numpy()))
+    _, idx = tree.query(to_unit_vectors(lat, lon), k=1, distance_upper_bound=search_chord(dst_threshold))
+
+    found = idx < len(cities)
+    city_idx = np.where(found, idx, 0)
+    dst = haversine_dst(cities['lat'].to_numpy()[city_idx], cities['lon'].to_numpy()[city_idx], lat, lon)
+    names = cities['city'].to_numpy()
+    return [names[i] if ok else None for i, ok in zip(city_idx, found & (dst <= dst_threshold))]
+
+
+# Merges the two closest clusters (by the distance of their centroids) while they are within 2 * dst_threshold,
+# like rec_clusters in ClusterStations.sql. Returns the merged cluster name of every leader.
+def merge_clusters(stations : pd.DataFrame, leaders : list[str | None], dst_threshold : float) -> dict[str, str]:
+    assigned = stations.assign(leader=leaders).dropna(subset=['leader'])
+    sums = assigned.groupby('leader').agg(lat=('latitude', 'sum'), lon=('longitude', 'sum'), size=('id', 'count'))
+    names = sums.index.tolist()
+    sum_lat, sum_lon, size = [sums[c].to_numpy(dtype=np.float64, copy=True) for c in ('lat', 'lon', 'size')]
+
+    def centroid_dst(i : int) -> np.ndarray:
+        row = haversine_dst(sum_lat[i] / size[i], sum_lon[i] / size[i], sum_lat / size, sum_lon / size)
+        row[i] = np.inf
+        row[(row > 2 * dst_threshold) | np.isnan(row)] = np.inf #too far, or already merged
+        return row
+
+    n = len(names)
+    dst = np.array([centroid_dst(i) for i in range(n)]).reshape(n, n)
+
+    uf = UnionFind(n)
+    while True:
+        a, b = np.unravel_index(np.argmin(dst), dst.shape)
+        if not np.isfinite(dst[a, b]):
+            break
+        uf.union(a, b)
+        names[a] = NAME_SEP.join([min(names[a], names[b]), max(names[a], names[b])])
+        sum_lat[a], sum_lon[a], size[a] = sum_lat[a] + sum_lat[b], sum_lon[a] + sum_lon[b], size[a] + size[b]
+        size[b] = np.nan
+        dst[b, :] = dst[:, b] = np.inf
+
+        dst[a, :] = dst[:, a] = centroid_dst(a)
+
+    return {leader: names[uf.find(i)] for i, leader in enumerate(sums.index)}
+
+
+# Same rows as the stations_clusters table of ClusterStations.sql
+def final_clusters(stations : pd.DataFrame, leaders : list[str | None], merged : dict[str, str]) -> pd.DataFrame:
+    clusters = pd.DataFrame({'station_id': stations['id'].to_numpy(), 'leader': leaders}).dropna(subset=['leader'])
+    clusters['cluster'] = clusters['leader'].map(merged)
+
+    cluster_names = sorted(set(merged.values()))
+    city_size = stations['city'].value_counts().to_dict()
+    new_names = {name: NAME_SEP.join(sorted(name.split(NAME_SEP), key=lambda city: -city_size.get(city, 0))) for name in cluster_names}
+
+    clusters['cluster_id'] = clusters['cluster'].map({name: i + 1 for i, name in enumerate(cluster_names)})
+    clusters['cluster_name'] = clusters['cluster'].map(new_names)
+    clusters['short_cluster_name'] = [name if len(name) <= SHORT_NAME_LEN else name[:SHORT_NAME_LEN] + "..." for name in clusters['cluster_name']]
+    return clusters[['station_id', 'cluster_id', 'cluster_name', 'short_cluster_name']].reset_index(drop=True)
+
+
+#----------------------------------------------------------
+# Why the previous state cannot be reused (None if it can): the assignments depend on the parameters and on which cities are top cities
+def full_clustering_reason(previous : ClusterState, state : ClusterState) -> str | None:
+    if (previous.dst_threshold, previous.min_city_size) != (state.dst_threshold, state.min_city_size):
+        return "dst_threshold or min_city_size changed"
+    added, removed = state.cities.keys() - previous.cities.keys(), previous.cities.keys() - state.cities.keys()
+    if added or removed:
+        return f"top cities changed ({len(added)} added, {len(removed)} removed)"
+    return None
+
+
+# Stations whose closest top city may differ from the previous run: the new ones, the ones assigned to a top city whose
+# center moved (it gained or lost stations) and the ones now within dst_threshold of a moved center.
+# The others keep their city: no center within dst_threshold of them moved.
+# Returns them with the number of new stations and of moved centers.
+def stations_to_assign(stations : pd.DataFrame, cities : pd.DataFrame, previous : ClusterState, dst_threshold : float) -> tuple[np.ndarray, int, int]:
+    centers = cities[['lat', 'lon']].to_numpy()
+    previous_centers = np.array([previous.cities[city] for city in cities['city']]).reshape(centers.shape)
+    moved = ~np.isclose(centers, previous_centers, rtol=0, atol=MOVED_TOLERANCE).all(axis=1)
+    moved_cities = set(cities['city'][moved])
+
+    ids = stations['id'].tolist()
+    is_new = np.array([id not in previous.leaders for id in ids], dtype=bool)
+    to_assign = is_new | np.array([previous.leaders.get(id) in moved_cities for id in ids], dtype=bool)
+    if moved.any():
+        tree = cKDTree(to_unit_vectors(stations['latitude'].to_numpy(), stations['longitude'].to_numpy()))
+        for near in tree.query_ball_point(to_unit_vectors(centers[moved, 0], centers[moved, 1]), search_chord(dst_threshold)):
+            to_assign[near] = True
+    return to_assign, int(is_new.sum()), int(moved.sum())
+
+
+# Clusters the stations like ClusterStations.sql (or PartialCluster.sql with partial).
+# With a previous state computed with the same parameters and top cities only the stations around the new ones and the
+# moved centers are assigned again, the merging always runs again (it only looks at one centroid per top city).
+def cluster_stations(stations : pd.DataFrame, dst_threshold : float = DST_THRESHOLD, min_city_size : int = MIN_CITY_SIZE,
+                     partial : bool = False, previous : ClusterState | None = None) -> tuple[pd.DataFrame, ClusterState]:
+    cities = top_cities(stations, min_city_size)
+    state = ClusterState(dst_threshold, min_city_size, {row.city: [row.lat, row.lon] for row in cities.itertuples()})
+
+    reason = full_clustering_reason(previous, state) if previous is not None else None
+    if previous is not None and reason is None:
+        to_assign, n_new, n_moved = stations_to_assign(stations, cities, previous, dst_threshold)
+        new_leaders = iter(assign_to_cities(stations[to_assign], cities, dst_threshold))
+        leaders = [next(new_leaders) if assign else previous.leaders[id] for id, assign in zip(stations['id'].tolist(), to_assign)]
+        print(f"Incremental clustering: {n_new} new stations, {n_moved} top cities moved, {int(to_assign.sum())} stations assigned again")
+    else:
+        if reason is not None:
+            print(f"Full clustering: {reason} since the previous run")
+        leaders = assign_to_cities(stations, cities, dst_threshold)
+
+    state.leaders = dict(zip(stations['id'], leaders))
+
+    if partial:
+        clusters = pd.DataFrame({'station_id': stations['id'].to_numpy(), 'cluster_name': leaders})
+        return clusters.dropna(subset=['cluster_name']).reset_index(drop=True), state
+
+    return final_clusters(stations, leaders, merge_clusters(stations, leaders, dst_threshold)), state
+
+
+def write_clusters(clusters : pd.DataFrame, table : str):
+    columns = {'station_id': "uuid", 'cluster_id': "bigint", 'cluster_name': "text", 'short_cluster_name': "text"}
+    columns = {c: t for c, t in columns.items() if c in clusters}
+
+    with get_pool().connection() as conn, conn.cursor() as cur:
+        cur.execute(f"DROP TABLE IF EXISTS {table};")
+        cur.execute(f"CREATE TABLE {table} ({', '.join(f'{c} {t}' for c, t in columns.items())});") #type: ignore
+        with cur.copy(f"COPY {table} ({', '.join(columns)}) FROM STDIN") as copy: #type: ignore
+            for row in zip(*[clusters[c].tolist() for c in columns]):
+                copy.write_row(row)
+        conn.commit()
+    print(f"Number of rows written: {len(clusters)}")
@@ -1,8 +1,11 @@
 from common import *
+from cluster_engine import ClusterState, DEFAULT_STATE_FILE, read_stations, cluster_stations, write_clusters
 import argparse
+import time
 
 #plotting
 import folium, random
+from fast_map import add_category_circles
 
 
 DO_PLOT = True
@@ -24,7 +27,7 @@ GET_CLUSTERS_SQL=f"""
     """
 
 
-def plot(output_file : str):
+def plot(output_file : str, fast : bool = False):
     generated_colors = set()
     def generate_color() -> str:
         while True:
@@ -41,26 +44,29 @@ def plot(output_file : str):
         return city_to_color[city]
     
     
-    df = run_query(GET_CLUSTERS_SQL)
+    df = run_query(GET_CLUSTERS_SQL, use_cache=False) #the table was just rebuilt
     print(f"Query done | Available columns: {df.columns}")
 
     m = folium.Map(tiles=None,location=(51.1657, 10.4515),zoom_start=7,control_scale=True)
     folium.TileLayer("CartoDB Positron",control=False).add_to(m)
 
-    for idx, row in df.iterrows():
-        color = get_city_color(row['cluster_name'])
-        marker = folium.CircleMarker(
-            location=[row['latitude'], row['longitude']],
-            tooltip=row['cluster_name'],
-            fill=True,
-            fill_opacity=1,
-            opacity=1,
-            fill_color=color,
-            color=color,
-            radius=2,
-            popup=f"id:{row['station_id']}\ncity:{row['city']})"
-        )
-        marker.add_to(m)
+    if fast:
+        add_category_circles(m, df, 'cluster_name', get_city_color, popup={'id': 'station_id', 'city': 'city'})
+    else:
+        for idx, row in df.iterrows():
+            color = get_city_color(row['cluster_name'])
+            marker = folium.CircleMarker(
+                location=[row['latitude'], row['longitude']],
+                tooltip=row['cluster_name'],
+                fill=True,
+                fill_opacity=1,
+                opacity=1,
+                fill_color=color,
+                color=color,
+                radius=2,
+                popup=f"id:{row['station_id']}\ncity:{row['city']})"
+            )
+            marker.add_to(m)
 
     print("Plotting done")
     m.save(os.path.join(OUTPUT_FOLDER,output_file))
@@ -68,33 +74,58 @@ def plot(output_file : str):
 
 
 def export_clusters(outfile : str):
-    run_query(f"SELECT * from {TABLE};").to_csv(outfile,index=False)
+    run_query(f"SELECT * from {TABLE};", use_cache=False).to_csv(outfile,index=False)
+
+
+def run_sql(partial : bool):
+    print(f"Executing: {QUERY_CREATE_DST}")
+    execute_statement(read_query(QUERY_CREATE_DST))
+
+    query_file = QUERY_PARTIAL if partial else QUERY_COMPLETE
+    print(f"Executing: {query_file}")
+    execute_statement(read_query(query_file), skip_if_done=True)
+
+
+def run_python(partial : bool, stations_csv : str | None, incremental : bool, state_file : str):
+    stations = read_stations(stations_csv)
+    previous = ClusterState.load(state_file) if incremental else None
+
+    start = time.perf_counter()
+    clusters, state = cluster_stations(stations, partial=partial, previous=previous)
+    print(f"Clustered {len(stations)} stations in {time.perf_counter() - start:.2f}s")
+
+    state.save(state_file)
+    write_clusters(clusters, TABLE)
 
 
 def main():  
     parser = argparse.ArgumentParser(description="Parse an optional -e <file_path> argument.")
     parser.add_argument('-e', '--export',type=str, metavar='file_path', help='Export the <file_path> as csv (path relative to the caller)')
     parser.add_argument('-p', '--partial', action='store_true', help='Run partial clustering')
+    parser.add_argument('--engine', choices=['python', 'sql'], default='python', help='Cluster in python (cluster_engine.py) or with the sql queries')
+    parser.add_argument('-s', '--stations', type=str, metavar='csv_path', help='[python] Read the stations from a csv (e.g. data/stations.csv) instead of the db', default=None)
+    parser.add_argument('-i', '--incremental', action='store_true', help='[python] Only assign again the new stations and the ones around moved top cities (if the top cities did not change)')
+    parser.add_argument('-f', '--fast', action='store_true', help='Draw the markers in the browser from one compact payload')
+    parser.add_argument('--state', type=str, metavar='file_path', help='[python] State kept between runs', default=DEFAULT_STATE_FILE)
     args = parser.parse_args()
 
     os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
-    print(f"Executing: {QUERY_CREATE_DST}")
-    execute_statement(read_query(QUERY_CREATE_DST))
-
-    query_file = QUERY_PARTIAL if args.partial else QUERY_COMPLETE
-    print(f"Executing: {query_file}")
-    execute_statement(read_query(query_file))
+    if args.engine == 'sql':
+        run_sql(args.partial)
+    else:
+        run_python(args.partial, args.stations, args.incremental, args.state)
 
     if DO_PLOT:
         plot_file = OUTPUT_PARTIAL if args.partial else OUTPUT_COMPLETE
-        plot(plot_file)
+        plot(plot_file, args.fast)
     
     if args.export:
         export_clusters(args.export)
         print(f"Clusters exported to {args.export}")
 
 
-main()
+if __name__ == "__main__":
+    main()
  
 
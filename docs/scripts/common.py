@@ -1,14 +1,24 @@
 import os
+import re
+import time
+import atexit
+import hashlib
 from typing import Callable, List
 
 #query cedardb
 import psycopg as pg 
+from psycopg_pool import ConnectionPool
 import pandas as pd 
 
+#radius lookups
+import numpy as np
+from scipy.spatial import cKDTree
+
 USER = 'client'
 USER_PSWD = 'client'
 DB = 'client'
 PORT=5432
+CONN_STR = f"host=localhost port={PORT} user={USER} password={USER_PSWD} dbname={DB}"
 
 
 def get_real_path(relative_path : str) -> str:
@@ -17,6 +27,12 @@ def get_real_path(relative_path : str) -> str:
 
 OUTPUT_FOLDER = get_real_path("../plots/point_in_time/")
 
+#query results cache (set QUERY_CACHE=0 to disable it)
+CACHE_ENABLED = os.getenv("QUERY_CACHE", "1") != "0"
+CACHE_FOLDER = get_real_path("../../data/query_cache/")
+CACHE_MAX_AGE = 7 * 24 * 3600 #seconds
+CACHE_MAX_BYTES = 1 << 30
+
 
 def transform_query(query : str, overwrite_f : List[Callable[[str],str]] = []) -> str:
     for transformation in overwrite_f:
@@ -26,6 +42,11 @@ def transform_query(query : str, overwrite_f : List[Callable[[str],str]] = []) -
 def replace_fuel_gen(fuel : str) -> Callable[[str],str]:
     return lambda q: q.replace("diesel",fuel)
 
+FUELS = ['diesel', 'e5', 'e10']
+
+def multi_fuel_file(query_file : str) -> str:
+    return query_file.replace(".sql", "MultiFuel.sql")
+
 
 
 
@@ -33,16 +54,149 @@ def read_query(query_file : str, overwrite_f : List[Callable[[str],str]] = []) -
     query = open(get_real_path(query_file),"r").read()
     return transform_query(query, overwrite_f)
 
-def execute_statement(stmt : str):
-     with pg.connect(f"host=localhost port={PORT} user={USER} password={USER_PSWD} dbname={DB}") as conn:
+#----------------------------------------------------------
+POOL_SIZE = 4
+_pool : ConnectionPool | None = None
+
+# one pool per process, connections are reused by every statement and query
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        _pool = ConnectionPool(CONN_STR, min_size=1, max_size=POOL_SIZE, open=True)
+        atexit.register(_pool.close)
+    return _pool
+
+
+# Fingerprint of the tables a query reads: row count and max(time) (for tables with a time column).
+# A cached result is used only if none of them changed since it was stored. The stats of a table are computed
+# once per process (scripts plot from data that does not change while they run), until a statement is executed.
+TIME_COLUMNS = ['time', 'last_update', 'hour']
+_table_columns : dict[str, set[str]] | None = None
+_table_stats : dict[str, list] = {}
+
+def max_time_sql(table : str, columns : set[str]) -> str:
+    time_column = next((c for c in TIME_COLUMNS if c in columns), None)
+    return f"(SELECT max({time_column})::text FROM {table})" if time_column else "NULL"
+
+# tables after FROM, JOIN (or a comma), INTO, UPDATE or TABLE, outside of comments
+def query_tables(query : str, tables : set[str]) -> list[str]:
+    code = re.sub(r"--[^\n]*|/\*.*?\*/", " ", query, flags=re.DOTALL)
+    return sorted(t for t in tables if re.search(rf"(?:\b(?:from|join|into|update|table)\s+|,\s*){t}\b", code, re.IGNORECASE))
+
+def reset_tables_fingerprint():
+    global _table_columns
+    _table_columns = None
+    _table_stats.clear()
+
+def tables_fingerprint(conn : pg.Connection, query : str) -> list:
+    global _table_columns
+    if _table_columns is None:
+        _table_columns = {}
+        for table, column in conn.execute("SELECT table_name, column_name FROM information_schema.columns WHERE table_schema = 'public';").fetchall():
+            _table_columns.setdefault(table, set()).add(column)
+
+    tables = query_tables(query, set(_table_columns))
+    missing = [t for t in tables if t not in _table_stats]
+    if len(missing) > 0:
+        stats = ", ".join(f"(SELECT count(*) FROM {t}), {max_time_sql(t, _table_columns[t])}" for t in missing)
+        values = list(conn.execute(f"SELECT {stats};").fetchone()) #type: ignore
+        for i, t in enumerate(missing):
+            _table_stats[t] = values[2 * i : 2 * i + 2]
+    return [[t, *_table_stats[t]] for t in tables]
+
+
+def cache_key(conn : pg.Connection, query : str, params : object) -> str:
+    return hashlib.sha256(repr((query, params, tables_fingerprint(conn, query))).encode()).hexdigest()
+
+def cache_file(key : str) -> str:
+    return os.path.join(CACHE_FOLDER, f"{key}.pkl")
+
+def cache_get(key : str) -> pd.DataFrame | None:
+    file = cache_file(key)
+    if not os.path.exists(file):
+        return None
+    if time.time() - os.path.getmtime(file) > CACHE_MAX_AGE:
+        os.remove(file)
+        return None
+    return pd.read_pickle(file)
+
+# stores a result, then evicts the least recently used entries until the cache fits in CACHE_MAX_BYTES
+def cache_put(key : str, df : pd.DataFrame):
+    os.makedirs(CACHE_FOLDER, exist_ok=True)
+    df.to_pickle(cache_file(key) + ".tmp")
+    os.replace(cache_file(key) + ".tmp", cache_file(key))
+
+    entries = sorted((os.path.getatime(f), os.path.getsize(f), f) for f in (os.path.join(CACHE_FOLDER, name) for name in os.listdir(CACHE_FOLDER)) if f.endswith(".pkl"))
+    total = sum(size for _, size, _ in entries)
+    for _, size, f in entries:
+        if total <= CACHE_MAX_BYTES or f == cache_file(key):
+            break
+        os.remove(f)
+        total -= size
+
+
+# With skip_if_done the statement is not executed again if it already ran and the tables it mentions did not change since
+def execute_statement(stmt : str, skip_if_done : bool = False):
+    with get_pool().connection() as conn:
+        use_cache = skip_if_done and CACHE_ENABLED
+        if use_cache and cache_get(cache_key(conn, stmt, None)) is not None:
+            print("Skipped: already executed on the same data")
+            return
+
         with conn.cursor() as cur:
             cur.execute(stmt) #type: ignore
             print(f"Number of rows affected: {cur.rowcount}")
             conn.commit()
 
-def run_query(query : str) -> pd.DataFrame:
-    with pg.connect(f"host=localhost port={PORT} user={USER} password={USER_PSWD} dbname={DB}") as conn:
-        return pd.read_sql(query,conn)
-
-
-
+        reset_tables_fingerprint() #the statement may have created or changed tables
+
+        if use_cache:
+            cache_put(cache_key(conn, stmt, None), pd.DataFrame())
+
+def run_query(query : str, params : dict | None = None, use_cache : bool = True) -> pd.DataFrame:
+    with get_pool().connection() as conn:
+        if not (use_cache and CACHE_ENABLED):
+            return pd.read_sql(query, conn, params=params) #type: ignore
+
+        key = cache_key(conn, query, params)
+        df = cache_get(key)
+        if df is None:
+            df = pd.read_sql(query, conn, params=params) #type: ignore
+            cache_put(key, df)
+        else:
+            os.utime(cache_file(key), (time.time(), os.path.getmtime(cache_file(key)))) #atime: last use, mtime: stored at
+        return df
+
+# Runs the MultiFuel variant of a query parametrized by fuel (e.g. PriceAt.sql -> PriceAtMultiFuel.sql):
+# prices are scanned once for all fuels, the result (one row per fuel) is split by its fuel column
+def run_query_multi_fuel(query_file : str, overwrite_f : List[Callable[[str],str]] = [], fuels : List[str] = FUELS) -> dict[str, pd.DataFrame]:
+    df = run_query(read_query(multi_fuel_file(query_file), overwrite_f))
+    return {fuel: df[df['fuel'] == fuel].drop(columns='fuel').reset_index(drop=True) for fuel in fuels}
+
+
+EARTH_RADIUS_KM = 6371 #same as haversine_dst
+
+def to_unit_vectors(lat : np.ndarray, lon : np.ndarray) -> np.ndarray:
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+class StationsTree:
+    """
+    KD-tree over the stations (latitude and longitude columns) for offline radius lookups.
+    Points live on the unit sphere, so the great-circle radius is searched as the matching chord length.
+    """
+    def __init__(self, stations : pd.DataFrame):
+        self.stations = stations.reset_index(drop=True)
+        self.tree = cKDTree(to_unit_vectors(self.stations['latitude'].to_numpy(), self.stations['longitude'].to_numpy()))
+
+    # stations within radius_km of (lat, lon) with their distance (dst_km), closest first
+    def within(self, lat : float, lon : float, radius_km : float) -> pd.DataFrame:
+        center = to_unit_vectors(np.array([lat]), np.array([lon]))[0]
+        chord = 2 * np.sin(min(radius_km / EARTH_RADIUS_KM, np.pi) / 2)
+        idx = np.array(self.tree.query_ball_point(center, chord), dtype=np.int64)
+
+        result = self.stations.iloc[idx].copy()
+        chords = np.linalg.norm(self.tree.data[idx] - center, axis=1)
+        result['dst_km'] = 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(chords / 2, 0, 1))
+        return result.sort_values('dst_km')
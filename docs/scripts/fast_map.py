@@ -0,0 +1,86 @@
+from common import *
+import json
+
+#plotting
+import folium
+from folium.plugins import MarkerCluster
+from folium.template import Template
+
+
+COORD_DECIMALS = 5 #~1 m
+Z_SCORE_DECIMALS = 2
+
+
+def z_scores(values : pd.Series) -> pd.Series:
+    return (values - values.mean()) / values.std() #sample std, like STDDEV
+
+
+# Colors of many values with one call per distinct value (color_f is slow, e.g. a branca colormap).
+# Missing values get a code too, color_f gets them as the CircleMarker loop did.
+def to_palette(values : pd.Series, color_f : Callable[[object], str]) -> tuple[list[str], np.ndarray]:
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    return [color_f(value) for value in uniques], codes
+
+
+def compact_json(payload : object) -> str:
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False, default=str).replace("</", "<\\/")
+
+
+class FastCircles(MarkerCluster):
+    """
+    Circle markers drawn in the browser (on a canvas) from one compact payload, instead of one folium.CircleMarker
+    (and one block of javascript) per point. Rows are [lat, lon, color index, z_score, tooltip, *popup values]
+    (popup: label -> column), markers are clustered only with clustered=True.
+    """
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function(){
+                var payload = {{ this.payload }};
+                {%- if this.clustered %}
+                var layer = L.markerClusterGroup({{ this.options|tojavascript }});
+                {%- if this.icon_create_function is not none %}
+                layer.options.iconCreateFunction = {{ this.icon_create_function.strip() }};
+                {%- endif %}
+                {%- else %}
+                var layer = L.featureGroup();
+                {%- endif %}
+                var renderer = L.canvas();
+                var markers = payload.rows.map(function(row) {
+                    var color = payload.palette[row[2]];
+                    var marker = L.circleMarker([row[0], row[1]], {renderer: renderer, radius: {{ this.radius }},
+                        fill: true, fillOpacity: 1, opacity: 1, fillColor: color, color: color, z_score: row[3]});
+                    var popup = payload.popup.map(function(label, i) { return label + ':' + row[5 + i]; });
+                    return marker.bindTooltip(String(row[4])).bindPopup(popup.join('<br>'));
+                });
+                {%- if this.clustered %}
+                layer.addLayers(markers);
+                {%- else %}
+                markers.forEach(function(marker) { marker.addTo(layer); });
+                {%- endif %}
+                return layer;
+            })();
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, df : pd.DataFrame, colors : pd.Series, color_f : Callable[[object], str], tooltip : str, popup : dict[str, str],
+                 z_score : str | None = None, clustered : bool = False, radius : int = 2, **kwargs):
+        super().__init__(**kwargs)
+        self._name = "FastCircles"
+        self.clustered, self.radius = clustered, radius
+
+        palette, codes = to_palette(colors, color_f)
+        z = df[z_score].round(Z_SCORE_DECIMALS) if z_score else pd.Series(0, index=df.index)
+        rows = pd.DataFrame({
+            'lat': df['latitude'].round(COORD_DECIMALS), 'lon': df['longitude'].round(COORD_DECIMALS),
+            'color': codes, 'z_score': z, 'tooltip': df[tooltip],
+            **{f"popup_{label}": df[column] for label, column in popup.items()}
+        })
+        rows = rows.astype(object).where(rows.notna(), None) #NaN is not valid json
+        self.payload = compact_json({'palette': palette, 'popup': list(popup), 'rows': rows.values.tolist()})
+
+
+# Same map as the CircleMarker loops: one color per category (e.g. city or cluster)
+def add_category_circles(m : folium.Map, df : pd.DataFrame, category : str, color_f : Callable[[object], str], popup : dict[str, str]):
+    FastCircles(df, df[category], color_f, tooltip=category, popup=popup, control=False).add_to(m)
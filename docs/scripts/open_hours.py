@@ -0,0 +1,63 @@
+from common import *
+
+
+HOURS_PER_WEEK = 168
+DAY = 24 * 3600
+WEEK = 7 * DAY
+FULL_HOUR = (1 << 60) - 1 #every minute of an hour open
+EPOCH_WEEKDAY = 3 #1970-01-01 was a thursday, monday is day 0
+
+
+#----------------------------------------------------------
+# hour of the week (monday 00:00 is 0), minute of the hour and second of the minute of times in seconds since epoch
+def split_week(t : np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    days = t // DAY + EPOCH_WEEKDAY
+    week, offset = days // 7, (days % 7) * DAY + t % DAY
+    return week, offset // 3600, (offset % 3600) // 60, offset % 60
+
+
+class OpenHours:
+    """
+    Weekly opening hours of every station as a bitmap, same as stations.open_hours (sql/open_hours.sql):
+    bits[s, h] has bit m set if station s is open during minute m of hour h of the week (monday 00:00 is hour 0).
+    Open seconds up to t are a running sum per hour plus the popcount of one masked word.
+    """
+    def __init__(self, bits : np.ndarray):
+        self.bits = bits.astype(np.int64) #60 bits used, never negative
+        minutes = np.bitwise_count(self.bits).astype(np.int64)
+        self.seconds_before = np.concatenate([np.zeros((len(bits), 1), dtype=np.int64), np.cumsum(minutes * 60, axis=1)], axis=1) #(S, 169)
+
+    # bitmap of the rows of stations_times (station index, days bitmask, open/close seconds of the day) and of always open stations.
+    # Minutes are open from open_time to close_time rounded up (23:59:59 closes at midnight), past midnight if close_time < open_time.
+    @staticmethod
+    def from_times(always_open : np.ndarray, times_station : np.ndarray, times_days : np.ndarray, times_open : np.ndarray, times_close : np.ndarray) -> 'OpenHours':
+        bits = np.zeros((len(always_open), HOURS_PER_WEEK), dtype=np.int64)
+        bits[always_open] = FULL_HOUR
+
+        #one interval [from_minute, to_minute) of the week per row and day
+        row, day = np.nonzero((times_days[:, None] >> np.arange(7)) & 1)
+        from_minute = day * 1440 + times_open[row] // 60
+        to_minute = day * 1440 + -(-times_close[row] // 60) + np.where(times_close[row] < times_open[row], 1440, 0)
+
+        #split into the hours they cover
+        first_hour, last_hour = from_minute // 60, (to_minute - 1) // 60
+        n_hours = np.maximum(last_hour - first_hour + 1, 0)
+        idx = np.repeat(np.arange(len(row)), n_hours)
+        hour = first_hour[idx] + np.arange(n_hours.sum()) - np.repeat(np.cumsum(n_hours) - n_hours, n_hours)
+        lo = np.maximum(from_minute[idx] - hour * 60, 0)
+        hi = np.minimum(to_minute[idx] - hour * 60, 60)
+        mask = ((np.int64(1) << hi) - 1) & ~((np.int64(1) << lo) - 1)
+
+        np.bitwise_or.at(bits, (times_station[row[idx]], hour % HOURS_PER_WEEK), mask)
+        return OpenHours(bits)
+
+    @staticmethod
+    def from_arrays(open_hours : list) -> 'OpenHours':
+        return OpenHours(np.array([list(h) for h in open_hours], dtype=np.int64).reshape(len(open_hours), HOURS_PER_WEEK))
+
+    # open seconds of every station from the first monday after the epoch to t
+    def open_seconds_to(self, station : np.ndarray, t : np.ndarray) -> np.ndarray:
+        week, hour, minute, second = split_week(t)
+        word = self.bits[station, hour]
+        return (week * self.seconds_before[station, -1] + self.seconds_before[station, hour]
+                + 60 * np.bitwise_count(word & ((np.int64(1) << minute) - 1)).astype(np.int64) + second * ((word >> minute) & 1))
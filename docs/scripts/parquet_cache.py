@@ -0,0 +1,145 @@
+from common import get_real_path
+import os
+import argparse
+from datetime import datetime
+from typing import Iterable
+
+#columnar cache
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.dataset as ds
+import pyarrow.fs as pa_fs
+import pyarrow.parquet as pq
+import pandas as pd
+
+
+DEFAULT_PRICES_FOLDER = get_real_path("../../data/prices")
+DEFAULT_CACHE_FOLDER = get_real_path("../../data/prices_parquet")
+
+FUELS = ['diesel', 'e5', 'e10']
+PRICE_SCALE = 1000 #prices stored as int16 in tenths of a cent (1.759 -> 1759)
+MAX_PRICE = 32.767 #largest price fitting in int16, rows with a price beyond it (bogus, e.g. 40.000) are dropped
+COMPRESSION = "zstd"
+
+# time: seconds since epoch of the local timestamp, ignoring the offset (as the db stores it in prices.time)
+SCHEMA = pa.schema(
+    [('time', pa.int64()), ('station_uuid', pa.dictionary(pa.int32(), pa.string()))]
+    + [(fuel, pa.int16()) for fuel in FUELS]
+    + [(f"{fuel}_change", pa.int8()) for fuel in FUELS]
+)
+
+
+#----------------------------------------------------------
+def cache_file_path(cache_folder : str, date : str) -> str:
+    year, month, _ = date.split("-")
+    return os.path.join(cache_folder, f"year={year}", f"month={month}", f"{date}.parquet")
+
+
+# Table of a price file and the number of rows dropped because a price does not fit in int16
+def read_price_csv(file : str) -> tuple[pa.Table, int]:
+    csv = pa_csv.read_csv(file, convert_options=pa_csv.ConvertOptions(column_types={
+        'date': pa.string(), 'station_uuid': pa.string(),
+        **{fuel: pa.float64() for fuel in FUELS}, **{f"{fuel}change": pa.int8() for fuel in FUELS}
+    }))
+
+    in_range = None
+    for fuel in FUELS:
+        fits = pc.fill_null(pc.less_equal(pc.abs(csv[fuel]), MAX_PRICE), True) #missing prices stay null
+        in_range = fits if in_range is None else pc.and_(in_range, fits)
+    n_rows = csv.num_rows
+    csv = csv.filter(in_range)
+
+    local_time = pc.strptime(pc.utf8_slice_codeunits(csv['date'], 0, 19), format="%Y-%m-%d %H:%M:%S", unit='s')
+    columns = [local_time.cast(pa.int64()), pc.dictionary_encode(csv['station_uuid'])]
+    columns += [pc.round(pc.multiply(csv[fuel], PRICE_SCALE)).cast(pa.int16()) for fuel in FUELS]
+    columns += [csv[f"{fuel}change"] for fuel in FUELS]
+    return pa.Table.from_arrays(columns, schema=SCHEMA), n_rows - csv.num_rows
+
+
+# Converts every *-prices.csv under prices_folder (skipping up-to-date ones), returns (csv bytes, parquet bytes)
+def convert(prices_folder : str, cache_folder : str, from_date : str = "", to_date : str = "9999") -> tuple[int, int]:
+    csv_bytes, parquet_bytes = 0, 0
+    for root, _, files in os.walk(prices_folder):
+        for file in sorted(files):
+            date = file.split("-prices.csv")[0]
+            if not file.endswith("-prices.csv") or not (from_date <= date < to_date):
+                continue
+
+            csv_file, parquet_file = os.path.join(root, file), cache_file_path(cache_folder, date)
+            if not os.path.exists(parquet_file) or os.path.getmtime(parquet_file) < os.path.getmtime(csv_file):
+                os.makedirs(os.path.dirname(parquet_file), exist_ok=True)
+                table, n_dropped = read_price_csv(csv_file)
+                pq.write_table(table, parquet_file + ".tmp", compression=COMPRESSION)
+                os.replace(parquet_file + ".tmp", parquet_file)
+                print(f"Converted {file}" + (f" ({n_dropped} rows with a price above {MAX_PRICE} dropped)" if n_dropped > 0 else ""))
+
+            csv_bytes += os.path.getsize(csv_file)
+            parquet_bytes += os.path.getsize(parquet_file)
+
+    return csv_bytes, parquet_bytes
+
+
+#----------------------------------------------------------
+PARTITIONING = ds.partitioning(pa.schema([('year', pa.int16()), ('month', pa.int8())]), flavor="hive")
+
+def to_datetime(t : datetime | str) -> datetime:
+    return (datetime.fromisoformat(t) if isinstance(t, str) else t).replace(tzinfo=None)
+
+def to_epoch(t : datetime | str) -> int:
+    return int((to_datetime(t) - datetime(1970, 1, 1)).total_seconds())
+
+
+def open_cache(cache_folder : str = DEFAULT_CACHE_FOLDER) -> ds.Dataset:
+    schema = SCHEMA.append(pa.field('year', pa.int16())).append(pa.field('month', pa.int8()))
+    return ds.dataset(cache_folder, schema=schema, format="parquet", partitioning=PARTITIONING,
+                      filesystem=pa_fs.LocalFileSystem(use_mmap=True))
+
+
+# Reads prices in [start, end) (local time, like prices.time) optionally only for some stations.
+# Predicates are pushed down: partitions of months outside the range are never opened,
+# row groups are pruned by their time statistics.
+def read_prices(start : datetime | str | None = None, end : datetime | str | None = None, stations : Iterable[str] | None = None,
+                columns : list[str] | None = None, cache_folder : str = DEFAULT_CACHE_FOLDER, as_float : bool = True) -> pd.DataFrame:
+    year, month = ds.field('year'), ds.field('month')
+    filters : list[ds.Expression] = []
+
+    if start is not None:
+        s = to_datetime(start)
+        filters += [(year > s.year) | ((year == s.year) & (month >= s.month)), ds.field('time') >= to_epoch(s)]
+    if end is not None:
+        e = to_datetime(end)
+        filters += [(year < e.year) | ((year == e.year) & (month <= e.month)), ds.field('time') < to_epoch(e)]
+    if stations is not None:
+        filters.append(ds.field('station_uuid').isin(list(stations)))
+
+    filter = None
+    for expr in filters:
+        filter = expr if filter is None else filter & expr
+
+    table = open_cache(cache_folder).to_table(columns=columns or SCHEMA.names, filter=filter)
+    df = table.to_pandas()
+    if 'time' in df:
+        df['time'] = pd.to_datetime(df['time'], unit='s')
+    if as_float:
+        for fuel in FUELS:
+            if fuel in df:
+                df[fuel] = df[fuel] / PRICE_SCALE
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Converts the price csv files to a partitioned parquet cache")
+    parser.add_argument("-p", "--price-folder", type=str, help="Path to the price folder", default=DEFAULT_PRICES_FOLDER)
+    parser.add_argument("-o", "--output", type=str, help="Path to the parquet cache", default=DEFAULT_CACHE_FOLDER)
+    parser.add_argument("--from-date", type=str, help="First day to convert (YYYY-MM-DD)", default="")
+    parser.add_argument("--to-date", type=str, help="First day not to convert (YYYY-MM-DD)", default="9999")
+    args = parser.parse_args()
+
+    csv_bytes, parquet_bytes = convert(args.price_folder, args.output, args.from_date, args.to_date)
+    if parquet_bytes > 0:
+        print(f"CSV: {csv_bytes / (1 << 20):.1f} MB -> Parquet: {parquet_bytes / (1 << 20):.1f} MB ({csv_bytes / parquet_bytes:.1f}x smaller)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,12 @@
 from common import *
+import argparse
+import time
 
 #plotting
 import folium
 from folium.plugins import MarkerCluster
 import branca.colormap as cm
+from fast_map import FastCircles, z_scores, Z_SCORE_DECIMALS
 
 
 QUERY="../sql/point_in_time/PriceAt.sql"
@@ -63,10 +66,11 @@ def get_color(z_score):
             return 'pink'
         return COLORMAP(z_score)
 
-# Query prices for a certain fuel and create a markerCluster out of them
-def create_cluster(fuel : str) -> MarkerCluster:
-    df = run_query(read_query(QUERY,[replace_fuel_gen(fuel)]))
-    print(f"Query done for {fuel}")
+# Query prices for a certain fuel (unless already queried) and create a markerCluster out of them
+def create_cluster(fuel : str, df : pd.DataFrame | None = None) -> MarkerCluster:
+    if df is None:
+        df = run_query(read_query(QUERY,[replace_fuel_gen(fuel)]))
+        print(f"Query done for {fuel}")
 
     mean_value, std_dev = df[VALUE_COL].mean(),df[VALUE_COL].std()
     print(f"Fuel: {fuel} -> Mean: {mean_value} | StdDev: {std_dev}")
@@ -92,15 +96,35 @@ def create_cluster(fuel : str) -> MarkerCluster:
     return cluster_markers
 
 
+# Same as create_cluster, markers are drawn in the browser and colored by z-score computed here
+def create_fast_cluster(fuel : str, df : pd.DataFrame | None = None) -> FastCircles:
+    if df is None:
+        df = run_query(read_query(QUERY,[replace_fuel_gen(fuel)]))
+        print(f"Query done for {fuel}")
+
+    mean_value, std_dev = df[VALUE_COL].mean(),df[VALUE_COL].std()
+    print(f"Fuel: {fuel} -> Mean: {mean_value} | StdDev: {std_dev}")
+
+    df['z_score'] = z_scores(df[VALUE_COL])
+    return FastCircles(df, df['z_score'].round(Z_SCORE_DECIMALS), get_color, tooltip=VALUE_COL,
+                       popup={'id': 'station_id', 'val': VALUE_COL, 'city': 'city', 'brand': 'brand'}, z_score='z_score', clustered=True,
+                       icon_create_function=js_func, overlay=False, name=f"{fuel}: avg:{mean_value:.4f}", show=False,
+                       options={"disableClusteringAtZoom":AGGREGATE_UNTIL_ZOOM})
+
+
+# For each fuel, query, create a MarkerCluster, add it to map (with multi_fuel all fuels are queried at once)
+def map_analysis(fast : bool = False, multi_fuel : bool = False):
+    start = time.perf_counter()
+    prices = run_query_multi_fuel(QUERY, fuels=FUELS_TO_PLOT) if multi_fuel else {}
+    if multi_fuel:
+        print(f"Query done for {', '.join(FUELS_TO_PLOT)}")
 
-# For each fuel, query, create a MarkerCluster, add it to map
-def map_analysis():
     m = folium.Map(tiles=None,location=(51.1657, 10.4515),zoom_start=7,control_scale=True)
     folium.TileLayer("CartoDB Positron",control=False).add_to(m)
     COLORMAP.add_to(m)
 
     for idx,fuel in enumerate(FUELS_TO_PLOT):
-        fuel_cluster = create_cluster(fuel)
+        fuel_cluster = create_fast_cluster(fuel, prices.get(fuel)) if fast else create_cluster(fuel, prices.get(fuel))
         if idx == 0:
             fuel_cluster.show = True
 
@@ -111,12 +135,17 @@ def map_analysis():
     print("Plotting done")
 
     m.save(os.path.join(OUTPUT_FOLDER,OUTPUT_FILENAME)) #this takes a while!
-    print(f"Map saved in {OUTPUT_FILENAME}")
+    print(f"Map saved in {OUTPUT_FILENAME} ({os.path.getsize(os.path.join(OUTPUT_FOLDER,OUTPUT_FILENAME)) / (1 << 20):.1f} MB, {time.perf_counter() - start:.1f}s)")
 
 
 def main():    
+    parser = argparse.ArgumentParser(description="Plots the price of every open station, colored by deviation from the mean")
+    parser.add_argument('-f', '--fast', action='store_true', help='Draw the markers in the browser from one compact payload')
+    parser.add_argument('-m', '--multi-fuel', action='store_true', help=f'Query all fuels at once with {multi_fuel_file(os.path.basename(QUERY))}')
+    args = parser.parse_args()
+
     os.makedirs(OUTPUT_FOLDER, exist_ok=True)
-    map_analysis()
+    map_analysis(args.fast, args.multi_fuel)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
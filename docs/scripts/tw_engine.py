@@ -0,0 +1,308 @@
+from common import *
+import re
+import time
+import argparse
+from datetime import datetime, timedelta
+from functools import cached_property
+
+import numpy as np
+from open_hours import OpenHours
+
+
+QUERY="../sql/time_series/AvgTW.sql"
+QUERY_OPEN_HOURS="../sql/time_series/AvgTWOpenHours.sql"
+
+DEFAULT_START = "2024-01-08T00:00:00"
+DEFAULT_END = "2024-01-21T23:59:59"
+DEFAULT_GRANULARITY = 3600 #seconds
+FUELS = ['diesel', 'e5', 'e10']
+
+DAY = 24 * 3600
+ACTIVE_WINDOW = 3 * DAY #a station is active if it sent an update in the last 3 days
+PRICE_SCALE = 1000      #prices are summed as integers in tenths of a cent, exactly like numeric in the db
+STATION_SHIFT = 1 << 36 #keys of different stations never overlap: station_idx * STATION_SHIFT + seconds
+BUCKETS_PER_CHUNK = 64  #bounds memory: buckets x stations_times rows evaluated at once
+
+
+#----------------------------------------------------------
+def to_seconds(values) -> np.ndarray:
+    return np.asarray(pd.to_datetime(values), dtype='datetime64[s]').astype(np.int64)
+
+def time_of_day_seconds(values) -> np.ndarray:
+    return np.array([t.hour * 3600 + t.minute * 60 + t.second for t in pd.to_datetime(values.astype(str), format="%H:%M:%S").dt.time], dtype=np.int64)
+
+
+class TWInputs:
+    """
+    Everything AvgTW.sql reads, as plain numpy arrays (times in seconds since epoch, local time as in the db):
+    - stations: id, always_open, first_active
+    - stations_times: station index, days bitmask, open/close seconds of the day
+    - prices of one fuel in [start - 3 days, end]: station index, time, price (tenths of a cent), change flag
+    - open_hours: the weekly opening hours bitmap, from stations.open_hours if it was read, otherwise built from stations_times
+    """
+    def __init__(self, stations : pd.DataFrame, times : pd.DataFrame, prices : pd.DataFrame, fuel : str):
+        self.station_ids = stations['id'].astype(str).to_numpy()
+        index = pd.Index(self.station_ids)
+        self.always_open = stations['always_open'].astype(str).str.lower().isin(['true', 't']).to_numpy()
+        self.first_active = to_seconds(stations['first_active'].astype(str).str.slice(0, 19))
+        self.open_hours_column = stations['open_hours'].tolist() if 'open_hours' in stations and stations['open_hours'].notna().all() else None
+
+        times = times[times['station_id'].astype(str).isin(index)]
+        self.times_station = index.get_indexer(times['station_id'].astype(str))
+        self.times_days = times['days'].to_numpy(dtype=np.int64)
+        self.times_open = time_of_day_seconds(times['open_time'])
+        self.times_close = time_of_day_seconds(times['close_time'])
+
+        prices = prices[prices['station_uuid'].astype(str).isin(index)]
+        self.price_station = index.get_indexer(prices['station_uuid'].astype(str))
+        self.price_time = to_seconds(prices['time'])
+        self.price_value = np.round(prices[fuel].to_numpy(dtype=np.float64) * PRICE_SCALE).astype(np.int64)
+        self.price_change = prices[f"{fuel}_change"].to_numpy(dtype=np.int64)
+
+    @cached_property
+    def open_hours(self) -> OpenHours:
+        if self.open_hours_column is not None:
+            return OpenHours.from_arrays(self.open_hours_column)
+        return OpenHours.from_times(self.always_open, self.times_station, self.times_days, self.times_open, self.times_close)
+
+
+#----------------------------------------------------------
+# (s1, e1) OVERLAPS (s2, e2) as postgres evaluates it (endpoints swapped if reversed, instants included)
+def overlaps(s1 : np.ndarray, e1 : np.ndarray, s2 : np.ndarray, e2 : np.ndarray) -> np.ndarray:
+    s1, e1 = np.minimum(s1, e1), np.maximum(s1, e1)
+    s2, e2 = np.minimum(s2, e2), np.maximum(s2, e2)
+    return ((s1 > s2) & ~((s1 >= e2) & (e1 >= e2))) | ((s2 > s1) & ~((s2 >= e1) & (e2 >= e1))) | (s1 == s2)
+
+
+class PriceIntervals:
+    """
+    Per-station price validity intervals (stations_prices + prices_intervals in AvgTW.sql), stored sorted by
+    station_idx * STATION_SHIFT + valid_from with a running integral of price * seconds, so that
+    the price integral of a station over any [a, b] is two searchsorted lookups.
+    Seconds are measured by clock(station, t), t itself by default (OpenHours.open_seconds_to counts only open seconds).
+    """
+    def __init__(self, inputs : TWInputs, start_t : int, end_t : int, active : np.ndarray, clock : Callable[[np.ndarray, np.ndarray], np.ndarray] | None = None):
+        changed = np.isin(inputs.price_change, [1, 3]) & active[inputs.price_station]
+        station, t, price = inputs.price_station[changed], inputs.price_time[changed], inputs.price_value[changed]
+
+        in_range = (t >= start_t) & (t <= end_t)
+        before = (t >= start_t - ACTIVE_WINDOW) & (t <= start_t)
+
+        #last event of each station before start, moved to start_t
+        order = np.lexsort((t[before], station[before]))
+        b_station, b_price = station[before][order], price[before][order]
+        is_last = np.append(b_station[1:] != b_station[:-1], True) if len(b_station) > 0 else np.zeros(0, dtype=bool)
+
+        station = np.concatenate([station[in_range], b_station[is_last]])
+        valid_from = np.concatenate([t[in_range], np.full(is_last.sum(), start_t)])
+        price = np.concatenate([price[in_range], b_price[is_last]])
+
+        order = np.lexsort((valid_from, station))
+        self.station, self.valid_from, self.price = station[order], valid_from[order], price[order]
+        self.keys = self.station * STATION_SHIFT + (self.valid_from - start_t + ACTIVE_WINDOW)
+        self.start_t, self.end_t = start_t, end_t
+
+        last_of_station = np.append(self.station[1:] != self.station[:-1], True)
+        self.valid_until = np.where(last_of_station, end_t, np.append(self.valid_from[1:], end_t))
+
+        self.clock = clock if clock is not None else lambda station, t: t
+        self.clock_from = self.clock(self.station, self.valid_from)
+        area = self.price * (self.clock(self.station, self.valid_until) - self.clock_from)
+        self.area_before = np.cumsum(area) - area  #integral from the first interval (of all stations) to valid_from
+
+        self.first_from = np.full(len(active), end_t + 1) #stations without prices never overlap
+        first_idx = np.flatnonzero(np.insert(self.station[1:] != self.station[:-1], 0, True)) if len(self.station) > 0 else np.zeros(0, dtype=np.int64)
+        self.first_from[self.station[first_idx]] = self.valid_from[first_idx]
+
+    def _integral_to(self, station : np.ndarray, x : np.ndarray) -> np.ndarray:
+        k = np.searchsorted(self.keys, station * STATION_SHIFT + (x - self.start_t + ACTIVE_WINDOW), side='right') - 1
+        return self.area_before[k] + self.price[k] * (self.clock(station, x) - self.clock_from[k])
+
+    # sum(price * duration), sum(duration) of the price intervals overlapping [a, b] (a <= b)
+    def weighted(self, station : np.ndarray, a : np.ndarray, b : np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        lo, hi = np.maximum(a, self.first_from[station]), np.minimum(b, self.end_t)
+        valid = hi > lo
+        station, lo, hi = station[valid], lo[valid], hi[valid]
+
+        price_seconds, seconds = np.zeros(len(valid), dtype=np.int64), np.zeros(len(valid), dtype=np.int64)
+        price_seconds[valid] = self._integral_to(station, hi) - self._integral_to(station, lo)
+        seconds[valid] = self.clock(station, hi) - self.clock(station, lo)
+        return price_seconds, seconds
+
+    # price integral and seconds from the first price of station to x (clipped to the prices), so that weighted(a, b)
+    # is the difference of the values at b and a: one evaluation per bucket boundary instead of two per bucket
+    def cumulative(self, station : np.ndarray, x : np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        if len(self.keys) == 0:
+            return np.zeros(len(station), dtype=np.int64), np.zeros(len(station), dtype=np.int64)
+        has_prices = self.first_from[station] <= self.end_t
+        x = np.minimum(np.maximum(x, self.first_from[station]), self.end_t)
+        clock_x = self.clock(station, x)
+        k = np.searchsorted(self.keys, station * STATION_SHIFT + (x - self.start_t + ACTIVE_WINDOW), side='right') - 1
+        price_seconds = self.area_before[k] + self.price[k] * (clock_x - self.clock_from[k])
+        return np.where(has_prices, price_seconds, 0), np.where(has_prices, clock_x, 0)
+
+    # same for a reversed interval (close before open): overlap test on the swapped endpoints,
+    # duration LEAST(b, valid_until) - GREATEST(a, valid_from) as written in the query (rare, not vectorized)
+    def weighted_reversed(self, station : int, a : int, b : int) -> tuple[int, int]:
+        idx = np.arange(*np.searchsorted(self.station, [station, station + 1]))
+        vf, vu, p = self.valid_from[idx], self.valid_until[idx], self.price[idx]
+        hit = overlaps(vf, vu, np.full(len(idx), a), np.full(len(idx), b))
+        duration = np.minimum(b, vu[hit]) - np.maximum(a, vf[hit])
+        return int((p[hit] * duration).sum()), int(duration.sum())
+
+
+#----------------------------------------------------------
+# stations with an update in the last 3 days before end_t
+def active_stations(inputs : TWInputs, end_t : int) -> np.ndarray:
+    active = np.zeros(len(inputs.station_ids), dtype=bool)
+    recent = (inputs.price_time >= end_t - ACTIVE_WINDOW) & (inputs.price_time <= end_t)
+    active[inputs.price_station[recent]] = True
+    return active
+
+
+# Time-weighted average per bucket, same result as AvgTW.sql: returns (bucket_start, avg price) in seconds / euros
+def time_weighted_average(inputs : TWInputs, start_t : int, end_t : int, granularity : int) -> tuple[np.ndarray, np.ndarray]:
+    n_buckets = (end_t - start_t) // granularity
+    bucket_start = start_t + np.arange(n_buckets, dtype=np.int64) * granularity
+
+    active = active_stations(inputs, end_t)
+    intervals = PriceIntervals(inputs, start_t, end_t, active)
+    price_seconds, seconds = np.zeros(n_buckets, dtype=np.int64), np.zeros(n_buckets, dtype=np.int64)
+
+    always_open = np.flatnonzero(active & inputs.always_open)
+    flex = active[inputs.times_station]
+    t_station, t_days, t_open, t_close = inputs.times_station[flex], inputs.times_days[flex], inputs.times_open[flex], inputs.times_close[flex]
+
+    for chunk_start in range(0, n_buckets, BUCKETS_PER_CHUNK):
+        bucket_idx = np.arange(chunk_start, min(chunk_start + BUCKETS_PER_CHUNK, n_buckets))
+        b_start = bucket_start[bucket_idx]
+        b_end = b_start + granularity
+
+        #alwaysopen_buckets: the bucket itself
+        bi, si = np.meshgrid(np.arange(len(bucket_idx)), always_open, indexing='ij')
+        bi, si = bi.ravel(), si.ravel()
+        keep = inputs.first_active[si] <= b_start[bi]
+        bi, si = bi[keep], si[keep]
+        ps, s = intervals.weighted(si, b_start[bi], b_end[bi])
+        np.add.at(price_seconds, bucket_idx[bi], ps)
+        np.add.at(seconds, bucket_idx[bi], s)
+
+        #flextime_buckets: the opening interval of the bucket's day
+        bi, ti = np.meshgrid(np.arange(len(bucket_idx)), np.arange(len(t_station)), indexing='ij')
+        bi, ti = bi.ravel(), ti.ravel()
+        day_start = (b_start // DAY) * DAY
+        day_bit = (b_start // DAY + 3) % 7 #1970-01-01 was a thursday, monday is bit 0
+
+        keep = (inputs.first_active[t_station[ti]] <= b_start[bi]) & ((t_days[ti] & (1 << day_bit[bi])) > 0)
+        bi, ti = bi[keep], ti[keep]
+        keep = overlaps(day_start[bi] + t_open[ti], day_start[bi] + t_close[ti], b_start[bi], b_end[bi])
+        bi, ti = bi[keep], ti[keep]
+
+        from_t = day_start[bi] + t_open[ti]
+        to_t = (b_end[bi] // DAY) * DAY + t_close[ti]
+        forward = from_t <= to_t
+        ps, s = intervals.weighted(t_station[ti][forward], from_t[forward], to_t[forward])
+        np.add.at(price_seconds, bucket_idx[bi[forward]], ps)
+        np.add.at(seconds, bucket_idx[bi[forward]], s)
+
+        for b, station, a, z in zip(bi[~forward], t_station[ti][~forward], from_t[~forward], to_t[~forward]):
+            ps_r, s_r = intervals.weighted_reversed(station, a, z)
+            price_seconds[bucket_idx[b]] += ps_r
+            seconds[bucket_idx[b]] += s_r
+
+    has_data = seconds != 0
+    return bucket_start[has_data], price_seconds[has_data] / seconds[has_data] / PRICE_SCALE
+
+
+# Same with the opening hours bitmap, as AvgTWOpenHours.sql: a price counts for the seconds of the bucket the station is open.
+# No split between always open and flextime stations: every active station is one price integral per bucket.
+def time_weighted_average_open_hours(inputs : TWInputs, start_t : int, end_t : int, granularity : int) -> tuple[np.ndarray, np.ndarray]:
+    n_buckets = (end_t - start_t) // granularity
+    bucket_start = start_t + np.arange(n_buckets, dtype=np.int64) * granularity
+
+    active = active_stations(inputs, end_t)
+    intervals = PriceIntervals(inputs, start_t, end_t, active, clock=inputs.open_hours.open_seconds_to)
+    price_seconds, seconds = np.zeros(n_buckets, dtype=np.int64), np.zeros(n_buckets, dtype=np.int64)
+    stations = np.flatnonzero(active)
+
+    for chunk_start in range(0, n_buckets, BUCKETS_PER_CHUNK):
+        bucket_idx = np.arange(chunk_start, min(chunk_start + BUCKETS_PER_CHUNK, n_buckets))
+        bounds = np.append(bucket_start[bucket_idx], bucket_start[bucket_idx[-1]] + granularity)
+
+        ps, s = intervals.cumulative(np.tile(stations, len(bounds)), np.repeat(bounds, len(stations)))
+        keep = inputs.first_active[stations] <= bounds[:-1, None] #(buckets, stations)
+        price_seconds[bucket_idx] = (np.diff(ps.reshape(len(bounds), -1), axis=0) * keep).sum(axis=1)
+        seconds[bucket_idx] = (np.diff(s.reshape(len(bounds), -1), axis=0) * keep).sum(axis=1)
+
+    has_data = seconds != 0
+    return bucket_start[has_data], price_seconds[has_data] / seconds[has_data] / PRICE_SCALE
+
+
+#----------------------------------------------------------
+def load_inputs_from_db(start : datetime, end : datetime, fuel : str, open_hours : bool = False) -> TWInputs:
+    stations = run_query(f"SELECT id, always_open, first_active{', open_hours' if open_hours else ''} FROM stations;")
+    times = run_query("SELECT station_id, days, open_time, close_time FROM stations_times;")
+    prices = run_query(f"""
+        SELECT station_uuid, time, {fuel}, {fuel}_change FROM prices
+        WHERE time BETWEEN '{start - timedelta(seconds=ACTIVE_WINDOW)}' AND '{end}';""")
+    return TWInputs(stations, times, prices, fuel)
+
+
+def load_inputs_from_parquet(start : datetime, end : datetime, fuel : str) -> TWInputs:
+    from parquet_cache import read_prices
+    stations = pd.read_csv(get_real_path("../../data/stations.csv"))[['uuid', 'always_open', 'first_active']].rename(columns={'uuid': 'id'})
+    times = pd.read_csv(get_real_path("../../data/stations_times.csv")).rename(columns={'uuid': 'station_id', 'open_at': 'open_time', 'close_at': 'close_time'})
+    prices = read_prices(start - timedelta(seconds=ACTIVE_WINDOW), end + timedelta(seconds=1), columns=['station_uuid', 'time', fuel, f"{fuel}_change"])
+    return TWInputs(stations, times, prices, fuel)
+
+
+# AvgTW.sql (or AvgTWOpenHours.sql) with another range, granularity and fuel
+def sql_query(start : datetime, end : datetime, granularity : int, fuel : str, query : str = QUERY) -> str:
+    return read_query(query, [
+        lambda q: re.sub(r"'[^']*'::TIMESTAMP AS start_t", f"'{start}'::TIMESTAMP AS start_t", q),
+        lambda q: re.sub(r"'[^']*'::TIMESTAMP AS end_t", f"'{end}'::TIMESTAMP AS end_t", q),
+        lambda q: re.sub(r"'[^']*'::INTERVAL AS time_granularity", f"'{granularity} seconds'::INTERVAL AS time_granularity", q),
+        replace_fuel_gen(fuel),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time-weighted average price per bucket (as AvgTW.sql) computed with numpy")
+    parser.add_argument("--start", type=str, default=DEFAULT_START, help="start_t (local time)")
+    parser.add_argument("--end", type=str, default=DEFAULT_END, help="end_t (local time)")
+    parser.add_argument("-g", "--granularity", type=int, default=DEFAULT_GRANULARITY, help="bucket size in seconds")
+    parser.add_argument("-f", "--fuel", choices=FUELS, default='diesel')
+    parser.add_argument("--source", choices=['db', 'parquet'], default='db', help="where to read stations and prices from")
+    parser.add_argument("--open-hours", action='store_true', help="weight prices by the open seconds of the opening hours bitmap (as AvgTWOpenHours.sql)")
+    parser.add_argument("--check", action='store_true', help="also run AvgTW.sql (AvgTWOpenHours.sql) and compare results and timings")
+    args = parser.parse_args()
+
+    start, end = datetime.fromisoformat(args.start), datetime.fromisoformat(args.end)
+    start_t, end_t = int(to_seconds([start])[0]), int(to_seconds([end])[0])
+
+    t = time.perf_counter()
+    inputs = load_inputs_from_db(start, end, args.fuel, args.open_hours) if args.source == 'db' else load_inputs_from_parquet(start, end, args.fuel)
+    t_load = time.perf_counter() - t
+
+    t = time.perf_counter()
+    engine = time_weighted_average_open_hours if args.open_hours else time_weighted_average
+    buckets, avg = engine(inputs, start_t, end_t, args.granularity)
+    t_engine = time.perf_counter() - t
+
+    result = pd.DataFrame({'datetime': buckets.astype('datetime64[s]'), f"avg_{args.fuel}_price": avg})
+    print(result.to_string(index=False))
+    print(f"Loaded inputs in {t_load:.2f}s, computed {len(result)} buckets in {t_engine:.3f}s")
+
+    if args.check:
+        t = time.perf_counter()
+        query = QUERY_OPEN_HOURS if args.open_hours else QUERY
+        expected = run_query(sql_query(start, end, args.granularity, args.fuel, query), use_cache=False) #timed
+        t_sql = time.perf_counter() - t
+
+        same_buckets = len(expected) == len(result) and (to_seconds(expected['datetime']) == buckets).all()
+        max_diff = np.abs(expected.iloc[:, 1].astype(float).to_numpy() - avg).max() if same_buckets and len(avg) > 0 else float('nan')
+        print(f"{os.path.basename(query)}: {len(expected)} buckets in {t_sql:.2f}s | same buckets: {same_buckets}, max difference: {max_diff}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,16 @@ WITH param AS (
     SELECT (select max(time) from prices) AS time_t, 
     (CASE WHEN EXTRACT(dow FROM time_t) = 0 THEN 6 ELSE EXTRACT(dow FROM time_t) -1 END ) as day_bit,
     52.50383 as lat, 13.3936 as lon, 30 AS dst_threshold
-    FROM prices
 ),
 close_enough_stations AS (
     SELECT s.*
     FROM param, ( 
         SELECT s.*, haversine_dst(lat, lon, s.latitude, s.longitude) as dst_km
-        FROM stations s
+        FROM param, stations s, stations_cells c
+        WHERE c.station_id = s.id -- bounding box prefilter on the grid cells (sql/stations_cells.sql)
+            AND c.cell_lat BETWEEN FLOOR((lat - dst_threshold / 111.19) * 10) AND FLOOR((lat + dst_threshold / 111.19) * 10)
+            AND c.cell_lon BETWEEN FLOOR((lon - dst_threshold / (111.19 * COS(RADIANS(ABS(lat) + dst_threshold / 111.19)))) * 10)
+                AND FLOOR((lon + dst_threshold / (111.19 * COS(RADIANS(ABS(lat) + dst_threshold / 111.19)))) * 10)
     ) as s
     WHERE dst_km <= dst_threshold
 ),
@@ -0,0 +1,60 @@
+--same as RankLocalStations.sql for all fuels at once (one row per fuel, in the fuel column): prices are read once, split the result with run_query_multi_fuel (common.py)
+WITH param AS (
+    SELECT (select max(time) from prices) AS time_t, 
+    (CASE WHEN EXTRACT(dow FROM time_t) = 0 THEN 6 ELSE EXTRACT(dow FROM time_t) -1 END ) as day_bit,
+    52.50383 as lat, 13.3936 as lon, 30 AS dst_threshold
+),
+close_enough_stations AS (
+    SELECT s.*
+    FROM param, ( 
+        SELECT s.*, haversine_dst(lat, lon, s.latitude, s.longitude) as dst_km
+        FROM param, stations s, stations_cells c
+        WHERE c.station_id = s.id -- bounding box prefilter on the grid cells (sql/stations_cells.sql)
+            AND c.cell_lat BETWEEN FLOOR((lat - dst_threshold / 111.19) * 10) AND FLOOR((lat + dst_threshold / 111.19) * 10)
+            AND c.cell_lon BETWEEN FLOOR((lon - dst_threshold / (111.19 * COS(RADIANS(ABS(lat) + dst_threshold / 111.19)))) * 10)
+                AND FLOOR((lon + dst_threshold / (111.19 * COS(RADIANS(ABS(lat) + dst_threshold / 111.19)))) * 10)
+    ) as s
+    WHERE dst_km <= dst_threshold
+),
+active_stations AS(
+    SELECT s.id as station_id, s.*
+    FROM param, close_enough_stations s 
+    WHERE first_active <= time_t AND
+    EXISTS (SELECT station_uuid from prices p where p.station_uuid = s.id AND time BETWEEN time_t - INTERVAL '3 day' AND time_t)-- avoid inactive stations
+), 
+alwaysopen AS(
+    SELECT s.* FROM active_stations s WHERE s.always_open 
+),
+flextime AS(
+    SELECT s.*
+    FROM param, stations_times st, active_stations s
+    WHERE st.station_id = s.station_id
+        AND (days & (1 << (day_bit))) > 0 -- open day?
+        AND time_t BETWEEN time_t::date + open_time AND time_t::date + close_time -- opening hours?
+),
+open_stations AS (
+    SELECT * FROM alwaysopen UNION ALL SELECT * FROM flextime
+),
+fuel_prices AS ( --every price change of the last 3 days, one row per fuel
+    SELECT station_uuid, time, fuel, price
+    FROM param, prices, LATERAL (VALUES ('diesel', diesel, diesel_change), ('e5', e5, e5_change), ('e10', e10, e10_change)) AS f(fuel, price, price_change)
+    WHERE time <= time_t AND time >= time_t - INTERVAL '3 day'
+    AND price_change IN (1, 3)
+),
+curr_prices AS (
+    SELECT open_stations.*, p.fuel, p.price, p.time
+    FROM open_stations, (
+            SELECT station_uuid, fuel, price, time, ROW_NUMBER() OVER (PARTITION BY station_uuid, fuel ORDER BY time DESC) AS rn
+            FROM fuel_prices
+        ) p
+    WHERE p.station_uuid = open_stations.station_id AND rn = 1
+),
+rankings AS (
+    SELECT s.*,  RANK() OVER (PARTITION BY fuel ORDER BY total_cost ASC) AS position
+    FROM (
+        SELECT pr.*, (price * 40) + (dst_km * ((7/100)*price)) as total_cost
+        FROM curr_prices pr
+        ) as s
+)
+SELECT fuel, station_id, brand, latitude, longitude, price, dst_km, total_cost, position
+FROM rankings;
\ No newline at end of file
@@ -0,0 +1,51 @@
+--same as RankLocalStations.sql, reading the latest prices and updates from current_prices
+WITH param AS (
+    SELECT (select max(last_update) from current_prices) AS time_t, 
+    (CASE WHEN EXTRACT(dow FROM time_t) = 0 THEN 6 ELSE EXTRACT(dow FROM time_t) -1 END ) as day_bit,
+    52.50383 as lat, 13.3936 as lon, 30 AS dst_threshold
+),
+close_enough_stations AS (
+    SELECT s.*
+    FROM param, ( 
+        SELECT s.*, haversine_dst(lat, lon, s.latitude, s.longitude) as dst_km
+        FROM param, stations s, stations_cells c
+        WHERE c.station_id = s.id -- bounding box prefilter on the grid cells (sql/stations_cells.sql)
+            AND c.cell_lat BETWEEN FLOOR((lat - dst_threshold / 111.19) * 10) AND FLOOR((lat + dst_threshold / 111.19) * 10)
+            AND c.cell_lon BETWEEN FLOOR((lon - dst_threshold / (111.19 * COS(RADIANS(ABS(lat) + dst_threshold / 111.19)))) * 10)
+                AND FLOOR((lon + dst_threshold / (111.19 * COS(RADIANS(ABS(lat) + dst_threshold / 111.19)))) * 10)
+    ) as s
+    WHERE dst_km <= dst_threshold
+),
+active_stations AS(
+    SELECT s.id as station_id, s.*, cp.diesel as price, cp.diesel_time as time
+    FROM param, close_enough_stations s, current_prices cp
+    WHERE cp.station_id = s.id AND first_active <= time_t
+    AND last_update >= time_t - INTERVAL '3 day' -- avoid inactive stations
+), 
+alwaysopen AS(
+    SELECT s.* FROM active_stations s WHERE s.always_open 
+),
+flextime AS(
+    SELECT s.*
+    FROM param, stations_times st, active_stations s
+    WHERE st.station_id = s.station_id
+        AND (days & (1 << (day_bit))) > 0 -- open day?
+        AND time_t BETWEEN time_t::date + open_time AND time_t::date + close_time -- opening hours?
+),
+open_stations AS (
+    SELECT * FROM alwaysopen UNION ALL SELECT * FROM flextime
+),
+curr_prices AS (
+    SELECT open_stations.*
+    FROM open_stations, param
+    WHERE time >= time_t - INTERVAL '3 day'
+),
+rankings AS (
+    SELECT s.*,  RANK() OVER (ORDER BY total_cost ASC) AS position
+    FROM (
+        SELECT pr.*, (price * 40) + (dst_km * ((7/100)*price)) as total_cost
+        FROM curr_prices pr
+        ) as s
+)
+SELECT station_id, brand, latitude, longitude, price, dst_km, total_cost, position
+FROM rankings;
\ No newline at end of file
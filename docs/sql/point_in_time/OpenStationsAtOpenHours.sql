@@ -0,0 +1,18 @@
+--same as OpenStationsAt.sql with the opening hours bitmap of stations (sql/open_hours.sql) instead of joining stations_times
+--(minute resolution: a station closing at 20:00 is closed at 20:00, always open stations have every bit set)
+WITH param AS (
+    SELECT '2024-01-31 17:00'::TIMESTAMP AS time_t,
+),
+active_stations AS(
+    SELECT s.id as station_id, s.*
+    FROM param, stations s 
+    WHERE first_active <= time_t AND
+    EXISTS (SELECT station_uuid from prices p where p.station_uuid = s.id AND time BETWEEN time_t - INTERVAL '3 day' AND time_t)-- avoid inactive stations
+), 
+open_stations AS (
+    SELECT s.* FROM param, active_stations s WHERE is_open_at(open_hours, time_t) -- one bit of open_hours
+)
+SELECT
+    (select count(station_id) from open_stations where not always_open) as n_flextime,
+    (select count(station_id) from open_stations where always_open) as n_alwaysopen,
+    n_flextime + n_alwaysopen as n_open_stations;
@@ -0,0 +1,31 @@
+--same as OpenStationsAt.sql at the latest update (now), reading the latest updates from current_prices
+WITH param AS (
+    SELECT (select max(last_update) from current_prices) AS time_t, 
+        (CASE WHEN EXTRACT(dow FROM time_t) = 0 THEN 6 ELSE EXTRACT(dow FROM time_t) -1 END ) as day_bit,
+),
+active_stations AS(
+    SELECT s.id as station_id, s.*
+    FROM param, stations s, current_prices cp
+    WHERE cp.station_id = s.id AND first_active <= time_t
+    AND last_update >= time_t - INTERVAL '3 day' -- avoid inactive stations
+), 
+alwaysopen AS(
+    SELECT s.* FROM active_stations s WHERE s.always_open 
+),
+flextime AS(
+    SELECT s.*
+    FROM param, stations_times st, active_stations s
+    WHERE st.station_id = s.station_id
+        AND (days & (1 << (day_bit))) > 0 -- open day?
+        AND time_t BETWEEN time_t::date + open_time AND time_t::date + close_time -- opening hours?
+),
+open_stations AS (
+    SELECT * FROM alwaysopen UNION ALL SELECT * FROM flextime
+)
+SELECT
+    (select count(station_id) from flextime) as n_flextime,
+    (select count(station_id) from alwaysopen) as n_alwaysopen,
+    n_flextime + n_alwaysopen as n_open_stations;
+
+-- SELECT count(station_id) as n_open_stations FROM open_stations;
+
@@ -0,0 +1,47 @@
+--same as PriceAt.sql for all fuels at once (one row per fuel, in the fuel column): prices are read once, split the result with run_query_multi_fuel (common.py)
+WITH param AS (
+    SELECT '2024-01-31 17:00'::TIMESTAMP AS time_t, 
+        (CASE WHEN EXTRACT(dow FROM time_t) = 0 THEN 6 ELSE EXTRACT(dow FROM time_t) -1 END ) as day_bit,
+),
+active_stations AS(
+    SELECT s.id as station_id, s.*
+    FROM param, stations s 
+    WHERE first_active <= time_t AND
+    EXISTS (SELECT station_uuid from prices p where p.station_uuid = s.id AND time BETWEEN time_t - INTERVAL '3 day' AND time_t)-- avoid inactive stations
+), 
+alwaysopen AS(
+    SELECT s.* FROM active_stations s WHERE s.always_open 
+),
+flextime AS(
+    SELECT s.*
+    FROM param, stations_times st, active_stations s
+    WHERE st.station_id = s.station_id
+        AND (days & (1 << (day_bit))) > 0 -- open day?
+        AND time_t BETWEEN time_t::date + open_time AND time_t::date + close_time -- opening hours?
+),
+open_stations AS (
+    SELECT * FROM alwaysopen UNION ALL SELECT * FROM flextime
+),
+fuel_prices AS ( --every price change of the last 3 days, one row per fuel
+    SELECT station_uuid, time, fuel, price
+    FROM param, prices, LATERAL (VALUES ('diesel', diesel, diesel_change), ('e5', e5, e5_change), ('e10', e10, e10_change)) AS f(fuel, price, price_change)
+    WHERE time <= time_t AND time >= time_t - INTERVAL '3 day'
+    AND price_change IN (1, 3)
+),
+curr_prices AS (
+    SELECT open_stations.*, p.fuel, p.price, p.time
+    FROM open_stations, (
+            SELECT station_uuid, fuel, price, time, ROW_NUMBER() OVER (PARTITION BY station_uuid, fuel ORDER BY time DESC) AS rn
+            FROM fuel_prices
+        ) p
+    WHERE p.station_uuid = open_stations.station_id AND rn = 1
+),
+stats AS (
+    SELECT fuel, AVG(price) AS avg_price, STDDEV(price) AS std_dev_price FROM curr_prices GROUP BY fuel
+),
+prices_scores AS (
+    SELECT p.*, (p.price - avg_price) / std_dev_price AS z_score
+    FROM curr_prices p,stats
+    WHERE p.fuel = stats.fuel
+)
+select fuel, station_id, brand, city, latitude, longitude, price, z_score from prices_scores;
@@ -0,0 +1,42 @@
+--same as PriceAt.sql at the latest update (now), reading the latest prices and updates from current_prices
+WITH param AS (
+    SELECT (select max(last_update) from current_prices) AS time_t, 
+        (CASE WHEN EXTRACT(dow FROM time_t) = 0 THEN 6 ELSE EXTRACT(dow FROM time_t) -1 END ) as day_bit,
+),
+active_stations AS(
+    SELECT s.id as station_id, s.*, cp.diesel as price, cp.diesel_time as time
+    FROM param, stations s, current_prices cp
+    WHERE cp.station_id = s.id AND first_active <= time_t
+    AND last_update >= time_t - INTERVAL '3 day' -- avoid inactive stations
+), 
+alwaysopen AS(
+    SELECT s.* FROM active_stations s WHERE s.always_open 
+),
+flextime AS(
+    SELECT s.*
+    FROM param, stations_times st, active_stations s
+    WHERE st.station_id = s.station_id
+        AND (days & (1 << (day_bit))) > 0 -- open day?
+        AND time_t BETWEEN time_t::date + open_time AND time_t::date + close_time -- opening hours?
+),
+open_stations AS (
+    SELECT * FROM alwaysopen UNION ALL SELECT * FROM flextime
+),
+curr_prices AS (
+    SELECT open_stations.*
+    FROM open_stations, param
+    WHERE time >= time_t - INTERVAL '3 day'
+),
+stats AS (
+    SELECT AVG(price) AS avg_price, STDDEV(price) AS std_dev_price FROM curr_prices
+),
+prices_scores AS (
+    SELECT p.*, (p.price - avg_price) / std_dev_price AS z_score
+    FROM curr_prices p,stats
+)
+select station_id, brand, city, latitude, longitude, price, z_score from prices_scores;
+
+
+
+
+
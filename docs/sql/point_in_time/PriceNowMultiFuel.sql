@@ -0,0 +1,38 @@
+--same as PriceNow.sql for all fuels at once (one row per fuel, in the fuel column), split the result with run_query_multi_fuel (common.py)
+WITH param AS (
+    SELECT (select max(last_update) from current_prices) AS time_t, 
+        (CASE WHEN EXTRACT(dow FROM time_t) = 0 THEN 6 ELSE EXTRACT(dow FROM time_t) -1 END ) as day_bit,
+),
+active_stations AS(
+    SELECT s.id as station_id, s.*, f.fuel, f.price, f.time
+    FROM param, stations s, current_prices cp, LATERAL (VALUES ('diesel', cp.diesel, cp.diesel_time), ('e5', cp.e5, cp.e5_time), ('e10', cp.e10, cp.e10_time)) AS f(fuel, price, time)
+    WHERE cp.station_id = s.id AND first_active <= time_t
+    AND last_update >= time_t - INTERVAL '3 day' -- avoid inactive stations
+), 
+alwaysopen AS(
+    SELECT s.* FROM active_stations s WHERE s.always_open 
+),
+flextime AS(
+    SELECT s.*
+    FROM param, stations_times st, active_stations s
+    WHERE st.station_id = s.station_id
+        AND (days & (1 << (day_bit))) > 0 -- open day?
+        AND time_t BETWEEN time_t::date + open_time AND time_t::date + close_time -- opening hours?
+),
+open_stations AS (
+    SELECT * FROM alwaysopen UNION ALL SELECT * FROM flextime
+),
+curr_prices AS (
+    SELECT open_stations.*
+    FROM open_stations, param
+    WHERE time >= time_t - INTERVAL '3 day'
+),
+stats AS (
+    SELECT fuel, AVG(price) AS avg_price, STDDEV(price) AS std_dev_price FROM curr_prices GROUP BY fuel
+),
+prices_scores AS (
+    SELECT p.*, (p.price - avg_price) / std_dev_price AS z_score
+    FROM curr_prices p,stats
+    WHERE p.fuel = stats.fuel
+)
+select fuel, station_id, brand, city, latitude, longitude, price, z_score from prices_scores;
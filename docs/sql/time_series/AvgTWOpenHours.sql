@@ -0,0 +1,61 @@
+--same as AvgTW.sql with the opening hours bitmap of stations (sql/open_hours.sql) instead of joining stations_times:
+--a price counts for the seconds of the bucket the station is open (minute resolution), always open stations included
+WITH param AS (
+    SELECT
+    '2024-01-08T00:00:00Z'::TIMESTAMP AS start_t,
+    '2024-01-21T23:59:59Z'::TIMESTAMP AS end_t,
+    '1 hour'::INTERVAL AS time_granularity,
+     EXTRACT(EPOCH FROM time_granularity) AS interval_seconds,
+),
+time_series AS (
+    SELECT  start_t + (((i-1) * interval_seconds) * INTERVAL '1 second') AS bucket_start, 
+            bucket_start + (interval_seconds * INTERVAL '1 second') as bucket_end,
+    FROM param, generate_series(1 , (EXTRACT(EPOCH FROM (end_t - start_t)) / interval_seconds)) AS i
+),
+bucket_hours AS ( -- the hours every bucket covers, clipped to the bucket
+    SELECT bucket_start, hour_start, GREATEST(bucket_start, hour_start) AS from_t, LEAST(bucket_end, hour_start + INTERVAL '1 hour') AS to_t,
+        ((CASE WHEN EXTRACT(dow FROM hour_start) = 0 THEN 6 ELSE EXTRACT(dow FROM hour_start) -1 END) * 24 + EXTRACT(hour FROM hour_start) + 1)::int AS hour_idx,
+    FROM param, time_series, generate_series(0, CEIL(interval_seconds / 3600)::int) AS h, LATERAL (SELECT date_trunc('hour', bucket_start) + h * INTERVAL '1 hour' AS hour_start) hs
+    WHERE hour_start < bucket_end
+),
+active_stations AS(
+    SELECT s.id as station_id, city, brand, first_active, open_hours
+    FROM stations s, param
+    WHERE EXISTS (SELECT station_uuid from prices p where p.station_uuid = s.id AND p.time BETWEEN end_t - INTERVAL '3 day' AND end_t)-- avoid inactive stations
+),
+stations_time_series AS (
+    SELECT bh.*, s.station_id, open_hours[hour_idx] AS bits
+    FROM bucket_hours bh, active_stations s
+    WHERE first_active <= bucket_start AND open_hours[hour_idx] <> 0 -- open in that hour?
+),
+stations_prices AS (
+   SELECT time as valid_from, diesel as price, s.station_id
+    FROM param, prices p, active_stations s
+    WHERE s.station_id = p.station_uuid
+    AND diesel_change IN (1,3) AND time BETWEEN param.start_t AND param.end_t
+
+    UNION ALL
+
+    SELECT  param.start_t AS valid_from, price, s.station_id --add last event before start
+    FROM param, active_stations s, (
+        SELECT time as valid_from, diesel as price
+        FROM prices pp, param
+        WHERE s.station_id = pp.station_uuid AND diesel_change IN (1,3)
+        AND time <= start_t AND time >= start_t - '3 day'::INTERVAL 
+        ORDER BY time DESC LIMIT 1
+    ) p
+), 
+prices_intervals AS (
+    SELECT LEAD(valid_from, 1, param.end_t) OVER (PARTITION BY station_id ORDER BY valid_from) AS valid_until, sp.*
+    FROM stations_prices sp, param
+),
+prices_time_series AS (
+    SELECT bucket_start, price, open_seconds(bits,
+            EXTRACT(EPOCH FROM (GREATEST(from_t, valid_from) - hour_start))::bigint,
+            EXTRACT(EPOCH FROM (LEAST(to_t, valid_until) - hour_start))::bigint) as duration_seconds
+    FROM stations_time_series ts, prices_intervals p_int
+    WHERE ts.station_id = p_int.station_id AND valid_from < to_t AND valid_until > from_t
+)
+SELECT bucket_start as datetime, SUM(price * duration_seconds) / SUM(duration_seconds) as avg_diesel_price,
+FROM prices_time_series
+GROUP BY datetime HAVING SUM(duration_seconds) > 0 ORDER BY datetime;
@@ -0,0 +1,34 @@
+--same as AvgTW.sql but reading the hourly rollup (prices_hourly) instead of prices
+--buckets are made of whole hours (granularity of at least 1 hour), a station counts for a whole hour if it is open at some point during it
+WITH param AS (
+    SELECT
+    '2024-01-08T00:00:00Z'::TIMESTAMP AS start_t,
+    '2024-01-21T23:59:59Z'::TIMESTAMP AS end_t,
+    '1 hour'::INTERVAL AS time_granularity,
+    GREATEST(EXTRACT(EPOCH FROM time_granularity), 3600) AS interval_seconds,
+),
+active_stations AS(
+    SELECT s.id as station_id, always_open, first_active
+    FROM stations s, param
+    WHERE EXISTS (SELECT station_id FROM prices_hourly h WHERE h.station_id = s.id AND h.n_updates > 0 AND h.hour BETWEEN end_t - INTERVAL '3 day' AND end_t)-- avoid inactive stations
+),
+hours AS (
+    SELECT h.*,
+        start_t + (FLOOR(EXTRACT(EPOCH FROM (hour - start_t)) / interval_seconds) * interval_seconds * INTERVAL '1 second') AS bucket_start,
+        (CASE WHEN EXTRACT(dow FROM hour) = 0 THEN 6 ELSE EXTRACT(dow FROM hour) -1 END ) as day_bit,
+    FROM param, prices_hourly h
+    WHERE hour >= start_t AND hour + INTERVAL '1 hour' <= end_t + INTERVAL '1 second' -- complete hours only
+),
+open_hours AS (
+    SELECT h.*
+    FROM hours h, active_stations s
+    WHERE h.station_id = s.station_id AND first_active <= hour AND (always_open OR EXISTS (
+        SELECT station_id FROM stations_times st
+        WHERE st.station_id = h.station_id
+            AND (days & (1 << (day_bit))) > 0 -- open day?
+            AND (hour::date + open_time, hour::date + close_time) OVERLAPS (hour, hour + INTERVAL '1 hour') -- opening hours?
+    ))
+)
+SELECT bucket_start as datetime, SUM(diesel_sum) / SUM(diesel_seconds) as avg_diesel_price,
+FROM open_hours
+GROUP BY datetime ORDER BY datetime;
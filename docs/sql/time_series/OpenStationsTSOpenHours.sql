@@ -0,0 +1,34 @@
+--same as OpenStationsTS.sql with the opening hours bitmap of stations (sql/open_hours.sql) instead of joining stations_times:
+--a station is open in a bucket if it is open for some seconds of it (minute resolution)
+WITH param AS (
+    SELECT
+    '2024-01-08T00:00:00Z'::TIMESTAMP AS start_t,
+    '2024-01-14T23:59:59Z'::TIMESTAMP AS end_t,
+    '1 hour'::INTERVAL AS time_granularity,
+     EXTRACT(EPOCH FROM time_granularity) AS interval_seconds,
+),
+time_series AS (
+    SELECT  start_t + (((i-1) * interval_seconds) * INTERVAL '1 second') AS bucket_start, 
+            bucket_start + (interval_seconds * INTERVAL '1 second') as bucket_end,
+    FROM param, generate_series(1 , (EXTRACT(EPOCH FROM (end_t - start_t)) / interval_seconds)) AS i
+),
+bucket_hours AS ( -- the hours every bucket covers, clipped to the bucket
+    SELECT bucket_start, hour_start, GREATEST(bucket_start, hour_start) AS from_t, LEAST(bucket_end, hour_start + INTERVAL '1 hour') AS to_t,
+        ((CASE WHEN EXTRACT(dow FROM hour_start) = 0 THEN 6 ELSE EXTRACT(dow FROM hour_start) -1 END) * 24 + EXTRACT(hour FROM hour_start) + 1)::int AS hour_idx,
+    FROM param, time_series, generate_series(0, CEIL(interval_seconds / 3600)::int) AS h, LATERAL (SELECT date_trunc('hour', bucket_start) + h * INTERVAL '1 hour' AS hour_start) hs
+    WHERE hour_start < bucket_end
+),
+active_stations AS(
+    SELECT s.id as station_id, first_active, open_hours
+    FROM stations s, param
+    WHERE EXISTS (SELECT station_uuid from prices p where p.station_uuid = s.id AND p.time BETWEEN end_t - INTERVAL '3 day' AND end_t)-- avoid inactive stations
+),
+stations_time_series AS (
+    SELECT bucket_start, station_id
+    FROM bucket_hours bh, active_stations s
+    WHERE first_active <= bucket_start AND open_hours[hour_idx] <> 0
+        AND open_seconds(open_hours[hour_idx], EXTRACT(EPOCH FROM (from_t - hour_start))::bigint, EXTRACT(EPOCH FROM (to_t - hour_start))::bigint) > 0
+)
+SELECT bucket_start as datetime, COUNT(distinct station_id) as n_open_stations 
+FROM stations_time_series
+GROUP BY bucket_start ORDER BY bucket_start;
@@ -0,0 +1,296 @@
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import threading
+from datetime import datetime, timezone
+from typing import Iterator
+import psycopg as pg
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "replay"))
+from load_prices import get_conn_str, get_real_path
+from bench_queries import DASHBOARDS_FOLDER, GRANULARITIES, dashboard_variables, execute, has_custom_granularity, load_dashboards, panel_targets, parse_duration, percentile, render_grafana_query
+from prices_reader import PriceBatch
+from resume_index import list_price_files
+from metrics import ReplayMetrics, serve_metrics, METRICS_PATH
+from scheduler import DEFAULT_MAX_LAG, DEFAULT_POLICY, DEFAULT_PROGRESS_INTERVAL, POLICIES, ReplayScheduler, parse_speed
+from replay import DEFAULT_WORKERS, DEFAULT_INSERT_MODE, INSERT_MODES, ReplayWriter, batches_after, latest_time
+
+
+DEFAULT_PRICES_FOLDER = "../data/prices"
+DEFAULT_SPEEDS = ['off', '10', '100', 'max'] #off: readers only
+DEFAULT_READERS = [0, 1, 4, 16]
+DEFAULT_STEP_SECONDS = 60
+DEFAULT_REFRESH = '5s' #dashboards without auto refresh
+DEFAULT_GRANULARITY = 'hour'
+DEFAULT_FUEL = 'diesel'
+DEFAULT_TIMEOUT = 60 #seconds per statement
+DEFAULT_OUTPUT = "bench_htap.json"
+PREFETCH = 1 #batches read ahead by the writer, inserted after the end of a step
+
+
+#----------------------------------------------------------
+def parse_step_speed(speed : str) -> str:
+    if speed != 'off':
+        parse_speed(speed)
+    return speed
+
+
+def latencies_ms(values : list[float]) -> dict:
+    if len(values) == 0:
+        return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None}
+    values = sorted(values)
+    return {f'p{p}_ms': round(percentile(values, p / 100), 3) for p in (50, 95, 99)}
+
+
+def ms_str(value : float | None) -> str:
+    return "-" if value is None else f"{value:.1f}"
+
+
+# time range of the dashboard: now-2d, now or absolute times as grafana saves them
+def time_range(dashboard : dict) -> tuple[datetime, datetime]:
+    now = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+
+    def parse(t : str) -> datetime:
+        if t == 'now':
+            return now
+        if t.startswith('now-'):
+            return now - parse_duration(t[len('now-'):])
+        return datetime.fromisoformat(t.rstrip('Z'))
+
+    t = dashboard.get('time', {})
+    return parse(t.get('from', 'now-1d')), parse(t.get('to', 'now'))
+
+
+# batches until the monotonic clock reaches deadline, the rest is left in batches for the next step
+def until(batches : Iterator[PriceBatch], deadline : float) -> Iterator[PriceBatch]:
+    while time.monotonic() < deadline:
+        batch = next(batches, None)
+        if batch is None:
+            return
+        yield batch
+
+
+#----------------------------------------------------------
+class ReadStats:
+    """Latencies of the panel queries and of whole refreshes of the dashboard users during a step"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queries : list[float] = [] #ms
+        self.refreshes : list[float] = [] #ms, variables and every panel
+        self.late, self.errors = 0, 0
+
+    def add_query(self, ms : float):
+        with self.lock:
+            self.queries.append(ms)
+
+    def add_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def add_refresh(self, ms : float, late : bool):
+        with self.lock:
+            self.refreshes.append(ms)
+            self.late += late
+
+
+class DashboardUser:
+    """
+    A user with a dashboard open: every refresh seconds the query variables are refreshed (the time range moved,
+    e.g. now_t and time_diff of the real-time dashboards follow the replay) and every panel query runs, one after the other.
+    A refresh taking longer than the interval is late, the next one starts right away.
+    """
+    def __init__(self, dashboard : dict, targets : list[tuple[str, str]], refresh : float, offset : float, fuel : str, granularity : str,
+                 conn_str : str, timeout : int, stats : ReadStats, stop : threading.Event):
+        self.dashboard, self.targets, self.refresh, self.offset = dashboard, targets, refresh, offset
+        self.fuel, self.granularity, self.conn_str, self.timeout = fuel, granularity, conn_str, timeout
+        self.stats, self.stop = stats, stop
+        self.custom_granularity = has_custom_granularity(dashboard)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        with pg.connect(self.conn_str, autocommit=True, prepare_threshold=None) as conn:
+            conn.execute(f"SET statement_timeout = '{self.timeout}s';")
+            next_refresh = time.monotonic() + self.offset
+            while not self.stop.wait(max(0.0, next_refresh - time.monotonic())):
+                start = time.perf_counter()
+                variables = dashboard_variables(self.dashboard, conn)
+                from_t, to_t = time_range(self.dashboard)
+                for _, sql in self.targets:
+                    query_start = time.perf_counter()
+                    try:
+                        execute(conn, render_grafana_query(sql, variables, from_t, to_t, self.granularity, self.fuel, self.custom_granularity))
+                        self.stats.add_query((time.perf_counter() - query_start) * 1000)
+                    except pg.Error:
+                        self.stats.add_error()
+
+                next_refresh += self.refresh
+                late = time.monotonic() > next_refresh
+                if late:
+                    next_refresh = time.monotonic()
+                self.stats.add_refresh((time.perf_counter() - start) * 1000, late)
+
+    def start(self):
+        self.thread.start()
+
+    def join(self):
+        self.thread.join()
+
+
+#----------------------------------------------------------
+# one step: n_readers users (spread over the dashboards, their refreshes staggered) while the writer replays at speed for seconds
+def run_step(writer : ReplayWriter | None, batches : Iterator[PriceBatch], speed : str, n_readers : int, seconds : float,
+             dashboards : list[tuple[dict, list[tuple[str, str]], float]], args : argparse.Namespace, metrics : ReplayMetrics | None) -> dict:
+    reads, stop = ReadStats(), threading.Event()
+    users = []
+    for i in range(n_readers):
+        dashboard, targets, refresh = dashboards[i % len(dashboards)]
+        users.append(DashboardUser(dashboard, targets, refresh, refresh * i / n_readers, args.fuel, args.granularity,
+                                   get_conn_str(args.compact), args.timeout, reads, stop))
+    for user in users:
+        user.start()
+
+    inserts : list[float] = []
+    def insert(group : list[PriceBatch]):
+        start = time.perf_counter()
+        writer.insert(group)  # type: ignore
+        inserts.append((time.perf_counter() - start) * 1000)
+
+    start = time.monotonic()
+    result : dict = {'speed': speed, 'readers': n_readers}
+    if writer is None or speed == 'off':
+        time.sleep(seconds)
+        result.update({'write_rows': 0, 'write_rows_s': 0.0, 'target_rows_s': None, 'inserts': 0, 'max_lag_s': 0.0, 'dropped_rows': 0})
+    else:
+        scheduler = ReplayScheduler(insert, parse_speed(speed), args.policy, args.max_lag, DEFAULT_PROGRESS_INTERVAL, metrics, prefetch=PREFETCH)
+        stats = scheduler.run(until(batches, start + seconds))
+        target = stats.rows / (stats.virtual_seconds / float(speed)) if speed != 'max' and stats.virtual_seconds > 0 else None
+        result.update({'write_rows': stats.rows, 'write_rows_s': round(stats.rows / stats.real_seconds, 1) if stats.real_seconds > 0 else 0.0,
+                       'target_rows_s': None if target is None else round(target, 1), 'inserts': stats.inserts,
+                       'max_lag_s': round(stats.max_lag, 3), 'dropped_rows': stats.dropped_rows, 'last_time': stats.last_time})
+        if stats.batches == 0:
+            print("No prices left to replay, the writer is idle")
+
+    stop.set()
+    for user in users:
+        user.join()
+
+    result['seconds'] = round(time.monotonic() - start, 1)
+    result.update({f'insert_{k}': v for k, v in latencies_ms(inserts).items()})
+    result.update({'reads': len(reads.queries), 'read_errors': reads.errors, 'refreshes': len(reads.refreshes), 'late_refreshes': reads.late})
+    result.update({f'read_{k}': v for k, v in latencies_ms(reads.queries).items()})
+    result.update({f'refresh_{k}': v for k, v in latencies_ms(reads.refreshes).items()})
+    return result
+
+
+def print_summary(results : list[dict]):
+    print("\nRead latency by write throughput (panel queries)")
+    print(f"{'readers':>8} {'speed':>6} {'rows/s':>10} {'read p50':>10} {'p95':>10} {'p99':>10} {'late':>6} {'errors':>6}")
+    for n_readers in sorted({r['readers'] for r in results if r['readers'] > 0}):
+        for r in sorted((r for r in results if r['readers'] == n_readers), key=lambda r: r['write_rows_s']):
+            print(f"{n_readers:>8} {r['speed']:>6} {r['write_rows_s']:>10.1f} {ms_str(r['read_p50_ms']):>10} {ms_str(r['read_p95_ms']):>10} "
+                  f"{ms_str(r['read_p99_ms']):>10} {r['late_refreshes']:>6} {r['read_errors']:>6}")
+
+    print("\nWrite throughput by readers")
+    print(f"{'speed':>6} {'readers':>8} {'rows/s':>10} {'target':>10} {'insert p50':>11} {'p95':>10} {'max lag':>8} {'dropped':>8}")
+    for speed in dict.fromkeys(r['speed'] for r in results if r['speed'] != 'off'):
+        for r in sorted((r for r in results if r['speed'] == speed), key=lambda r: r['readers']):
+            print(f"{speed:>6} {r['readers']:>8} {r['write_rows_s']:>10.1f} {ms_str(r['target_rows_s']):>10} {ms_str(r['insert_p50_ms']):>11} "
+                  f"{ms_str(r['insert_p95_ms']):>10} {r['max_lag_s']:>7.2f}s {r['dropped_rows']:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays the prices while simulated users refresh the grafana dashboards, for every speed and number of users: read latency against write throughput, write throughput against readers")
+    parser.add_argument('-p', '--price-folder', type=str, help="folder of the prices to replay", default=get_real_path(DEFAULT_PRICES_FOLDER))
+    parser.add_argument('-s', '--speeds', type=parse_step_speed, nargs='+', help="replay speeds to run (off: no writer, max: as fast as possible)", default=DEFAULT_SPEEDS)
+    parser.add_argument('-u', '--readers', type=int, nargs='+', help="numbers of simulated dashboard users to run", default=DEFAULT_READERS)
+    parser.add_argument('-d', '--duration', type=int, help="seconds of every step", default=DEFAULT_STEP_SECONDS)
+    parser.add_argument('--dashboard', type=str, nargs='*', help="dashboards whose title contains any of these (default: the ones with auto refresh)", default=None)
+    parser.add_argument('--refresh', type=str, help=f"refresh interval of every dashboard (default: their own, {DEFAULT_REFRESH} without)", default=None)
+    parser.add_argument('-g', '--granularity', choices=list(GRANULARITIES), help="$time_granularity of the panels", default=DEFAULT_GRANULARITY)
+    parser.add_argument('-f', '--fuel', choices=['diesel', 'e5', 'e10'], help="$fuel of the panels", default=DEFAULT_FUEL)
+    parser.add_argument('-t', '--timeout', type=int, help="statement timeout of the readers in seconds", default=DEFAULT_TIMEOUT)
+    parser.add_argument('--policy', choices=POLICIES, help="what the writer does when more than --max-lag seconds behind", default=DEFAULT_POLICY)
+    parser.add_argument('--max-lag', type=float, help="seconds behind schedule tolerated before applying --policy", default=DEFAULT_MAX_LAG)
+    parser.add_argument('-w', '--workers', type=int, help="connections inserting concurrently", default=DEFAULT_WORKERS)
+    parser.add_argument('-i', '--insert-mode', choices=INSERT_MODES, help="how each batch is sent to the db", default=DEFAULT_INSERT_MODE)
+    parser.add_argument('-r', '--rollup', action='store_true', help="keep the hourly rollup up to date while replaying")
+    parser.add_argument('--no-current-prices', action='store_true', help="do not upsert current_prices with each insert")
+    parser.add_argument('-k', '--compact', action='store_true', help="write and read the compact layout (sql/compact_schema.sql)")
+    parser.add_argument('-m', '--metrics-port', type=int, help=f"serve the replay metrics on http://localhost:PORT{METRICS_PATH}", default=None)
+    parser.add_argument('-o', '--output', type=str, help="JSON file with the results of every step", default=DEFAULT_OUTPUT)
+    args = parser.parse_args()
+
+    selected = []
+    for file, dashboard in load_dashboards(get_real_path(DASHBOARDS_FOLDER)).items():
+        if (args.dashboard is None and dashboard.get('refresh')) or (args.dashboard is not None and any(d in dashboard['title'] for d in args.dashboard)):
+            selected.append(dashboard)
+    if len(selected) == 0:
+        print("No dashboard selected")
+        exit(1)
+
+    #panels grafana could not run here (unsupported macros) are left out
+    dashboards = []
+    with pg.connect(get_conn_str(args.compact), autocommit=True) as conn:
+        for dashboard in selected:
+            variables, (from_t, to_t) = dashboard_variables(dashboard, conn), time_range(dashboard)
+            targets = []
+            for name, sql in panel_targets(dashboard):
+                try:
+                    render_grafana_query(sql, variables, from_t, to_t, args.granularity, args.fuel, has_custom_granularity(dashboard))
+                    targets.append((name, sql))
+                except ValueError as e:
+                    print(f"Skipping {name}: {e}")
+            refresh = parse_duration(args.refresh or dashboard.get('refresh') or DEFAULT_REFRESH).total_seconds()
+            dashboards.append((dashboard, targets, refresh))
+            print(f"{dashboard['title']}: {len(targets)} panel queries every {refresh:.0f}s")
+
+    metrics = None
+    if args.metrics_port is not None:
+        metrics = ReplayMetrics()
+        serve_metrics(metrics, args.metrics_port)
+        print(f"Serving metrics on http://localhost:{args.metrics_port}{METRICS_PATH}")
+
+    latest = latest_time(args.compact)
+    files = list_price_files(args.price_folder, latest.strftime("%Y-%m-%d") if latest is not None else "")
+    writes = any(speed != 'off' for speed in args.speeds)
+    if writes and len(files) == 0:
+        print(f"0 files found in {args.price_folder}")
+        exit(1)
+
+    batches : Iterator[PriceBatch] = iter([])
+    if writes:
+        start_time = latest if latest is not None else datetime.strptime(os.path.basename(files[0]).split("-prices.csv")[0], "%Y-%m-%d")
+        batches = batches_after(files, start_time.replace(tzinfo=timezone.utc).timestamp())
+        first = next(batches, None) #seeks to the start before the first step
+        batches = itertools.chain([] if first is None else [first], batches)
+
+    steps = [(speed, n_readers) for speed in args.speeds for n_readers in args.readers if speed != 'off' or n_readers > 0]
+    print(f"{len(steps)} steps of {args.duration}s: speeds {' '.join(args.speeds)}, readers {' '.join(map(str, args.readers))}")
+
+    report = {'started': datetime.now().isoformat(timespec='seconds'), 'compact': args.compact, 'workers': args.workers, 'insert_mode': args.insert_mode,
+              'policy': args.policy, 'dashboards': [d['title'] for d, _, _ in dashboards], 'steps': []}
+    writer = ReplayWriter(start_time, args.insert_mode, args.workers, args.rollup, not args.no_current_prices, args.compact) if writes else None
+    try:
+        for speed, n_readers in steps:
+            print(f"\nStep: speed {speed}, {n_readers} readers")
+            result = run_step(writer, batches, speed, n_readers, args.duration, dashboards, args, metrics)
+            report['steps'].append(result)
+            print(f"write {result['write_rows_s']:.1f} rows/s (insert p95 {ms_str(result['insert_p95_ms'])} ms, max lag {result['max_lag_s']:.2f}s), "
+                  f"read p50 {ms_str(result['read_p50_ms'])} ms, p95 {ms_str(result['read_p95_ms'])} ms, p99 {ms_str(result['read_p99_ms'])} ms "
+                  f"({result['reads']} queries, {result['late_refreshes']}/{result['refreshes']} refreshes late, {result['read_errors']} errors)")
+    finally:
+        if writer is not None:
+            writer.close()
+
+    print_summary(report['steps'])
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print(f"\nResults written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
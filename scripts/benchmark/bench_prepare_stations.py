@@ -0,0 +1,109 @@
+import os
+import sys
+import csv
+import time
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from prepare_stations import PostcodeIndex, normalize_split, get_real_path
+
+
+DEFAULT_STATIONS = "../data/stations_original.csv"
+DEFAULT_REGIONS = "../data/zuordnung_plz_ort.csv"
+DEFAULT_REPEATS = 5
+
+
+#----------------------------------------------------------
+# matching of prepare_stations before PostcodeIndex: lists of cities per postcode, words normalized at every call
+def legacy_plz_to_cities(plz_region_file : str) -> dict[str, list[str]]:
+    plz_to_cities : dict[str, list[str]] = {}
+    with open(plz_region_file, 'r') as input_plz_to_city:
+        for row in csv.DictReader(input_plz_to_city):
+            plz, city = row['plz'], row['ort']
+            if plz in plz_to_cities:
+                if city not in plz_to_cities[plz]:
+                    plz_to_cities[plz].append(city)
+            else:
+                plz_to_cities[plz] = [city]
+    return plz_to_cities
+
+def legacy_find_best_match(city : str, possible_cities : list[str]) -> str | None:
+    def normalize_split(city_str : str):
+        s = set(city_str.title().replace("-", " ").replace("/", " ").replace("ß", "ss").replace("ö", "oe").replace("ä", "ae").replace("ü","ue").split())
+        return {word for word in s if len(word) >= 3}
+
+    targets = normalize_split(city)
+    for possible_city in possible_cities:
+        if targets & normalize_split(possible_city):
+            return possible_city
+    return None
+
+
+#----------------------------------------------------------
+# (plz, city) of the stations that prepare_stations matches against the region file
+def read_stations(stations_file : str) -> list[tuple[str, str]]:
+    stations = []
+    with open(stations_file, mode='r', newline='') as infile:
+        for row in csv.DictReader(infile):
+            plz = row['post_code']
+            if not plz.isdigit() or plz in ['12345', '00000']:
+                continue
+            stations.append(("0" * (5 - len(plz)) + plz, row['city']))
+    return stations
+
+
+def match_legacy(stations : list[tuple[str, str]], plz_to_cities : dict[str, list[str]]) -> list[str | None]:
+    return [legacy_find_best_match(city, plz_to_cities[plz]) if plz in plz_to_cities else None for plz, city in stations]
+
+def match_index(stations : list[tuple[str, str]], index : PostcodeIndex) -> list[str | None]:
+    return [index.match(plz, city) if plz in index else None for plz, city in stations]
+
+def run_legacy(stations : list[tuple[str, str]], region_file : str) -> list[str | None]:
+    return match_legacy(stations, legacy_plz_to_cities(region_file))
+
+def run_index(stations : list[tuple[str, str]], region_file : str, fuzzy_cutoff : float | None = None) -> list[str | None]:
+    normalize_split.cache_clear()
+    return match_index(stations, PostcodeIndex.from_file(region_file, fuzzy_cutoff))
+
+
+def best_of(repeats : int, f, *args) -> tuple[float, list[str | None]]:
+    best, result = float('inf'), []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = f(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the city matching of prepare_stations (region file loading + one match per station)")
+    parser.add_argument('station_file', type=str, nargs='?', help="station input file", default=get_real_path(DEFAULT_STATIONS))
+    parser.add_argument('region_file', type=str, nargs='?', help="region input file", default=get_real_path(DEFAULT_REGIONS))
+    parser.add_argument('-r', '--repeats', type=int, help="runs of each version (the best one is reported)", default=DEFAULT_REPEATS)
+    parser.add_argument('--fuzzy', type=float, metavar='CUTOFF', help="also run the index with fuzzy matching", default=0.85)
+    args = parser.parse_args()
+
+    stations = read_stations(args.station_file)
+    print(f"{len(stations)} stations, region file {args.region_file}")
+
+    t_legacy, legacy = best_of(args.repeats, run_legacy, stations, args.region_file)
+    t_index, exact = best_of(args.repeats, run_index, stations, args.region_file)
+    t_fuzzy, fuzzy = best_of(args.repeats, run_index, stations, args.region_file, args.fuzzy)
+
+    #matching only, the region file already loaded
+    t_legacy_match, _ = best_of(args.repeats, match_legacy, stations, legacy_plz_to_cities(args.region_file))
+    t_index_match, _ = best_of(args.repeats, match_index, stations, PostcodeIndex.from_file(args.region_file))
+
+    assert legacy == exact, "PostcodeIndex does not match as before"
+    extra = [(plz, city, match) for (plz, city), before, match in zip(stations, legacy, fuzzy) if before is None and match is not None]
+
+    print(f"before (lists, normalized per call): {t_legacy * 1000:.1f} ms (matching only {t_legacy_match * 1000:.1f} ms)")
+    print(f"PostcodeIndex:                       {t_index * 1000:.1f} ms (matching only {t_index_match * 1000:.1f} ms), "
+          f"{t_legacy / t_index:.1f}x ({t_legacy_match / t_index_match:.1f}x matching only), same matches")
+    print(f"PostcodeIndex fuzzy ({args.fuzzy}): {t_fuzzy * 1000:.1f} ms, {len(extra)} more stations matched, {sum(m is None for m in legacy)} unmatched before")
+    for plz, city, match in extra[:10]:
+        print(f"\t{plz} {city} -> {match}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+import os
+import re
+import sys
+import glob
+import json
+import time
+import argparse
+import subprocess
+from datetime import datetime, timedelta, timezone
+import psycopg as pg
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from load_prices import get_conn_str, get_real_path
+
+
+DOCS_FOLDER = "../docs/sql"
+DASHBOARDS_FOLDER = "../grafana/dashboards"
+DOCS_QUERIES = ['time_series/AvgTW.sql', 'time_series/AvgTWUniformStations.sql', 'point_in_time/PriceAt.sql', 'local_area/RankLocalStations.sql']
+
+DEFAULT_END = "2024-01-22T00:00:00" #end of every range (dashboards with a range relative to now end now)
+DEFAULT_RANGES = ['1d', '7d', '14d']
+DEFAULT_GRANULARITIES = ['hour', 'day']
+DEFAULT_FUEL = 'diesel'
+DEFAULT_RUNS = 5
+DEFAULT_WARMUP = 1
+DEFAULT_TIMEOUT = 600 #seconds per statement
+DEFAULT_THRESHOLD = 1.2 #p50 slower than this ratio against the baseline is a regression
+DEFAULT_OUTPUT = "bench_queries.json"
+
+#granularity -> (unit of '1 $time_granularity' in custom variables, interval of '${time_granularity}'::INTERVAL)
+GRANULARITIES = {'5m': ('5 minutes', '5m'), 'hour': ('hour', '1h'), 'day': ('day', '1d'), 'week': ('week', '7d')}
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+MUTATING = re.compile(r"\b(insert|update|delete|drop|create|alter|truncate)\b", re.IGNORECASE)
+VARIABLE = re.compile(r"\$__(\w+)\(([^)]*)\)|\$\{(\w+)(?::(\w+))?\}|\$(\w+)")
+
+
+#----------------------------------------------------------
+def parse_duration(duration : str) -> timedelta:
+    return timedelta(seconds=int(duration[:-1]) * DURATION_UNITS[duration[-1]])
+
+def percentile(sorted_values : list[float], p : float) -> float:
+    k = (len(sorted_values) - 1) * p
+    lo, hi = int(k), min(int(k) + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+def sql_time(t : datetime) -> str:
+    return f"'{t.strftime('%Y-%m-%dT%H:%M:%SZ')}'"
+
+
+class Case:
+    """One query with one range, granularity and fuel, rendered to the sql sent to the db"""
+    def __init__(self, name : str, source : str, range_name : str, granularity : str, fuel : str, start : datetime, end : datetime, sql : str):
+        self.name, self.source, self.range_name, self.granularity, self.fuel = name, source, range_name, granularity, fuel
+        self.start, self.end, self.sql = start, end, sql
+
+    @property
+    def key(self) -> str:
+        return f"{self.name} | {self.range_name} | {self.granularity} | {self.fuel}"
+
+
+#----------------------------------------------------------
+# docs/sql: the literals of the param CTE (as tw_engine.sql_query) and the fuel
+def render_docs_query(query : str, start : datetime, end : datetime, granularity : str, fuel : str) -> str:
+    unit, _ = GRANULARITIES[granularity]
+    query = re.sub(r"'[^']*'::TIMESTAMP AS start_t", f"{sql_time(start)}::TIMESTAMP AS start_t", query)
+    query = re.sub(r"'[^']*'::TIMESTAMP AS end_t", f"{sql_time(end)}::TIMESTAMP AS end_t", query)
+    query = re.sub(r"'[^']*'::TIMESTAMP AS time_t", f"{sql_time(end)}::TIMESTAMP AS time_t", query)
+    query = re.sub(r"'[^']*'::INTERVAL AS time_granularity", f"'1 {unit}'::INTERVAL AS time_granularity", query)
+    return query.replace("diesel", fuel)
+
+
+def docs_cases(folder : str, files : list[str], ranges : list[str], granularities : list[str], fuel : str, end : datetime) -> list[Case]:
+    cases = []
+    for file in files:
+        with open(os.path.join(folder, file), 'r') as f:
+            query = f.read()
+        for range_name in ranges:
+            start = end - parse_duration(range_name)
+            for granularity in granularities:
+                sql = render_docs_query(query, start, end, granularity, fuel)
+                cases.append(Case(file, os.path.join("docs/sql", file), range_name, granularity, fuel, start, end, sql))
+    return cases
+
+
+#----------------------------------------------------------
+def format_value(value : str | list, fmt : str | None) -> str:
+    values = value if isinstance(value, list) else [value]
+    if fmt == 'singlequote' or (fmt is None and len(values) > 1):
+        return ",".join("'" + str(v).replace("'", "''") + "'" for v in values)
+    return ",".join(str(v) for v in values)
+
+
+# Values of the dashboard variables: the current one, or for single valued query variables
+# the first value of their query (as grafana refreshes them), read only queries only.
+def dashboard_variables(dashboard : dict, conn : pg.Connection) -> dict[str, str | list]:
+    values : dict[str, str | list] = {}
+    for variable in dashboard.get('templating', {}).get('list', []):
+        values[variable['name']] = variable.get('current', {}).get('value', "")
+        query = variable.get('query')
+        if variable['type'] == 'query' and not variable.get('multi') and isinstance(query, str) and query and not MUTATING.search(query):
+            try:
+                record = conn.execute(query).fetchone()  # type: ignore
+                if record is not None:
+                    values[variable['name']] = str(record[0])
+            except pg.Error:
+                pass
+    return values
+
+
+# Replaces the grafana macros and variables as the postgres datasource does
+def render_grafana_query(sql : str, variables : dict[str, str | list], start : datetime, end : datetime, granularity : str, fuel : str, custom_granularity : bool) -> str:
+    unit, interval = GRANULARITIES[granularity]
+
+    def replace(m : re.Match) -> str:
+        macro, args, name, fmt = m.group(1), m.group(2), m.group(3) or m.group(5), m.group(4)
+        if macro == 'timeFrom':
+            return sql_time(start)
+        if macro == 'timeTo':
+            return sql_time(end)
+        if macro == 'timeFilter':
+            return f"{args} BETWEEN {sql_time(start)} AND {sql_time(end)}"
+        if macro == 'unixEpochFrom':
+            return str(int(start.timestamp()))
+        if macro == 'unixEpochTo':
+            return str(int(end.timestamp()))
+        if macro is not None:
+            raise ValueError(f"unsupported macro $__{macro}")
+        if name == 'fuel':
+            return fuel
+        if name == 'time_granularity':
+            return unit if custom_granularity else interval
+        if name in variables:
+            return format_value(variables[name], fmt)
+        raise ValueError(f"unknown variable ${name}")
+
+    return VARIABLE.sub(replace, sql)
+
+
+def load_dashboards(folder : str) -> dict[str, dict]:
+    dashboards = {}
+    for file in sorted(glob.glob(os.path.join(folder, "*.json"))):
+        with open(file, 'r') as f:
+            dashboards[file] = json.load(f)
+    return dashboards
+
+
+# (dashboard/panel/refId, sql) of every visible sql target, nested panels (rows) included
+def panel_targets(dashboard : dict) -> list[tuple[str, str]]:
+    def panels(ps : list) -> list:
+        return [q for p in ps for q in [p] + panels(p.get('panels', []))]
+
+    return [(f"{dashboard['title']}/{panel.get('title', '')}/{target.get('refId', 'A')}", target['rawSql'])
+            for panel in panels(dashboard['panels']) for target in panel.get('targets', []) if target.get('rawSql') and not target.get('hide')]
+
+
+# $time_granularity of a custom variable is a unit ('1 $time_granularity'), of a query variable an interval
+def has_custom_granularity(dashboard : dict) -> bool:
+    return any(v['name'] == 'time_granularity' and v['type'] == 'custom' for v in dashboard.get('templating', {}).get('list', []))
+
+
+def grafana_cases(folder : str, conn : pg.Connection, ranges : list[str], granularities : list[str], fuel : str, end : datetime) -> list[Case]:
+    cases = []
+    now = datetime.now(timezone.utc).replace(tzinfo=None, microsecond=0)
+    for file, dashboard in load_dashboards(folder).items():
+        variables = dashboard_variables(dashboard, conn)
+        custom_granularity = has_custom_granularity(dashboard)
+        dashboard_end = now if str(dashboard.get('time', {}).get('to', "")).startswith("now") else end
+
+        for name, sql in panel_targets(dashboard):
+            try:
+                render_grafana_query(sql, variables, dashboard_end, dashboard_end, granularities[0], fuel, custom_granularity)
+            except ValueError as e:
+                print(f"Skipping {name}: {e}")
+                continue
+
+            for range_name in ranges:
+                start = dashboard_end - parse_duration(range_name)
+                for granularity in granularities:
+                    rendered = render_grafana_query(sql, variables, start, dashboard_end, granularity, fuel, custom_granularity)
+                    cases.append(Case(name, os.path.relpath(file, get_real_path("..")), range_name, granularity, fuel, start, dashboard_end, rendered))
+    return cases
+
+
+#----------------------------------------------------------
+# rows of the last statement returning rows (panels may run several statements)
+def execute(conn : pg.Connection, sql : str) -> int:
+    with conn.cursor() as cur:
+        cur.execute(sql)  # type: ignore
+        n_rows = 0
+        while True:
+            if cur.description is not None:
+                n_rows = len(cur.fetchall())
+            if not cur.nextset():
+                return n_rows
+
+
+def run_case(conn : pg.Connection, case : Case, runs : int, warmup : int) -> dict:
+    result : dict = {'key': case.key, 'query': case.name, 'source': case.source, 'range': case.range_name, 'granularity': case.granularity,
+                     'fuel': case.fuel, 'start': case.start.isoformat(), 'end': case.end.isoformat()}
+    latencies, n_rows = [], 0
+    try:
+        for i in range(warmup + runs):
+            start = time.perf_counter()
+            n_rows = execute(conn, case.sql)
+            if i >= warmup:
+                latencies.append((time.perf_counter() - start) * 1000)
+    except pg.Error as e:
+        result['error'] = str(e).splitlines()[0]
+        return result
+
+    latencies.sort()
+    result.update({'rows': n_rows, 'runs': runs, 'p50_ms': round(percentile(latencies, 0.5), 3), 'p95_ms': round(percentile(latencies, 0.95), 3),
+                   'p99_ms': round(percentile(latencies, 0.99), 3), 'mean_ms': round(sum(latencies) / runs, 3), 'latencies_ms': [round(l, 3) for l in latencies]})
+    return result
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=get_real_path("..")).stdout.strip() or None
+    except OSError:
+        return None
+
+
+# p50 of every case in both runs: slower than threshold or with other rows counts are reported, True if any
+def compare(baseline : dict, current : dict, threshold : float) -> bool:
+    before = {r['key'] : r for r in baseline['results']}
+    regressions = 0
+    print(f"\nAgainst {baseline.get('commit')} ({baseline.get('started')}):")
+    for result in current['results']:
+        old = before.get(result['key'])
+        if old is None or 'p50_ms' not in old or 'p50_ms' not in result:
+            continue
+        ratio = result['p50_ms'] / old['p50_ms'] if old['p50_ms'] > 0 else float('inf')
+        flags = []
+        if ratio > threshold:
+            flags.append("REGRESSION")
+        if result['rows'] != old['rows']:
+            flags.append(f"ROWS {old['rows']} -> {result['rows']}")
+        regressions += len(flags) > 0
+        print(f"{result['key']:<90} {old['p50_ms']:>10.1f} -> {result['p50_ms']:>10.1f} ms {ratio:>6.2f}x {' '.join(flags)}")
+    print(f"{regressions} cases regressed or changed rows (threshold {threshold}x)")
+    return regressions > 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the docs/sql queries and the grafana panel queries (macros and variables substituted) over a matrix of ranges and granularities, writing latency percentiles and rows to JSON")
+    parser.add_argument('-o', '--output', type=str, help="JSON file with the results", default=DEFAULT_OUTPUT)
+    parser.add_argument('--compare', type=str, metavar='BASELINE', help="JSON of a previous run to compare with (exit code 1 on regressions)", default=None)
+    parser.add_argument('--source', choices=['all', 'docs', 'grafana'], help="which queries to run", default='all')
+    parser.add_argument('--docs', type=str, nargs='*', help=f"queries in {DOCS_FOLDER} to run", default=DOCS_QUERIES)
+    parser.add_argument('-q', '--query', type=str, help="only queries whose name contains it", default=None)
+    parser.add_argument('--ranges', type=str, nargs='+', help="ranges ending at --end (m, h, d, w)", default=DEFAULT_RANGES)
+    parser.add_argument('--granularities', choices=list(GRANULARITIES), nargs='+', help="bucket sizes", default=DEFAULT_GRANULARITIES)
+    parser.add_argument('--end', type=str, help="end of the ranges (dashboards relative to now end now)", default=DEFAULT_END)
+    parser.add_argument('-f', '--fuel', choices=['diesel', 'e5', 'e10'], help="fuel of the queries", default=DEFAULT_FUEL)
+    parser.add_argument('-n', '--runs', type=int, help="measured runs of every case", default=DEFAULT_RUNS)
+    parser.add_argument('-w', '--warmup', type=int, help="runs of every case before measuring", default=DEFAULT_WARMUP)
+    parser.add_argument('-t', '--timeout', type=int, help="statement timeout in seconds", default=DEFAULT_TIMEOUT)
+    parser.add_argument('-k', '--compact', action='store_true', help="run on the compact layout (sql/compact_schema.sql)")
+    parser.add_argument('--threshold', type=float, help="p50 ratio against the baseline reported as a regression", default=DEFAULT_THRESHOLD)
+    args = parser.parse_args()
+
+    end = datetime.fromisoformat(args.end)
+    with pg.connect(get_conn_str(args.compact), autocommit=True, prepare_threshold=None) as conn:
+        conn.execute(f"SET statement_timeout = '{args.timeout}s';")
+
+        cases : list[Case] = []
+        if args.source in ('all', 'docs'):
+            cases += docs_cases(get_real_path(DOCS_FOLDER), args.docs, args.ranges, args.granularities, args.fuel, end)
+        if args.source in ('all', 'grafana'):
+            cases += grafana_cases(get_real_path(DASHBOARDS_FOLDER), conn, args.ranges, args.granularities, args.fuel, end)
+        if args.query is not None:
+            cases = [case for case in cases if args.query in case.name]
+
+        #a query not depending on the range (or granularity) is run once
+        seen : set[str] = set()
+        cases = [case for case in cases if not (case.sql in seen or seen.add(case.sql))]  # type: ignore
+        print(f"{len(cases)} cases, {args.warmup} + {args.runs} runs each")
+
+        report = {'started': datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(), 'compact': args.compact,
+                  'runs': args.runs, 'warmup': args.warmup, 'results': []}
+        for case in cases:
+            result = run_case(conn, case, args.runs, args.warmup)
+            report['results'].append(result)
+            if 'error' in result:
+                print(f"{case.key:<90} failed: {result['error']}")
+            else:
+                print(f"{case.key:<90} p50 {result['p50_ms']:>10.1f} ms, p95 {result['p95_ms']:>10.1f} ms, p99 {result['p99_ms']:>10.1f} ms, {result['rows']} rows")
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print(f"Results written to {args.output}")
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            if compare(json.load(f), report, args.threshold):
+                exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import os
+import re
+import sys
+import time
+import argparse
+import psycopg as pg
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from load_prices import get_conn_str, get_real_path
+
+
+DEFAULT_QUERIES = "../docs/sql"
+DEFAULT_REPEATS = 3
+DEFAULT_TIMEOUT = 600 #seconds per query
+
+#size of each layout: prices against the partitions of compact.prices_data (or the table itself) and station_ids
+PLAIN_SIZE = "SELECT pg_total_relation_size('public.prices');"
+COMPACT_SIZE = """SELECT pg_total_relation_size('compact.station_ids') + pg_total_relation_size('compact.prices_data')
+    + COALESCE((SELECT SUM(pg_total_relation_size(inhrelid)) FROM pg_inherits WHERE inhparent = 'compact.prices_data'::regclass), 0);"""
+
+
+#----------------------------------------------------------
+# queries of the folder reading prices, by path relative to the folder
+def list_queries(folder : str, pattern : str | None = None) -> dict[str, str]:
+    queries = {}
+    for root, _, files in os.walk(folder):
+        for file in files:
+            path = os.path.join(root, file)
+            name = os.path.relpath(path, folder)
+            if not file.endswith(".sql") or (pattern is not None and pattern not in name):
+                continue
+            with open(path, 'r') as f:
+                query = f.read()
+            if re.search(r"\bprices\b", re.sub(r"--.*", "", query)):
+                queries[name] = query
+    return dict(sorted(queries.items()))
+
+
+def best_of(conn : pg.Connection, query : str, repeats : int) -> tuple[float, list[tuple]]:
+    best, rows = float('inf'), []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        rows = conn.execute(query).fetchall()  # type: ignore
+        best = min(best, time.perf_counter() - start)
+    return best, rows
+
+
+# rows comparable across layouts: floats rounded (sums in another order), any row order
+def normalized(rows : list[tuple]) -> list[tuple]:
+    return sorted([tuple(round(v, 6) if isinstance(v, float) else v for v in row) for row in rows], key=str)
+
+
+def size_mb(conn : pg.Connection, query : str) -> float:
+    try:
+        return conn.execute(query).fetchone()[0] / (1 << 20)  # type: ignore
+    except pg.Error:
+        return float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the queries reading prices on prices and on the compact layout (sql/compact_schema.sql), same data in both")
+    parser.add_argument('queries', type=str, nargs='?', help="folder of the queries", default=get_real_path(DEFAULT_QUERIES))
+    parser.add_argument('-q', '--query', type=str, help="only queries whose path contains it", default=None)
+    parser.add_argument('-r', '--repeats', type=int, help="runs of each query on each layout (the best one is reported)", default=DEFAULT_REPEATS)
+    parser.add_argument('-t', '--timeout', type=int, help="statement timeout in seconds", default=DEFAULT_TIMEOUT)
+    args = parser.parse_args()
+
+    queries = list_queries(args.queries, args.query)
+    print(f"{len(queries)} queries reading prices in {args.queries}")
+
+    with pg.connect(get_conn_str(), autocommit=True) as plain, pg.connect(get_conn_str(compact=True), autocommit=True) as compact:
+        for conn in (plain, compact):
+            conn.execute(f"SET statement_timeout = '{args.timeout}s';")
+
+        print(f"prices: {size_mb(plain, PLAIN_SIZE):.0f} MB, compact layout: {size_mb(plain, COMPACT_SIZE):.0f} MB\n")
+        print(f"{'query':<50} {'prices':>10} {'compact':>10} {'speedup':>8}")
+
+        total_plain, total_compact = 0.0, 0.0
+        for name, query in queries.items():
+            try:
+                t_plain, rows_plain = best_of(plain, query, args.repeats)
+                t_compact, rows_compact = best_of(compact, query, args.repeats)
+            except pg.Error as e:
+                print(f"{name:<50} failed: {str(e).splitlines()[0]}")
+                continue
+
+            total_plain, total_compact = total_plain + t_plain, total_compact + t_compact
+            same = normalized(rows_plain) == normalized(rows_compact)
+            print(f"{name:<50} {t_plain * 1000:>8.0f}ms {t_compact * 1000:>8.0f}ms {t_plain / t_compact:>7.2f}x" + ("" if same else "  DIFFERENT RESULTS"))
+
+        if total_compact > 0:
+            print(f"\n{'total':<50} {total_plain * 1000:>8.0f}ms {total_compact * 1000:>8.0f}ms {total_plain / total_compact:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
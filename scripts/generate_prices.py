@@ -0,0 +1,261 @@
+import os
+import csv
+import time
+import uuid
+import random
+import argparse
+from array import array
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+DEFAULT_STATIONS = "../data/stations.csv"
+DEFAULT_TIMES = "../data/stations_times.csv"
+DEFAULT_OUTPUT = "../data/synthetic"
+DEFAULT_JOBS = os.cpu_count() or 4
+DEFAULT_SEED = 42
+
+DEFAULT_MULTIPLIER = 1
+DEFAULT_UPDATES = 30.0 #per station and day (open all day)
+DEFAULT_BASE_PRICES = [1.699, 1.789, 1.729] #diesel, e5, e10
+DEFAULT_TREND = 0.0 #euro per day
+DEFAULT_VOLATILITY = 0.01 #euro, std of the daily step of the national price
+DEFAULT_INTRADAY = 0.08 #euro, from the cheapest to the most expensive hour of the day
+DEFAULT_SPREAD = 0.03 #euro, std of the offset of a station from the national price
+
+TIMEZONE = ZoneInfo("Europe/Berlin") #files are per local day, dates with the local offset (+01/+02)
+PRICES_HEADER = "date,station_uuid,diesel,e5,e10,dieselchange,e5change,e10change\n"
+STATIONS_OUTPUT = "stations.csv"
+TIMES_OUTPUT = "stations_times.csv"
+PRICES_FOLDER = "prices"
+FUELS = ['diesel', 'e5', 'e10']
+
+UUID_NAMESPACE = uuid.UUID("5b0e9a3c-2f44-4d8e-9a61-7c1f0d6e3b21") #copies of a station: uuid5(namespace, "<uuid>/<copy>")
+COPY_JITTER = 0.02 #degrees, std of the distance of a copy from its station
+WINDOW = 600 #seconds of updates drawn (and sorted) at once, divides an hour so the utc offset is the same in a window
+WEEK_MINUTES = 7 * 24 * 60
+FUEL_CHANGE = [0.9, 0.8, 0.8] #probability an update changes the price of each fuel
+NOISE_CENTS = [-1, 0, 0, 1] #cents added to the price of an update
+
+#relative price by local hour (0 cheapest, 1 most expensive): peaks in the night and the early morning, cheapest in the evening
+INTRADAY_PROFILE = [1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 0.95, 0.8, 0.65, 0.7, 0.6, 0.65, 0.5, 0.55, 0.4, 0.45, 0.3, 0.2, 0.1, 0.0, 0.05, 0.9, 1.0]
+
+
+#----------------------------------------------------------
+def get_real_path(relative_path : str) -> str:
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(script_dir, relative_path)
+
+def to_minutes(t : str) -> int:
+    h, m, s = t.split(":")
+    return int(h) * 60 + int(m) + (int(s) > 0)
+
+
+class Seeds:
+    """Stations of data/stations.csv with their weekly opening minutes (bit d * 1440 + minute, Monday is day 0, as sql/open_hours.sql)"""
+    def __init__(self, stations_file : str, times_file : str):
+        with open(stations_file, 'r', newline='') as f:
+            self.stations = list(csv.DictReader(f))
+        with open(times_file, 'r', newline='') as f:
+            self.times = list(csv.DictReader(f))
+
+        self.uuids = [s['uuid'] for s in self.stations]
+        self.first_active = [datetime.fromisoformat(s['first_active']).timestamp() for s in self.stations]
+
+        index = {u : i for i, u in enumerate(self.uuids)}
+        always_open = (1 << WEEK_MINUTES) - 1
+        self.open_minutes = [always_open if s['always_open'] == 'True' else 0 for s in self.stations]
+        for t in self.times:
+            i = index.get(t['uuid'])
+            if i is None:
+                continue
+            days, open_at, close_at = int(t['days']), to_minutes(t['open_at']), to_minutes(t['close_at'])
+            length = close_at - open_at + (1440 if close_at < open_at else 0)
+            for d in range(7):
+                if days & (1 << d):
+                    start = d * 1440 + open_at
+                    bits = ((1 << length) - 1) << start
+                    self.open_minutes[i] |= (bits | (bits >> WEEK_MINUTES)) & always_open #sunday night wraps to monday
+
+        #stations open for at least a minute of every hour of the week
+        hour_mask = (1 << 60) - 1
+        self.open_in_hour = [[i for i, minutes in enumerate(self.open_minutes) if (minutes >> (h * 60)) & hour_mask] for h in range(7 * 24)]
+
+    def __len__(self) -> int:
+        return len(self.stations)
+
+
+def copy_uuid(station_uuid : str, copy : int) -> str:
+    return station_uuid if copy == 0 else str(uuid.uuid5(UUID_NAMESPACE, f"{station_uuid}/{copy}"))
+
+
+# stations_times.csv and stations.csv with multiplier copies of every station (the first one is the station itself, the others nearby)
+def write_stations(seeds : Seeds, multiplier : int, seed : int, folder : str):
+    rng = random.Random(f"{seed}-stations")
+    with open(os.path.join(folder, STATIONS_OUTPUT), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(seeds.stations[0].keys()))
+        writer.writeheader()
+        for station in seeds.stations:
+            for copy in range(multiplier):
+                row = dict(station, uuid=copy_uuid(station['uuid'], copy))
+                if copy > 0:
+                    row['latitude'] = f"{float(station['latitude']) + rng.gauss(0, COPY_JITTER):.6f}"
+                    row['longitude'] = f"{float(station['longitude']) + rng.gauss(0, COPY_JITTER):.6f}"
+                writer.writerow(row)
+
+    with open(os.path.join(folder, TIMES_OUTPUT), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(seeds.times[0].keys()))
+        writer.writeheader()
+        for t in seeds.times:
+            for copy in range(multiplier):
+                writer.writerow(dict(t, uuid=copy_uuid(t['uuid'], copy)))
+
+
+# national price level (added to the base prices) of every day from the first one: a random walk with a trend
+def price_levels(n_days : int, trend : float, volatility : float, seed : int) -> list[float]:
+    rng = random.Random(f"{seed}-levels")
+    levels = [0.0]
+    for _ in range(n_days):
+        levels.append(levels[-1] + trend + rng.gauss(0, volatility))
+    return levels
+
+
+#----------------------------------------------------------
+# state of every worker process, set once by init_worker
+SEEDS : Seeds | None = None
+UUIDS : list[str] = []
+OFFSETS : array = array('i')
+OPTIONS : dict = {}
+
+def init_worker(stations_file : str, times_file : str, options : dict):
+    global SEEDS, UUIDS, OFFSETS, OPTIONS
+    SEEDS, OPTIONS = Seeds(stations_file, times_file), options
+    multiplier = options['multiplier']
+    UUIDS = [copy_uuid(u, copy) for u in SEEDS.uuids for copy in range(multiplier)]
+    rng = random.Random(f"{options['seed']}-offsets")
+    OFFSETS = array('i', [round(rng.gauss(0, options['spread']) * 1000) for _ in range(len(UUIDS))])
+
+
+def price_str(price : int) -> str:
+    return f"{price // 1000}.{price % 1000:03d}"
+
+
+# the prices of one local day, in time order: updates are drawn window by window for the stations open then
+def generate_day(day : date, level : float, next_level : float, path : str) -> int:
+    assert SEEDS is not None
+    multiplier, updates, intraday = OPTIONS['multiplier'], OPTIONS['updates'], OPTIONS['intraday']
+    base = [round(p * 1000) for p in OPTIONS['base_prices']]
+    rng = random.Random(f"{OPTIONS['seed']}-{day.isoformat()}")
+
+    day_start = int(datetime(day.year, day.month, day.day, tzinfo=TIMEZONE).timestamp())
+    day_end = int(datetime.combine(day + timedelta(days=1), datetime.min.time(), tzinfo=TIMEZONE).timestamp())
+    current = array('i', [-1]) * (len(UUIDS) * len(FUELS)) #price of every station and fuel today, -1 before its first update
+    rate = updates / 86400 #per station and second open
+
+    n_rows = 0
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", 'w') as f:
+        f.write(PRICES_HEADER)
+        for window_start in range(day_start, day_end, WINDOW):
+            local = datetime.fromtimestamp(window_start, TIMEZONE)
+            utc_offset = int(local.utcoffset().total_seconds())  # type: ignore
+            offset_str = f"{'+' if utc_offset >= 0 else '-'}{abs(utc_offset) // 3600:02d}"
+            week_minute = local.weekday() * 1440 + local.hour * 60 + local.minute
+            candidates = SEEDS.open_in_hour[week_minute // 60]
+            if len(candidates) == 0:
+                continue
+
+            #national price of the window: the level of the day moving towards the next one, plus the hour of the day
+            progress = (window_start - day_start) / (day_end - day_start)
+            national = round(((level + (next_level - level) * progress) + intraday * INTRADAY_PROFILE[local.hour]) * 1000)
+
+            expected = rate * WINDOW * len(candidates) * multiplier
+            n = int(expected) + (rng.random() < expected - int(expected))
+            draws = sorted((rng.randrange(WINDOW), rng.randrange(len(candidates)), rng.randrange(multiplier)) for _ in range(n))
+
+            lines = []
+            for second, candidate, copy in draws:
+                seed_station = candidates[candidate]
+                t = window_start + second
+                minute = week_minute + second // 60
+                if not (SEEDS.open_minutes[seed_station] >> minute) & 1 or t < SEEDS.first_active[seed_station]:
+                    continue #closed at this minute (the station is only open for part of the hour), or not active yet
+
+                station = seed_station * multiplier + copy
+                changes = []
+                for i in range(len(FUELS)):
+                    k = station * len(FUELS) + i
+                    old = current[k]
+                    if old < 0 or rng.random() < FUEL_CHANGE[i]:
+                        cents = (base[i] + national + OFFSETS[station]) // 10 + rng.choice(NOISE_CENTS)
+                        current[k] = cents * 10 + 9 #prices end with 9 tenths of a cent
+                    changes.append(0 if current[k] == old else 1)
+                if not any(changes):
+                    continue
+
+                local_seconds = (t + utc_offset) % 86400
+                k = station * len(FUELS)
+                lines.append(f"{day.isoformat()} {local_seconds // 3600:02d}:{local_seconds // 60 % 60:02d}:{local_seconds % 60:02d}{offset_str},{UUIDS[station]},"
+                             f"{price_str(current[k])},{price_str(current[k + 1])},{price_str(current[k + 2])},{changes[0]},{changes[1]},{changes[2]}\n")
+            f.writelines(lines)
+            n_rows += len(lines)
+
+    os.replace(path + ".tmp", path) #a file is there only once complete
+    return n_rows
+
+
+#----------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Generates synthetic price files (tankerkoenig format) for the stations of data/stations.csv, multiplied, deterministic from a seed")
+    parser.add_argument('start', type=str, help="first day to generate (YYYY-MM-DD)")
+    parser.add_argument('end', type=str, help="first day not to generate (YYYY-MM-DD)")
+    parser.add_argument('-o', '--output', type=str, help=f"output folder: {STATIONS_OUTPUT}, {TIMES_OUTPUT} and {PRICES_FOLDER}/YYYY/MM/YYYY-MM-DD-prices.csv", default=get_real_path(DEFAULT_OUTPUT))
+    parser.add_argument('--stations', type=str, help="stations to start from", default=get_real_path(DEFAULT_STATIONS))
+    parser.add_argument('--times', type=str, help="opening times of the stations", default=get_real_path(DEFAULT_TIMES))
+    parser.add_argument('-m', '--multiplier', type=int, help="copies of every station (the first one is the station itself)", default=DEFAULT_MULTIPLIER)
+    parser.add_argument('-u', '--updates', type=float, help="price updates per station and day (while open)", default=DEFAULT_UPDATES)
+    parser.add_argument('--base-prices', type=float, nargs=3, metavar=('DIESEL', 'E5', 'E10'), help="national prices at the cheapest hour of the first day", default=DEFAULT_BASE_PRICES)
+    parser.add_argument('--trend', type=float, help="national price change per day (euro)", default=DEFAULT_TREND)
+    parser.add_argument('--volatility', type=float, help="std of the daily random change of the national price (euro)", default=DEFAULT_VOLATILITY)
+    parser.add_argument('--intraday', type=float, help="national price difference between the most expensive and the cheapest hour of the day (euro)", default=DEFAULT_INTRADAY)
+    parser.add_argument('--spread', type=float, help="std of the difference of a station from the national price (euro)", default=DEFAULT_SPREAD)
+    parser.add_argument('-s', '--seed', type=int, help="same seed and options, same files", default=DEFAULT_SEED)
+    parser.add_argument('-j', '--jobs', type=int, help="days generated in parallel (processes)", default=DEFAULT_JOBS)
+    args = parser.parse_args()
+
+    start, end = date.fromisoformat(args.start), date.fromisoformat(args.end)
+    days = [start + timedelta(days=i) for i in range((end - start).days)]
+    if len(days) == 0 or args.multiplier < 1:
+        print("Nothing to generate: end must be after start, multiplier at least 1")
+        exit(1)
+
+    seeds = Seeds(args.stations, args.times)
+    print(f"{len(seeds)} stations x {args.multiplier} = {len(seeds) * args.multiplier} stations, {len(days)} days from {start}, "
+          f"{args.updates} updates per station and day (while open), seed {args.seed}")
+
+    os.makedirs(args.output, exist_ok=True)
+    write_stations(seeds, args.multiplier, args.seed, args.output)
+    print(f"Stations written to {os.path.join(args.output, STATIONS_OUTPUT)} and {os.path.join(args.output, TIMES_OUTPUT)}")
+
+    levels = price_levels(len(days), args.trend, args.volatility, args.seed)
+    options = {'multiplier': args.multiplier, 'updates': args.updates, 'base_prices': args.base_prices,
+               'intraday': args.intraday, 'spread': args.spread, 'seed': args.seed}
+
+    start_time, total_rows = time.perf_counter(), 0
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker, initargs=(args.stations, args.times, options)) as executor:
+        futures = {}
+        for i, day in enumerate(days):
+            path = os.path.join(args.output, PRICES_FOLDER, f"{day.year}", f"{day.month:02d}", f"{day.isoformat()}-prices.csv")
+            futures[executor.submit(generate_day, day, levels[i], levels[i + 1], path)] = path
+        for future in as_completed(futures):
+            n_rows = future.result()
+            total_rows += n_rows
+            print(f"{futures[future]}: {n_rows} updates")
+
+    elapsed = time.perf_counter() - start_time
+    print(f"{total_rows} updates in {len(days)} files in {elapsed:.1f}s ({total_rows / elapsed:.0f} updates/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import threading
+from typing import Any
+import requests
+
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org"
+DEFAULT_CACHE_FILE = "../data/geocoding_cache.sqlite"
+DEFAULT_RATE = 1.0 #requests per second (Nominatim usage policy)
+DEFAULT_RETRIES = 3
+BACKOFF_SECONDS = 2.0
+CACHE_MAX_AGE = 90 * 24 * 3600 #seconds, older answers are asked again
+TIMEOUT_SECONDS = 30
+
+USER_AGENTS = ["pippo", "pluto", "paperino"]
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+#----------------------------------------------------------
+def get_real_path(relative_path : str) -> str:
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(script_dir, relative_path)
+
+
+# Answers of the geocoding api by (api, params), kept between runs
+class GeoCache:
+    def __init__(self, file : str):
+        os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(file, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (api TEXT, params TEXT, response TEXT, fetched_at REAL, PRIMARY KEY (api, params));")
+        self.conn.commit()
+        self.hits, self.misses = 0, 0
+
+    @staticmethod
+    def key(params : dict[str, Any]) -> str:
+        return json.dumps(params, sort_keys=True, ensure_ascii=False)
+
+    def get(self, api : str, params : dict[str, Any]) -> Any | None:
+        with self.lock:
+            record = self.conn.execute("SELECT response, fetched_at FROM responses WHERE api = ? AND params = ?;", (api, self.key(params))).fetchone()
+            if record is None or time.time() - record[1] > CACHE_MAX_AGE:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return json.loads(record[0])
+
+    def put(self, api : str, params : dict[str, Any], response : Any):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?);", (api, self.key(params), json.dumps(response), time.time()))
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+# At most rate acquisitions per second, shared by all threads
+class RateLimiter:
+    def __init__(self, rate : float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.lock = threading.Lock()
+        self.next_t = time.monotonic()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_t - now
+            self.next_t = max(now, self.next_t) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+#----------------------------------------------------------
+class Geocoder:
+    """
+    Nominatim-like api (search, reverse) behind a persistent cache, a rate limiter and retries.
+    base_url can point to any server answering the same requests (e.g. a local stand-in).
+    """
+    def __init__(self, base_url : str = NOMINATIM_URL, cache_file : str = get_real_path(DEFAULT_CACHE_FILE), rate : float = DEFAULT_RATE,
+                 retries : int = DEFAULT_RETRIES):
+        self.base_url = base_url.rstrip("/")
+        self.cache = GeoCache(cache_file)
+        self.limiter = RateLimiter(rate)
+        self.retries = retries
+        self.session = requests.Session()
+        self.lock = threading.Lock() #fetch and query run on the threads of the callers
+        self.n_requests, self.n_errors = 0, 0
+
+    def fetch(self, api : str, params : dict[str, Any]) -> Any:
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            with self.lock:
+                self.n_requests += 1
+            try:
+                response = self.session.get(f"{self.base_url}/{api}", params=params, headers={"User-Agent": random.choice(USER_AGENTS)}, timeout=TIMEOUT_SECONDS)
+                print(f"\tSending: {response.url}")
+                if response.status_code in RETRY_STATUS and attempt < self.retries:
+                    raise requests.HTTPError(f"{response.status_code} for {response.url}")
+                response.raise_for_status()
+                return response.json()
+            except requests.RequestException as e:
+                if attempt == self.retries:
+                    raise
+                print(f"\tRetrying ({e})")
+                time.sleep(BACKOFF_SECONDS * (2 ** attempt))
+
+    # Cached answer of api for params, or an Exception if the api could not be queried (not cached)
+    def query(self, api : str, params : dict[str, Any]) -> Any | Exception:
+        cached = self.cache.get(api, params)
+        if cached is not None:
+            return cached
+
+        try:
+            data = self.fetch(api, params)
+        except (requests.RequestException, ValueError) as e:
+            with self.lock:
+                self.n_errors += 1
+            print(f"Error querying the geocoding api: {e}")
+            return Exception(e)
+
+        self.cache.put(api, params, data)
+        return data
+
+    def search(self, params : dict[str, Any]) -> Any | Exception:
+        return self.query("search", params)
+
+    def reverse(self, params : dict[str, Any]) -> Any | Exception:
+        return self.query("reverse", params)
+
+    def stats(self) -> str:
+        return f"cache hits: {self.cache.hits}, requests: {self.n_requests}, errors: {self.n_errors}"
+
+    def close(self):
+        self.session.close()
+        self.cache.close()
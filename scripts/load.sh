@@ -4,24 +4,48 @@ set -e
 PATH_TO_SCHEMA="sql/schema.sql"
 PATH_TO_STATIONS="/data/stations.csv"
 PATH_TO_TIMES="/data/stations_times.csv"
+PATH_TO_CURRENT_PRICES="sql/current_prices.sql"
+PATH_TO_CELLS="sql/stations_cells.sql"
+PATH_TO_OPEN_HOURS="sql/open_hours.sql"
+PATH_TO_COMPACT_SCHEMA="sql/compact_schema.sql"
+PATH_TO_COMPACT_PARTITIONS="sql/compact_partitions.sql"
+COMPACT_SEARCH_PATH="set search_path = compact, public;"
 
 PRICES_TABLE=prices
 STATIONS_TABLE=stations
 TIMES_TABLE=stations_times
+MANIFEST_TABLE=prices_manifest
+ROLLUP_TABLE=prices_hourly
 
 PRICES_DIR="/data/prices"
+LOCAL_PRICES_DIR="data/prices" #same folder, as seen from the host (used by the parallel loader)
+PARALLEL_LOADER="scripts/load_prices.py"
+ROLLUP="scripts/replay/rollup.py"
 
 CONTAINER=cedar
 
 do_create=0
 do_stations=0
 do_prices=0
+jobs=0
+incremental=0
+do_rollup=0
+compact=0
+use_postgres=0
+DEFAULT_JOBS=4
 
 usage() {
-    echo "Usage: $0 [-c] [-s] [-p  <year/mm> <year/mm> ] [-o]"
+    echo "Usage: $0 [-c] [-s] [-j <n_jobs>] [-i] [-p  <year/mm> <year/mm> ] [-r] [-k] [-o]"
     echo "  -c              creates schema from $PATH_TO_SCHEMA"
-    echo "  -s              loads stations from $PATH_TO_STATIONS and $PATH_TO_TIMES "
-    echo "  -p <year/mm start> <year/mm end> loads prices from $PRICES_DIR from start to end"
+    echo "  -s              loads stations from $PATH_TO_STATIONS and $PATH_TO_TIMES (and their grid cells with $PATH_TO_CELLS, their opening hours with $PATH_TO_OPEN_HOURS)"
+    echo "  -p <year/mm start> <year/mm end> loads prices from $PRICES_DIR from start to end (and refreshes current_prices)"
+    echo "  -j <n_jobs>     loads prices with $PARALLEL_LOADER, n_jobs files at a time (pass it before -p)"
+    echo "  -i              loads only new or changed price files (tracked in $MANIFEST_TABLE), without recreating prices (pass it before -p)"
+    echo "                  only the loads of $PARALLEL_LOADER (-j, -k or -i) fill $MANIFEST_TABLE: after a load without them every file is reloaded"
+    echo "  -r              rolls up the loaded prices into $ROLLUP_TABLE with $ROLLUP (recreated with the prices)"
+    echo "  -k              creates (with -c) and loads prices into the compact layout $PATH_TO_COMPACT_SCHEMA instead of $PRICES_TABLE"
+    echo "                  (with -o also partitioned by month, $PATH_TO_COMPACT_PARTITIONS), always with $PARALLEL_LOADER"
+    echo "  -o              uses postgres instead of CedarDB"
     exit 1
 }
 
@@ -41,7 +65,7 @@ source .env
 CONN_STR="host=localhost user=$CEDAR_USER dbname=$CEDAR_DB password=$CEDAR_PASSWORD"
 
 
-while getopts "csp:o" opt; do
+while getopts "csj:ip:rko" opt; do
     case "$opt" in
         c)
             do_create=1
@@ -57,7 +81,20 @@ while getopts "csp:o" opt; do
             end_date=$1
             echo "End date $end_date"
             ;;
+        j)
+            jobs=${OPTARG}
+            ;;
+        i)
+            incremental=1
+            ;;
+        r)
+            do_rollup=1
+            ;;
+        k)
+            compact=1
+            ;;
         o)
+            use_postgres=1
             CONTAINER=postgres
             echo "Using use postgres -> container: $CONTAINER"
             ;;
@@ -124,6 +161,14 @@ extract_table_schema() {
     ' "$PATH_TO_SCHEMA"
 }
 
+create_compact(){
+    execute_query "$(cat $PATH_TO_COMPACT_SCHEMA)"
+    if [[ "$use_postgres" -eq 1 ]]; then
+        execute_query "$(cat $PATH_TO_COMPACT_PARTITIONS)"
+    fi
+    echo "Compact layout created"
+}
+
 recreate_table(){
     if [[ "$do_create" -eq 0 ]]; then
         execute_query "drop table if exists $1;"
@@ -146,6 +191,10 @@ fi
 if [[ "$do_create" -eq 1 ]]; then
     execute_query "$(cat $PATH_TO_SCHEMA)"
     echo "Schema for MTS-K created"
+
+    if [[ "$compact" -eq 1 ]]; then
+        create_compact
+    fi
 fi
 
 
@@ -154,7 +203,8 @@ if [[ "$do_stations" -eq 1 ]]; then
     #stations
     if file_exists $PATH_TO_STATIONS; then
         recreate_table $STATIONS_TABLE
-        execute_query "copy $STATIONS_TABLE from '$PATH_TO_STATIONS' with(format csv, delimiter ',', null '', header true);"
+        execute_query "copy $STATIONS_TABLE (id, name, brand, street, house_number, post_code, city, latitude, longitude, first_active, always_open) from '$PATH_TO_STATIONS' with(format csv, delimiter ',', null '', header true);"
+        execute_query "$(cat $PATH_TO_CELLS)"
     else
         echo "File not found $PATH_TO_STATIONS -> doing nothing"
     fi
@@ -163,6 +213,7 @@ if [[ "$do_stations" -eq 1 ]]; then
     if file_exists $PATH_TO_TIMES; then
         recreate_table $TIMES_TABLE
         execute_query "copy $TIMES_TABLE from '$PATH_TO_TIMES' with(format text, delimiter ',', null '', header);"
+        execute_query "$(cat $PATH_TO_OPEN_HOURS)"
     else
         echo "File not found $PATH_TO_TIMES -> doing nothing"
     fi
@@ -172,14 +223,41 @@ fi
 if [[ "$do_prices" -eq 1 ]]; then
     echo "Loading from $start_date/01 to $end_date/01"
 
-    recreate_table $PRICES_TABLE
+    if [[ "$incremental" -eq 1 ]]; then
+        python "$PARALLEL_LOADER" -p "$LOCAL_PRICES_DIR" -j "$([[ $jobs -gt 0 ]] && echo $jobs || echo $DEFAULT_JOBS)" --incremental $([[ $compact -eq 1 ]] && echo --compact) "$start_date" "$end_date"
+    elif [[ "$compact" -eq 1 ]]; then
+        if [[ "$do_create" -eq 0 ]]; then
+            create_compact
+        fi
+        if [[ "$do_rollup" -eq 1 ]]; then
+            recreate_table $ROLLUP_TABLE
+        fi
+        python "$PARALLEL_LOADER" -p "$LOCAL_PRICES_DIR" -j "$([[ $jobs -gt 0 ]] && echo $jobs || echo $DEFAULT_JOBS)" --compact "$start_date" "$end_date"
+    else
+        recreate_table $PRICES_TABLE
+        recreate_table $MANIFEST_TABLE
+        if [[ "$do_rollup" -eq 1 ]]; then
+            recreate_table $ROLLUP_TABLE
+        fi
 
-    run_cmd find "$PRICES_DIR" -type f -name "*-prices.csv" | sort | while read -r file; do
-        file_date=$(basename "$file" | cut -d'-' -f1-3)
+        if [[ "$jobs" -gt 0 ]]; then
+            python "$PARALLEL_LOADER" -p "$LOCAL_PRICES_DIR" -j "$jobs" "$start_date" "$end_date"
+        else
+            run_cmd find "$PRICES_DIR" -type f -name "*-prices.csv" | sort | while read -r file; do
+                file_date=$(basename "$file" | cut -d'-' -f1-3)
 
-        if [[ $(date -d "$file_date" +%s) -ge $(date -d "$start_date/01" +%s) && $(date -d "$file_date" +%s) -lt $(date -d "$end_date/01" +%s) ]]; then
-            execute_query "copy $PRICES_TABLE from '$file' with(format text, delimiter ',', null '', header);"
+                if [[ $(date -d "$file_date" +%s) -ge $(date -d "$start_date/01" +%s) && $(date -d "$file_date" +%s) -lt $(date -d "$end_date/01" +%s) ]]; then
+                    execute_query "copy $PRICES_TABLE from '$file' with(format text, delimiter ',', null '', header);"
+                fi
+
+            done
         fi
+    fi
+
+    execute_query "$([[ $compact -eq 1 ]] && echo "$COMPACT_SEARCH_PATH")$(cat $PATH_TO_CURRENT_PRICES)"
+fi
 
-    done
+#rollup ----------------------------------------
+if [[ "$do_rollup" -eq 1 ]]; then
+    python "$ROLLUP" $([[ $compact -eq 1 ]] && echo --compact)
 fi
\ No newline at end of file
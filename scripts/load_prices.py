@@ -0,0 +1,239 @@
+import os
+import time
+import hashlib
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import psycopg as pg
+from psycopg_pool import ConnectionPool
+
+
+DEFAULT_PRICES_FOLDER = "../data/prices"
+DEFAULT_JOBS = 4
+READ_CHUNK = 1 << 20 #bytes of lines read (and sent) at once
+
+PRICES_TABLE = "prices"
+MANIFEST_TABLE = "prices_manifest"
+PORT = 5432
+COPY_PRICES = f"COPY {PRICES_TABLE} FROM STDIN WITH (FORMAT text, DELIMITER ',', NULL '')"
+
+#compact layout (sql/compact_schema.sql): prices_manifest resolves to compact.prices_manifest through the search_path,
+#files are copied into a staging table and moved to compact.prices_data with their station ids and scaled prices
+COMPACT_OPTIONS = " options='-c search_path=compact,public'"
+COMPACT_PRICES_TABLE = "compact.prices_data"
+STAGING_TABLE = "prices_staging"
+CREATE_STAGING = f"""CREATE TEMPORARY TABLE {STAGING_TABLE} (
+    time timestamp not null, station_uuid uuid, diesel numeric(5,3) not null, e5 numeric(5,3) not null, e10 numeric(5,3) not null,
+    diesel_change smallint not null, e5_change smallint not null, e10_change smallint not null);"""
+COPY_STAGING = f"COPY {STAGING_TABLE} FROM STDIN WITH (FORMAT text, DELIMITER ',', NULL '')"
+REGISTER_STATIONS = """INSERT INTO compact.station_ids (station_uuid)
+    SELECT DISTINCT {column} FROM {table} WHERE {column} NOT IN (SELECT station_uuid FROM compact.station_ids) ORDER BY {column}
+    ON CONFLICT (station_uuid) DO NOTHING;"""
+MOVE_STAGING = f"""INSERT INTO {COMPACT_PRICES_TABLE}
+    SELECT p.time, s.station_id, (p.diesel * 1000)::int, (p.e5 * 1000)::int, (p.e10 * 1000)::int, p.diesel_change, p.e5_change, p.e10_change
+    FROM {STAGING_TABLE} p JOIN compact.station_ids s ON s.station_uuid = p.station_uuid;"""
+
+#columns of a price file: date,station_uuid,diesel,e5,e10,dieselchange,e5change,e10change
+PRICE_IDX, CHANGE_IDX = [2, 3, 4], [5, 6, 7]
+
+
+#----------------------------------------------------------
+def get_real_path(relative_path : str) -> str:
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(script_dir, relative_path)
+
+def get_conn_str(compact : bool = False) -> str:
+    user, user_pswd, db = os.getenv('CEDAR_USER'),os.getenv('CEDAR_PASSWORD'), os.getenv('CEDAR_DB')
+    if not all([user, user_pswd, db]):
+        print("Missing env variables")
+        exit(1)
+    return f"host=localhost port={PORT} user={user} password={user_pswd} dbname={db}" + (COMPACT_OPTIONS if compact else "")
+
+
+# Same filter as sql/cleaning.sql: a changed (1) or new (3) price must not be negative
+def is_negative_price(line : str) -> bool:
+    prices_start = line.find(",", line.find(",") + 1) #skip date and uuid, they contain "-"
+    if "-" not in line[prices_start:]: #the common case
+        return False
+    values = line.rstrip().split(",")
+    return any(values[p].startswith("-") and values[c] in ("1", "3") for p,c in zip(PRICE_IDX, CHANGE_IDX))
+
+
+def list_files(price_folder : str, start_date : str, end_date : str) -> list[str]:
+    price_files : list[tuple[str,str]] = []
+    for root, _, files in os.walk(price_folder):
+        for file in files:
+            if file.endswith("-prices.csv") and start_date <= file.split("-prices.csv")[0] < end_date:
+                price_files.append((file,os.path.join(root, file)))
+
+    return [file for _, file in sorted(price_files)]
+
+
+def file_checksum(file : str) -> str:
+    digest = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(READ_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Time range of a price file (sorted by time) from its first and last row.
+# The db stores the local time and ignores the offset, so we do the same.
+def file_time_range(file : str) -> tuple[str, str] | None:
+    with open(file, 'rb') as f:
+        f.readline() #header
+        first = f.readline()
+        if not first:
+            return None
+        f.seek(max(0, os.path.getsize(file) - 4096))
+        last = f.read().splitlines()[-1]
+    return first[:19].decode(), last[:19].decode()
+
+
+class LoadStats:
+    def __init__(self, n_bytes : int = 0, n_rows : int = 0, n_skipped : int = 0, seconds : float = 0):
+        self.n_bytes, self.n_rows, self.n_skipped, self.seconds = n_bytes, n_rows, n_skipped, seconds
+        self.n_files, self.n_unchanged = 0, 0
+
+    def add(self, other : 'LoadStats'):
+        self.n_bytes += other.n_bytes
+        self.n_rows += other.n_rows
+        self.n_skipped += other.n_skipped
+        self.n_files += 1
+
+    def __str__(self) -> str:
+        mb_s = self.n_bytes / (1 << 20) / self.seconds if self.seconds > 0 else 0
+        rows_s = self.n_rows / self.seconds if self.seconds > 0 else 0
+        return f"{self.n_rows} rows ({self.n_skipped} negative skipped) in {self.seconds:.2f}s -> {mb_s:.1f} MB/s, {rows_s:.0f} rows/s"
+
+
+#----------------------------------------------------------
+def read_manifest(conn_str : str) -> dict[str, str]:
+    with pg.connect(conn_str) as conn:
+        return dict(conn.execute(f"SELECT file, checksum FROM {MANIFEST_TABLE};").fetchall())  # type: ignore
+
+
+# Union of the time range of a file and of the one recorded in the manifest for its previous version
+def replaced_range(cur : pg.Cursor, file : str, time_range : tuple[str, str] | None) -> tuple[datetime, datetime] | None:
+    ranges = [(datetime.fromisoformat(time_range[0]), datetime.fromisoformat(time_range[1]))] if time_range else []
+    previous = cur.execute(f"SELECT min_time, max_time FROM {MANIFEST_TABLE} WHERE file = %s;", (file,)).fetchone()
+    if previous and previous[0] is not None:
+        ranges.append(previous)
+    if len(ranges) == 0:
+        return None
+    return min(r[0] for r in ranges), max(r[1] for r in ranges)
+
+
+# Streams one price file with COPY FROM STDIN, dropping negative prices on the way, and records it in the manifest.
+# Everything runs in one transaction: a file is either loaded completely or not at all.
+# With replace, the rows of the previous version of the file are deleted first: everything in its time range
+# and in the one stored in the manifest (the previous version may have covered more).
+# With compact, the file goes through the staging table into compact.prices_data.
+def copy_file(pool : ConnectionPool, file : str, do_cleaning : bool, replace : bool = False, checksum : str | None = None, compact : bool = False) -> LoadStats:
+    stats = LoadStats(n_bytes=os.path.getsize(file))
+    start = time.perf_counter()
+    checksum = checksum or file_checksum(file)
+    time_range = file_time_range(file)
+
+    with pool.connection() as conn, conn.cursor() as cur:
+        if replace:
+            delete_range = replaced_range(cur, os.path.basename(file), time_range)
+            if delete_range:
+                cur.execute(f"DELETE FROM {COMPACT_PRICES_TABLE if compact else PRICES_TABLE} WHERE time BETWEEN %s AND %s;", delete_range)
+        if compact:
+            cur.execute(CREATE_STAGING)  # type: ignore
+
+        with cur.copy(COPY_STAGING if compact else COPY_PRICES) as copy, open(file, 'r') as f:  # type: ignore
+            f.readline() #header
+            for lines in iter(lambda: f.readlines(READ_CHUNK), []):
+                if do_cleaning:
+                    kept = [line for line in lines if not is_negative_price(line)]
+                    stats.n_skipped += len(lines) - len(kept)
+                    lines = kept
+                copy.write("".join(lines))
+                stats.n_rows += len(lines)
+
+        if compact:
+            cur.execute(REGISTER_STATIONS.format(table=STAGING_TABLE, column="station_uuid"))  # type: ignore
+            cur.execute(MOVE_STAGING)  # type: ignore
+            cur.execute(f"DROP TABLE {STAGING_TABLE};")  # type: ignore
+
+        min_time, max_time = time_range or (None, None)
+        cur.execute(f"DELETE FROM {MANIFEST_TABLE} WHERE file = %s;", (os.path.basename(file),))
+        cur.execute(f"INSERT INTO {MANIFEST_TABLE} VALUES (%s, %s, %s, %s, %s, NOW());", (os.path.basename(file), checksum, stats.n_rows, min_time, max_time))
+
+    stats.seconds = time.perf_counter() - start
+    return stats
+
+
+# Loads a file only if it is new or changed since it was last loaded
+def copy_file_incremental(pool : ConnectionPool, file : str, do_cleaning : bool, manifest : dict[str, str], compact : bool = False) -> LoadStats | None:
+    checksum = file_checksum(file)
+    if manifest.get(os.path.basename(file)) == checksum:
+        return None
+    return copy_file(pool, file, do_cleaning, replace=True, checksum=checksum, compact=compact)
+
+
+# Before the parallel copies: the months of the files get their partitions and the stations loaded since
+# the compact schema was created their ids, so concurrent files rarely register the same station.
+def prepare_compact(conn_str : str, files : list[str]):
+    first_day, last_day = [os.path.basename(file).split("-prices.csv")[0] for file in (files[0], files[-1])]
+    with pg.connect(conn_str) as conn:
+        n_months = conn.execute("SELECT compact.create_partitions(%s, %s);", (first_day, last_day)).fetchone()[0]  # type: ignore
+        conn.execute(REGISTER_STATIONS.format(table="stations", column="id"))  # type: ignore
+    print(f"Compact layout: {n_months} monthly partitions from {first_day} to {last_day}")
+
+
+def load_prices(files : list[str], conn_str : str, jobs : int, do_cleaning : bool, incremental : bool = False, compact : bool = False) -> LoadStats:
+    total = LoadStats()
+    start = time.perf_counter()
+    manifest = read_manifest(conn_str) if incremental else {}
+    if compact:
+        prepare_compact(conn_str, files)
+
+    with ConnectionPool(conn_str, min_size=jobs, max_size=jobs) as pool, ThreadPoolExecutor(jobs) as executor:
+        if incremental:
+            futures = {executor.submit(copy_file_incremental, pool, file, do_cleaning, manifest, compact) : file for file in files}
+        else:
+            futures = {executor.submit(copy_file, pool, file, do_cleaning, False, None, compact) : file for file in files}
+
+        for future in as_completed(futures):
+            stats = future.result()
+            if stats is None:
+                total.n_unchanged += 1
+                continue
+            total.add(stats)
+            print(f"Loaded {os.path.basename(futures[future])}: {stats}")
+
+    total.seconds = time.perf_counter() - start
+    return total
+
+
+def to_date(year_month : str) -> str:
+    return datetime.strptime(year_month, "%Y/%m").strftime("%Y-%m-%d")
+
+def main():
+    parser = argparse.ArgumentParser(description="Loads prices in [start/01, end/01) with parallel COPY FROM STDIN")
+    parser.add_argument('start', type=str, help="year/mm of the first month to load")
+    parser.add_argument('end', type=str, help="year/mm of the first month not to load")
+    parser.add_argument("-p", "--price-folder", type=str, help="Path to the price folder", default=get_real_path(DEFAULT_PRICES_FOLDER))
+    parser.add_argument("-j", "--jobs", type=int, help="Number of files loaded concurrently", default=DEFAULT_JOBS)
+    parser.add_argument("--no-cleaning", action='store_true', help="Keep negative prices (see sql/cleaning.sql)")
+    parser.add_argument("-i", "--incremental", action='store_true', help=f"Load only files that are new or changed according to {MANIFEST_TABLE}")
+    parser.add_argument("-k", "--compact", action='store_true', help=f"Load into the compact layout {COMPACT_PRICES_TABLE} (sql/compact_schema.sql)")
+    args = parser.parse_args()
+
+    files = list_files(args.price_folder, to_date(args.start), to_date(args.end))
+    if len(files) == 0:
+        print(f"0 files found in {args.price_folder}")
+        return
+
+    print(f"Loading {len(files)} files from {files[0]} to {files[-1]} with {args.jobs} jobs")
+    total = load_prices(files, get_conn_str(args.compact), args.jobs, not args.no_cleaning, args.incremental, args.compact)
+    if args.incremental:
+        print(f"{total.n_files} new or changed files, {total.n_unchanged} unchanged")
+    print(f"Total: {total}")
+
+
+if __name__ == "__main__":
+    main()
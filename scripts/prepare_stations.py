@@ -1,12 +1,16 @@
 import csv
 import os
 from datetime import time, datetime
-from typing import Any, TypeAlias
-import requests
-import random
+from typing import Any, Iterable, Iterator, TypeAlias
 import argparse
 import json
 import math
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
+from difflib import SequenceMatcher, get_close_matches
+from geocoding import Geocoder, NOMINATIM_URL, DEFAULT_CACHE_FILE, DEFAULT_RATE
 
 
 RowType : TypeAlias =  dict[str | Any, str | Any]
@@ -15,12 +19,18 @@ STATIONS_HEADER = COLUMNS_TO_KEEP + ['always_open']
 TIMES_HEADER = ['uuid', 'days', 'open_at', 'close_at']
 
 AVOID_STR= ["please delete - bitte loeschen", "Nicht", "mehr aktiv", "", "gelöscht", "Hh Admi-Testkasse", "12345"]
-TIMES : list[RowType] = []
 
 STATION_OUTPUT="stations.csv"
 TIMES_OUTPUT="stations_times.csv"
 JUST_TRIM= False
 
+#what is wrong with a station, and how the fixing phase treats it
+INVALID_COORDS, INVALID_PLZ, INVALID_PLZ_COORDS = "coords", "plz", "plz and coords"
+DO_FIX = {INVALID_COORDS: True, INVALID_PLZ: True, INVALID_PLZ_COORDS: True}
+KEEP_INVALID = {INVALID_COORDS: False, INVALID_PLZ: False, INVALID_PLZ_COORDS: False}
+MAX_PENDING = 1024 #stations held back (in order) while their fixes run
+DEFAULT_WORKERS = 4 #concurrent lookups (requests still respect the rate limit of the geocoder)
+
 #----------------------------------------------------------
 def get_real_path(relative_path : str) -> str:
     script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -46,52 +56,64 @@ def to_str_2(row : RowType) -> str:
     s += f", coords: ({row['latitude']},{row['longitude']})"
     return s
 
-def find_best_match(city : str, possible_cities : list[str]) -> str | None:
-    def normalize_split(city_str : str):
-        s = set(city_str.title().replace("-", " ").replace("/", " ").replace("ß", "ss").replace("ö", "oe").replace("ä", "ae").replace("ü","ue").split())
-        return {word for word in s if len(word) >= 3}
-    
-    if len(possible_cities) == 0:
-        return possible_cities[0]
-    
-    targets = normalize_split(city)
-    for possible_city in possible_cities:
-        possible_substrings = normalize_split(possible_city)
-
-        if targets & possible_substrings:
-            return possible_city
-    
-    return None
+@lru_cache(maxsize=1 << 16)
+def normalize_split(city_str : str) -> frozenset[str]:
+    s = set(city_str.title().replace("-", " ").replace("/", " ").replace("ß", "ss").replace("ö", "oe").replace("ä", "ae").replace("ü","ue").split())
+    return frozenset(word for word in s if len(word) >= 3)
+
+
+class PostcodeIndex:
+    """
+    Cities of every postcode (from the region file) with their normalized words, computed once.
+    A city matches a candidate of its postcode if they share a word (the first candidate in file order wins),
+    with fuzzy_cutoff words that are similar enough (difflib ratio) also count, for misspelled cities.
+    """
+    def __init__(self, fuzzy_cutoff : float | None = None):
+        self.cities : dict[str, dict[str, frozenset[str]]] = {}
+        self.fuzzy_cutoff = fuzzy_cutoff
+
+    @staticmethod
+    def from_file(plz_region_file : str, fuzzy_cutoff : float | None = None) -> 'PostcodeIndex':
+        index = PostcodeIndex(fuzzy_cutoff)
+        with open(plz_region_file, 'r') as input_plz_to_city:
+            for row in csv.DictReader(input_plz_to_city):
+                index.add(row['plz'], row['ort'])
+        return index
+
+    def add(self, plz : str, city : str):
+        candidates = self.cities.setdefault(plz, {})
+        if city not in candidates:
+            candidates[city] = normalize_split(city)
+
+    def __contains__(self, plz : str) -> bool:
+        return plz in self.cities
+
+    def match(self, plz : str, city : str) -> str | None:
+        candidates = self.cities.get(plz, {})
+        targets = normalize_split(city)
+        for possible_city, possible_substrings in candidates.items():
+            if targets & possible_substrings:
+                return possible_city
+
+        return self.fuzzy_match(candidates, targets) if self.fuzzy_cutoff else None
+
+    # candidate with the most similar pair of words, if at least fuzzy_cutoff similar
+    def fuzzy_match(self, candidates : dict[str, frozenset[str]], targets : frozenset[str]) -> str | None:
+        best, best_score = None, self.fuzzy_cutoff or 1.0
+        for possible_city, possible_substrings in candidates.items():
+            for word in possible_substrings:
+                for close in get_close_matches(word, targets, n=1, cutoff=best_score):
+                    score = SequenceMatcher(None, close, word).ratio()
+                    if best is None or score > best_score:
+                        best, best_score = possible_city, score
+        return best
 
 
 #---------------------------------------------------------------------------------
-def query_osm(api_type : str, params : dict[str,Any]) -> Any | Exception:
-    url = f"https://nominatim.openstreetmap.org/{api_type}"
-    user = random.choice(["pippo", "pluto", "paperino"])
-    
-    try:
-        response = requests.get(url, params=params, headers={"User-Agent": user})
-        print(f"\tSending: {response.url}")
-        response.raise_for_status()
-        data = response.json()
-        return data
-        
-    except requests.RequestException as e:
-        print(f"Error querying the Nominatim API: {e}")
-        return Exception(e)
-
-def osm_search(params : dict[str,Any]) -> Any | Exception:
-    return query_osm("search",params)
-
-def osm_reverse(params : dict[str,Any]) -> Any | Exception:
-    return query_osm("reverse",params)
-
-
-
-def query_for_postcode_city(lat: float, lon:float) -> tuple[str,str] | None:
+def query_for_postcode_city(geocoder : Geocoder, lat: float, lon:float) -> tuple[str,str] | None:
     params = {'lat': lat,'lon': lon,"country": "Germany", "format": "json", "addressdetails": 1}
 
-    data = osm_reverse(params)
+    data = geocoder.reverse(params)
     if isinstance(data,Exception):
         return None
 
@@ -108,10 +130,10 @@ def query_for_postcode_city(lat: float, lon:float) -> tuple[str,str] | None:
     return None
 
 
-def query_for_coordinates(post_code : str  = "", city : str = "", street : str = "") -> tuple[float, float] | None:
+def query_for_coordinates(geocoder : Geocoder, post_code : str  = "", city : str = "", street : str = "") -> tuple[float, float] | None:
     params = {'postalcode': post_code, 'city': city, 'street': street,"country": "Germany","format": "json","addressdetails": 1}
 
-    data = osm_search(params)
+    data = geocoder.search(params)
     if isinstance(data,Exception):
         return None
         
@@ -121,13 +143,20 @@ def query_for_coordinates(post_code : str  = "", city : str = "", street : str =
             return lat,lon
         
     if post_code != "" and street != "":
-        return query_for_coordinates(post_code=post_code) #street not found, just take coords of post_code
+        return query_for_coordinates(geocoder, post_code=post_code) #street not found, just take coords of post_code
     else:
         return None
+
+# coordinates from city and street, then post code and city from the coordinates
+def query_for_coordinates_postcode_city(geocoder : Geocoder, row : RowType) -> tuple[tuple[float, float] | None, tuple[str,str] | None]:
+    match_coords = query_for_coordinates(geocoder, city=row['city'], street=row['street'])
+    if match_coords is None:
+        return None, None
+    return match_coords, query_for_postcode_city(geocoder, match_coords[0], match_coords[1])
     
 #---------------------------------------------------------------------------------
 
-def add_stations_time(st_time, stations_id):
+def parse_stations_time(st_time, stations_id) -> list[RowType]:
     def to_time(time_str : str) -> time:
         try:
             return datetime.strptime(time_str, "%H:%M:%S").time()
@@ -151,20 +180,19 @@ def add_stations_time(st_time, stations_id):
         else:
             merged.append((days, open,close))
             
-    for d,o,c in merged:       
-        TIMES.append({'uuid': stations_id, 'days': d, 'open_at': o, 'close_at': c})
+    return [{'uuid': stations_id, 'days': d, 'open_at': o, 'close_at': c} for d,o,c in merged]
 
 
 
-def parse_row(row : RowType) -> RowType:
+# station row (STATIONS_HEADER) and its rows of opening times (TIMES_HEADER)
+def parse_row(row : RowType) -> tuple[RowType, list[RowType]]:
         filter_row = {key : row.get(key, '') for key in COLUMNS_TO_KEEP}
 
         openingTimes = json.loads(row['openingtimes_json'])
         filter_row['always_open'], filter_row['brand']  = 'openingTimes' not in openingTimes , filter_row['brand'].title()
-        if not filter_row['always_open']:
-            add_stations_time(openingTimes, filter_row['uuid'])
+        times = [] if filter_row['always_open'] else parse_stations_time(openingTimes, filter_row['uuid'])
 
-        return filter_row
+        return filter_row, times
 
 
 def are_coords_correct(row : RowType) -> bool:
@@ -173,159 +201,179 @@ def are_coords_correct(row : RowType) -> bool:
     
     return is_point_in_germany(row)
 
-def prepare_stations(stations_dataset :str, plz_region_file : str,  output :str):
-    tmp_out_file = 'data_temp.csv'
-    plz_to_cities : dict[str, list[str]] = {}
-    with open(plz_region_file, 'r') as input_plz_to_city:
-            reader_plz_city = csv.DictReader(input_plz_to_city)  
-            for row in reader_plz_city:
-                plz, city = row['plz'], row['ort']
-        
-                if plz in plz_to_cities:
-                    if city not in plz_to_cities[plz]:
-                        plz_to_cities[plz].append(city)
-                else:
-                    plz_to_cities[plz] = [city]
+@dataclass
+class PrepareStats:
+    skipped : int = 0
+    invalid : dict[str, int] = field(default_factory=dict)
+    okay_fixes : int = 0
+    not_okay_fixes : int = 0
+    latest_active : str = ""
 
 
+# rows of the stations dataset, valid ones with their city matched, others with what is wrong with them
+def validate(rows : Iterable[RowType], plz_index : PostcodeIndex, stats : PrepareStats) -> Iterator[tuple[str | None, RowType]]:
+    for row in rows:
+        stats.latest_active = row['first_active']
+        plz, city = row['post_code'], row['city']
 
-    
-    latest_active : str = ""
-    with open(tmp_out_file,'w+') as outfile:
+        if not plz.isdigit() or plz in ['12345', '00000']:
+            print(f"Skipping {to_str_1(row)}")
+            stats.skipped += 1
+            continue
+
+        if len(plz) < 5:
+            plz = "0"*(5-len(plz)) + plz
+
+        if are_coords_correct(row):
+            if plz in plz_index: #plz is correct
+                match = plz_index.match(plz, city) #find best candidate
+                row['city'] = match if match else row['city'] #otherwise keep old
+                yield None, row
+                continue
+            problem = INVALID_PLZ #NEED TO CORRECT PLZ?
+        else:
+            problem = INVALID_COORDS if plz in plz_index else INVALID_PLZ_COORDS #NEED TO CORRECT (COORDS)
+
+        stats.invalid[problem] = stats.invalid.get(problem, 0) + 1
+        yield problem, row
+
+
+#fixing phase, using OSM ---------------------------------
+def lookup_fix(geocoder : Geocoder, problem : str, row : RowType) -> Any:
+    if problem == INVALID_COORDS:
+        return query_for_coordinates(geocoder, row['post_code'], row['city'], row['street'])
+    if problem == INVALID_PLZ:
+        return query_for_postcode_city(geocoder, float(row['latitude']),float(row['longitude']))
+    return query_for_coordinates_postcode_city(geocoder, row)
+
+
+# applies the answer of lookup_fix to row, True if it was fixed
+def apply_fix(problem : str, row : RowType, match : Any) -> bool:
+    if problem == INVALID_COORDS:
+        if match:
+            print(f"\tFOUND coord: {match[0]}, {match[1]}")
+            row['latitude'], row['longitude'] = match
+        else:
+            print(f"\tNOT FOUND coords!")
+        return bool(match)
+
+    if problem == INVALID_PLZ:
+        if match:
+            print(f"\tFOUND zip,city: {match[0]}, {match[1]}")
+            row['post_code'], row['city'] = match
+        else:
+            print(f"\tNOT FOUND info!")
+        return bool(match)
+
+    match_coords, match_info = match
+    if match_coords:
+        print(f"\tFOUND coords: {match_coords[0]}, {match_coords[1]}")
+        row['latitude'], row['longitude'] = match_coords
+        if match_info:
+            print(f"\tFOUND zip,city: {match_info[0]}, {match_info[1]}")
+            row['post_code'], row['city'] = match_info
+    else:
+        print(f"\tNOT FOUND coords!")
+    return bool(match_coords)
+
+
+def resolve(problem : str | None, row : RowType, lookup : Future | None, stats : PrepareStats) -> Iterator[RowType]:
+    if problem is None:
+        yield row
+        return
+
+    print(f"Invalid {problem}: {to_str_2(row)}")
+    if lookup is None: #not fixing
+        if KEEP_INVALID[problem]:
+            yield row
+        return
+
+    if apply_fix(problem, row, lookup.result()):
+        stats.okay_fixes += 1
+        yield row
+    else:
+        stats.not_okay_fixes += 1
+        if KEEP_INVALID[problem]:
+            yield row
+
+
+# Rows to write, in the order of the dataset. The lookups of invalid rows run on workers threads (through the rate limited and cached geocoder),
+# at most max_pending rows wait for them. Without a geocoder invalid rows are not fixed.
+def fix(validated : Iterable[tuple[str | None, RowType]], geocoder : Geocoder | None, stats : PrepareStats, max_pending : int = MAX_PENDING,
+        workers : int = DEFAULT_WORKERS) -> Iterator[RowType]:
+    executor = ThreadPoolExecutor(workers if geocoder else 1)
+    window : deque[tuple[str | None, RowType, Future | None]] = deque()
+    try:
+        for problem, row in validated:
+            lookup = executor.submit(lookup_fix, geocoder, problem, row) if problem and geocoder and DO_FIX[problem] else None
+            window.append((problem, row, lookup))
+
+            while window and (len(window) >= max_pending or window[0][2] is None or window[0][2].done()):
+                yield from resolve(*window.popleft(), stats)
+
+        while window:
+            yield from resolve(*window.popleft(), stats)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+#---------------------------------------------------------------------------------
+def prepare(stations_iter : Iterable[RowType], plz_index : PostcodeIndex, geocoder : Geocoder | None = None,
+            stats : PrepareStats | None = None, max_pending : int = MAX_PENDING, workers : int = DEFAULT_WORKERS) -> Iterator[tuple[RowType, list[RowType]]]:
+    """
+    Prepares the rows of a stations dataset (as read by csv.DictReader) one at a time: parse -> validate -> fix -> emit.
+    Yields the prepared station and its opening times, in the order of the dataset; counters end up in stats.
+    """
+    stats = stats if stats is not None else PrepareStats()
+    for row in fix(validate(stations_iter, plz_index, stats), geocoder, stats, max_pending, workers):
+        yield parse_row(row)
+
+
+def prepare_stations(stations_dataset :str, plz_region_file : str, output :str, times_output : str,
+                     geocoder : Geocoder | None = None, fuzzy_cutoff : float | None = None, workers : int = DEFAULT_WORKERS) -> PrepareStats:
+    tmp_out_file, tmp_times_file = f"{output}.tmp", f"{times_output}.tmp"
+    plz_to_cities = PostcodeIndex.from_file(plz_region_file, fuzzy_cutoff)
+    stats = PrepareStats()
+
+    with open(stations_dataset, mode='r', newline='') as infile, open(tmp_out_file,'w+') as outfile, open(tmp_times_file,'w+') as times_outfile:
         writer = csv.DictWriter(outfile, fieldnames=STATIONS_HEADER)
         writer.writeheader()
+        times_writer = csv.DictWriter(times_outfile, fieldnames=TIMES_HEADER)
+        times_writer.writeheader()
 
-        invalid_plz : list[RowType] = [] 
-        invalid_coord : list[RowType] = []
-        invalid_plz_coord : list[RowType] = []
-
-        with open(stations_dataset, mode='r', newline='') as infile:
-            reader = csv.DictReader(infile) 
-            for row in reader:                    
-                latest_active = row['first_active']
-                plz, city = row['post_code'], row['city']
-
-                if not plz.isdigit() or plz in ['12345', '00000']:
-                    print(f"Skipping {to_str_1(row)}")
-                    continue
-                                
-                if len(plz) < 5:
-                    plz = "0"*(5-len(plz)) + plz
-
-                if are_coords_correct(row):
-                    if plz in plz_to_cities: #plz is correct
-                        match = find_best_match(city,plz_to_cities[plz]) #find best candidate
-                        row['city'] = match if match else row['city'] #otherwise keep old
-                        writer.writerow(parse_row(row)) #WRITE TO RESULT
-                    else:
-                        invalid_plz.append(row) #NEED TO CORRECT PLZ?
-                else:
-                    if plz in plz_to_cities: #plz is correct
-                        invalid_coord.append(row) #NEED TO CORRECT COORDS       
-                    else:
-                        invalid_plz_coord.append(row) #NEED TO CORRECT
+        for station, times in prepare(csv.DictReader(infile), plz_to_cities, geocoder, stats, workers=workers):
+            writer.writerow(station) #WRITE TO RESULT
+            times_writer.writerows(times)
 
-        
-        #fixing phase, using OSM ---------------------------------
-        DO_FIX_COORDS, KEEP_INVALID_COORDS= True, False
-        DO_FIX_PLZ, KEEP_INVALID_PLZ= True, False
-        DO_FIX_PLZ_COORDS, KEEP_INVALID_PLZ_COORDS= True, False
-        
-        okay_fixes, not_okay_fixes = 0,0
-
-        print(f"\nINVALID COORDS: {len(invalid_coord)}")
-        for row in invalid_coord:
-            print(f"Invalid coords: {to_str_2(row)}")
-            if DO_FIX_COORDS:
-                match = query_for_coordinates(row['post_code'], row['city'], row['street'])
-
-                if match:
-                    print(f"\tFOUND coord: {match[0]}, {match[1]}")
-                    row['latitude'], row['longitude'] = match
-                    okay_fixes += 1
-                    
-                else:
-                    print(f"\tNOT FOUND coords!")
-                    not_okay_fixes += 1
-                
-                if match or KEEP_INVALID_COORDS:
-                    writer.writerow(parse_row(row)) #WRITE TO RESULT
-
-            elif KEEP_INVALID_COORDS:
-                    writer.writerow(parse_row(row)) #WRITE TO RESULT
-                 
-        
-        print(f"\nINVALID PLZ: {len(invalid_plz)}")
-        for row in invalid_plz:
-            print(f"Invalid plz: {to_str_2(row)}")
-            if DO_FIX_PLZ:
-                match = query_for_postcode_city(float(row['latitude']),float(row['longitude']))
-                            
-                if match:
-                    print(f"\tFOUND zip,city: {match[0]}, {match[1]}")
-                    row['post_code'], row['city'] = match
-                    okay_fixes += 1
-                else:
-                    print(f"\tNOT FOUND info!")
-                    not_okay_fixes += 1
-                
-                if match or KEEP_INVALID_PLZ:
-                    writer.writerow(parse_row(row)) #WRITE TO RESULT
-
-            elif KEEP_INVALID_PLZ:
-                    writer.writerow(parse_row(row)) #WRITE TO RESULT
-             
-
-        print(f"\nINVALID PLZ AND COORD: {len(invalid_plz_coord)}")
-        for row in invalid_plz_coord:
-            print(f"Invalid plz and coord: {to_str_2(row)}")
-            if DO_FIX_PLZ_COORDS:
-                match_coords = query_for_coordinates(city=row['city'], street=row['street'])
-                if match_coords:
-                    print(f"\tFOUND coords: {match_coords[0]}, {match_coords[1]}")
-                    row['latitude'], row['longitude'] = match_coords
-                    match_info = query_for_postcode_city(float(row['latitude']),float(row['longitude']))
-                    if match_info:
-                        print(f"\tFOUND zip,city: {match_info[0]}, {match_info[1]}")
-                        row['post_code'], row['city'] = match_info
-
-                    okay_fixes += 1
-                else:
-                    print(f"\tNOT FOUND coords!")
-                    not_okay_fixes += 1
-
-                if match_coords or KEEP_INVALID_PLZ_COORDS:
-                    writer.writerow(parse_row(row)) #WRITE TO RESULT
-
-            elif KEEP_INVALID_PLZ_COORDS:
-                    writer.writerow(parse_row(row)) #WRITE TO RESULT
-
-    print(f"Status of Fixed: OK: {okay_fixes} , NOT OKAY: {not_okay_fixes}")
-    print(f"Last station insert in dataset active from {latest_active}")
+    print(f"\nSkipped: {stats.skipped}, INVALID: {stats.invalid}")
+    print(f"Status of Fixed: OK: {stats.okay_fixes} , NOT OKAY: {stats.not_okay_fixes}")
+    print(f"Last station insert in dataset active from {stats.latest_active}")
     os.replace(tmp_out_file,output)
-        
+    os.replace(tmp_times_file,times_output)
+    return stats
 
 
 def main():
     parser = argparse.ArgumentParser(description="Usage: <station_file> <region_file>")
     parser.add_argument('station_file', type=str, help="station input file")
     parser.add_argument('region_file', type=str, help="region input file")
+    parser.add_argument('--geocoder-url', type=str, help="Nominatim (or compatible) server used to fix stations", default=os.getenv('NOMINATIM_URL', NOMINATIM_URL))
+    parser.add_argument('--geocoding-cache', type=str, help="sqlite file caching the geocoding answers", default=get_real_path(DEFAULT_CACHE_FILE))
+    parser.add_argument('--rate', type=float, help="max geocoding requests per second", default=DEFAULT_RATE)
+    parser.add_argument('-j', '--jobs', type=int, help="concurrent geocoding requests", default=DEFAULT_WORKERS)
+    parser.add_argument('--fuzzy', type=float, metavar='CUTOFF', help="also match cities with a word at least CUTOFF similar (0-1, e.g. 0.85) to a city of the postcode", default=None)
     args = parser.parse_args()
 
-    stations_output_file = os.path.join(os.path.dirname(args.station_file),STATION_OUTPUT)
-    prepare_stations(args.station_file,args.region_file, stations_output_file)
-    print(f'Stations dataset ready in {stations_output_file}')
+    geocoder = Geocoder(args.geocoder_url, args.geocoding_cache, args.rate)
 
+    stations_output_file = os.path.join(os.path.dirname(args.station_file),STATION_OUTPUT)
     times_output_file = os.path.join(os.path.dirname(args.station_file),TIMES_OUTPUT)
-    with open(times_output_file,'w+') as outfile:
-        writer = csv.DictWriter(outfile, fieldnames=TIMES_HEADER) 
-        writer.writeheader()
-        
-        for row in TIMES:
-            writer.writerow(row)
+    prepare_stations(args.station_file,args.region_file, stations_output_file, times_output_file, geocoder, args.fuzzy, args.jobs)
+    geocoder.close()
 
+    print(f'Stations dataset ready in {stations_output_file} (geocoding {geocoder.stats()})')
     print(f'Stations Times ready in {times_output_file}')
 
-    
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
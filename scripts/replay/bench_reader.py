@@ -0,0 +1,53 @@
+import time
+import argparse
+from csv import DictReader
+from datetime import datetime
+
+from prices_reader import read_batches
+
+
+# the original replay path: one dict and one datetime per row
+def dict_reader(file : str) -> tuple[int, int]:
+    n_rows, n_batches = 0, 0
+    current_time = None
+    with open(file, 'r') as f:
+        for row in DictReader(f):
+            row_time = datetime.fromisoformat(row['date'])
+            if row_time != current_time:
+                current_time = row_time
+                n_batches += 1
+            n_rows += 1
+    return n_rows, n_batches
+
+
+def batch_reader(file : str) -> tuple[int, int]:
+    n_rows, n_batches = 0, 0
+    for batch in read_batches(file):
+        n_rows += len(batch)
+        n_batches += 1
+    return n_rows, n_batches
+
+
+READERS = {'DictReader': dict_reader, 'read_batches': batch_reader}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the DictReader path with prices_reader on a price file")
+    parser.add_argument("file", type=str, help="a (one-day) *-prices.csv file")
+    parser.add_argument("-r", "--repeat", type=int, help="Runs per reader (best is reported)", default=3)
+    args = parser.parse_args()
+
+    baseline = None
+    for name, reader in READERS.items():
+        best = float('inf')
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            n_rows, n_batches = reader(args.file)
+            best = min(best, time.perf_counter() - start)
+
+        baseline = baseline or best
+        print(f"{name:<24} {n_rows} rows, {n_batches} batches in {best:.3f}s -> {n_rows / best:,.0f} rows/s ({baseline / best:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+METRICS_PATH = "/metrics"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8" #prometheus text format
+
+INSERT_ROWS_BUCKETS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 10000]
+INSERT_SECONDS_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+READ_SECONDS_BUCKETS = [0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005, 0.01, 0.1]
+
+
+class Histogram:
+    """Cumulative histogram in the prometheus format: count of observations <= every bucket bound, sum and count"""
+    def __init__(self, name : str, help : str, buckets : list[float]):
+        self.name, self.help, self.buckets = name, help, buckets
+        self.counts = [0] * (len(buckets) + 1) #last one is +Inf
+        self.sum, self.count = 0.0, 0
+
+    def observe(self, value : float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets + [float('inf')], self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{"+Inf" if bound == float("inf") else bound}"}} {cumulative}')
+        lines += [f"{self.name}_sum {self.sum}", f"{self.name}_count {self.count}"]
+        return lines
+
+
+class ReplayMetrics:
+    """
+    Counters, gauges and histograms of the replay, updated by the scheduler and rendered for prometheus
+    (rows/s is rate(replay_rows_inserted_total[...]), latency percentiles histogram_quantile over the buckets).
+    """
+    COUNTERS = {
+        'replay_rows_inserted_total': "Price updates inserted",
+        'replay_inserts_total': "Insert transactions committed",
+        'replay_batches_merged_total': "Batches inserted together with an earlier one to catch up",
+        'replay_batches_dropped_total': "Batches dropped to get back to real time",
+        'replay_rows_dropped_total': "Price updates dropped to get back to real time",
+    }
+    GAUGES = {
+        'replay_lag_seconds': "Seconds behind schedule of the virtual time when the last insert started",
+        'replay_virtual_time_seconds': "Epoch of the last inserted batch (virtual time)",
+        'replay_speed_factor': "Speed factor of the replay, 0 for max",
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values : dict[str, float] = {name : 0 for name in list(self.COUNTERS) + list(self.GAUGES)}
+        self.insert_rows = Histogram('replay_insert_rows', "Price updates per insert transaction", INSERT_ROWS_BUCKETS)
+        self.insert_seconds = Histogram('replay_insert_seconds', "Seconds from the start of an insert to its commit", INSERT_SECONDS_BUCKETS)
+        self.read_seconds = Histogram('replay_read_seconds', "Seconds to read and parse a batch from the price files", READ_SECONDS_BUCKETS)
+
+    def observe_insert(self, rows : int, batches : int, seconds : float, lag : float, virtual_epoch : float):
+        with self.lock:
+            self.values['replay_rows_inserted_total'] += rows
+            self.values['replay_inserts_total'] += 1
+            self.values['replay_batches_merged_total'] += batches - 1
+            self.values['replay_lag_seconds'] = lag
+            self.values['replay_virtual_time_seconds'] = virtual_epoch
+            self.insert_rows.observe(rows)
+            self.insert_seconds.observe(seconds)
+
+    def observe_drop(self, rows : int, lag : float):
+        with self.lock:
+            self.values['replay_batches_dropped_total'] += 1
+            self.values['replay_rows_dropped_total'] += rows
+            self.values['replay_lag_seconds'] = lag
+
+    def observe_read(self, seconds : float):
+        with self.lock:
+            self.read_seconds.observe(seconds)
+
+    def set_speed(self, speed : float | None):
+        with self.lock:
+            self.values['replay_speed_factor'] = speed or 0
+
+    def render(self) -> str:
+        with self.lock:
+            lines = []
+            for kind, metrics in (('counter', self.COUNTERS), ('gauge', self.GAUGES)):
+                for name, help in metrics.items():
+                    lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}", f"{name} {self.values[name]}"]
+            for histogram in (self.insert_rows, self.insert_seconds, self.read_seconds):
+                lines += histogram.lines()
+        return "\n".join(lines) + "\n"
+
+
+# Serves the metrics on http://0.0.0.0:port/metrics from a daemon thread, until the process exits
+def serve_metrics(metrics : ReplayMetrics, port : int) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != METRICS_PATH:
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args): #no line per scrape
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
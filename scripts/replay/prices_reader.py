@@ -0,0 +1,67 @@
+import csv
+import io
+from datetime import datetime
+from typing import Iterator, TypeAlias
+
+from resume_index import seek_offset
+
+
+PRICE_COLUMNS = ['date', 'station_uuid', 'diesel', 'e5', 'e10', 'dieselchange', 'e5change', 'e10change']
+PRICE_SCALE = 1000 #prices are stored as integers in tenths of a cent (1.759 -> 1759)
+
+PriceRow : TypeAlias = list[str]  #one line of a price file, in PRICE_COLUMNS order
+
+
+def to_epoch(date : str) -> int:
+    return int(datetime.fromisoformat(date).timestamp())
+
+def to_scaled_price(price : str) -> int:
+    return round(float(price) * PRICE_SCALE)
+
+
+class PriceBatch:
+    """All the updates of a price file sharing the same timestamp"""
+    __slots__ = ('date', 'epoch', 'rows')
+
+    def __init__(self, date : str, rows : list[PriceRow]):
+        self.date, self.rows = date, rows
+        self.epoch = to_epoch(date)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @property
+    def time(self) -> datetime:
+        return datetime.fromisoformat(self.date)
+
+
+# Streams a price file as batches of rows with the same timestamp (files are sorted by time).
+# Rows are kept as the lists of strings read by csv.reader (PriceRow), only the timestamp is parsed, once per batch.
+# With after_epoch, it seeks (through the resume index) straight to the first batch after it.
+def read_batches(file : str, after_epoch : float | None = None) -> Iterator[PriceBatch]:
+    with open(file, 'rb') as raw:
+        first_line = raw.readline()
+        if not first_line:
+            return
+        header = next(csv.reader([first_line.decode()]))
+        if header != PRICE_COLUMNS:
+            raise ValueError(f"Unexpected header in {file}: {header}")
+
+        if after_epoch is not None:
+            raw.seek(seek_offset(file, after_epoch))
+
+        with io.TextIOWrapper(raw, newline='') as f:
+            yield from group_batches(csv.reader(f))
+
+
+def group_batches(reader : Iterator[PriceRow]) -> Iterator[PriceBatch]:
+    date, rows = "", []
+    for row in reader:
+        if row[0] != date:
+            if len(rows) > 0:
+                yield PriceBatch(date, rows)
+            date, rows = row[0], []
+        rows.append(row)
+
+    if len(rows) > 0:
+        yield PriceBatch(date, rows)
@@ -1,13 +1,22 @@
 import os
-import time
-from csv import DictReader
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 import argparse
+import threading
+from queue import Queue
+from typing import Iterator
 import psycopg as pg 
 
+from prices_reader import PriceBatch, PriceRow, read_batches, to_scaled_price
+from resume_index import list_price_files
+from rollup import HOUR, ROLLUP_TABLE, floor_hour, roll_up
+from metrics import ReplayMetrics, serve_metrics, METRICS_PATH
+from scheduler import DEFAULT_MAX_LAG, DEFAULT_POLICY, DEFAULT_PROGRESS_INTERVAL, POLICIES, ReplayScheduler, parse_speed
+
 
 DEFUALT_PRICES_FOLDER= "../../data/prices"
 DEFAULT_SPEED_FACTOR = 1
+DEFAULT_WORKERS = 1
+DEFAULT_METRICS_PORT = 9108
 
 PRICES_TABLE="prices"
 PORT=5432
@@ -20,110 +29,330 @@ if not all([USER,USER_PSWD, DB]):
     
 
 CONN_STR = f"host=localhost port={PORT} user={USER} password={USER_PSWD} dbname={DB}"
+COMPACT_OPTIONS = " options='-c search_path=compact,public'" #prices is the view of the compact layout (sql/compact_schema.sql)
+
 
+INSERT_COLUMNS = "time, station_uuid, diesel, e5, e10, diesel_change, e5_change, e10_change" #same order as PRICE_COLUMNS
+INSERT_MODES = ['row', 'batch', 'copy']
+DEFAULT_INSERT_MODE = 'row'
 
-def insert_row(row : dict[str,str]) -> str:
+
+def insert_row(row : PriceRow) -> str:
+    date, station_uuid, diesel, e5, e10, diesel_change, e5_change, e10_change = row
     return f"""
             INSERT INTO {PRICES_TABLE} (
                 time, station_uuid, diesel, e5, e10, diesel_change, e5_change, e10_change
             ) VALUES (
-                '{row['date']}', '{row['station_uuid']}', 
-                {row['diesel']}, {row['e5']}, {row['e10']}, 
-                {row['dieselchange']}, {row['e5change']}, {row['e10change']}
+                '{date}', '{station_uuid}', 
+                {diesel}, {e5}, {e10}, 
+                {diesel_change}, {e5_change}, {e10_change}
             );
         """
 
 
-def transactional_workload(files : list[str], speed_factor : int, start_time : datetime):
-    print(f"Similating Workload: from {files[0]} to {files[-1]} , start_time : {start_time}")   
+# one statement (and one round trip) per row
+def insert_rows_row(conn : pg.Connection, rows : list[PriceRow]):
+    for entry in rows:
+        conn.execute(insert_row(entry))  # type: ignore
+
+# one prepared statement, all rows sent in a single pipeline
+def insert_rows_batch(conn : pg.Connection, rows : list[PriceRow]):
+    with conn.cursor() as cur, conn.pipeline():
+        cur.executemany(f"INSERT INTO {PRICES_TABLE} ({INSERT_COLUMNS}) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)", rows)
+
+# all rows streamed with COPY FROM STDIN
+def insert_rows_copy(conn : pg.Connection, rows : list[PriceRow]):
+    with conn.cursor() as cur:
+        with cur.copy(f"COPY {PRICES_TABLE} ({INSERT_COLUMNS}) FROM STDIN") as copy:  # type: ignore
+            for row in rows:
+                copy.write_row(row)
+
+INSERT_FUNCTIONS = {'row': insert_rows_row, 'batch': insert_rows_batch, 'copy': insert_rows_copy}
+
+
+COMPACT_PRICES_TABLE = "compact.prices_data"
+REGISTER_STATION = "INSERT INTO compact.station_ids (station_uuid) VALUES (%s) ON CONFLICT (station_uuid) DO NOTHING"
+
+class StationIds:
+    """station_uuid -> station_id of compact.station_ids, registering unknown stations on the way"""
+    def __init__(self, conn : pg.Connection):
+        self.ids : dict[str, int] = dict(conn.execute("SELECT station_uuid::text, station_id FROM compact.station_ids;").fetchall())  # type: ignore
+
+    def get(self, conn : pg.Connection, uuids : list[str]) -> list[int]:
+        unknown = sorted({uuid for uuid in uuids if uuid not in self.ids})
+        if len(unknown) > 0:
+            with conn.cursor() as cur:
+                cur.executemany(REGISTER_STATION, [(uuid,) for uuid in unknown])
+                cur.execute("SELECT station_uuid::text, station_id FROM compact.station_ids WHERE station_uuid = ANY(%s::uuid[]);", (unknown,))
+                self.ids.update(cur.fetchall())  # type: ignore
+        return [self.ids[uuid] for uuid in uuids]
+
+
+# rows as compact.prices_data rows: station ids and prices in tenths of a cent
+def compact_rows(conn : pg.Connection, rows : list[PriceRow], station_ids : StationIds) -> list[tuple]:
+    ids = station_ids.get(conn, [row[1] for row in rows])
+    return [(row[0], station_id, to_scaled_price(row[2]), to_scaled_price(row[3]), to_scaled_price(row[4]), row[5], row[6], row[7])
+            for row, station_id in zip(rows, ids)]
+
+def insert_compact_row(conn : pg.Connection, rows : list[tuple]):
+    for entry in rows:
+        conn.execute(f"INSERT INTO {COMPACT_PRICES_TABLE} VALUES (%s, %s, %s, %s, %s, %s, %s, %s)", entry)
+
+def insert_compact_batch(conn : pg.Connection, rows : list[tuple]):
+    with conn.cursor() as cur, conn.pipeline():
+        cur.executemany(f"INSERT INTO {COMPACT_PRICES_TABLE} VALUES (%s, %s, %s, %s, %s, %s, %s, %s)", rows)
+
+def insert_compact_copy(conn : pg.Connection, rows : list[tuple]):
+    with conn.cursor() as cur:
+        with cur.copy(f"COPY {COMPACT_PRICES_TABLE} FROM STDIN") as copy:  # type: ignore
+            for row in rows:
+                copy.write_row(row)
+
+INSERT_COMPACT_FUNCTIONS = {'row': insert_compact_row, 'batch': insert_compact_batch, 'copy': insert_compact_copy}
+
+
+CURRENT_PRICES_TABLE = "current_prices"
+UPSERT_CURRENT_PRICE = f"""
+    INSERT INTO {CURRENT_PRICES_TABLE} AS cp (station_id, last_update, diesel, diesel_time, e5, e5_time, e10, e10_time)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (station_id) DO UPDATE SET
+        last_update = GREATEST(cp.last_update, excluded.last_update),
+        diesel = COALESCE(excluded.diesel, cp.diesel), diesel_time = COALESCE(excluded.diesel_time, cp.diesel_time),
+        e5 = COALESCE(excluded.e5, cp.e5), e5_time = COALESCE(excluded.e5_time, cp.e5_time),
+        e10 = COALESCE(excluded.e10, cp.e10), e10_time = COALESCE(excluded.e10_time, cp.e10_time)
+"""
+
+# last update of the station and, for every fuel with a changed (1) or new (3) price, its price and time (None keeps the current one)
+def current_price_row(row : PriceRow) -> tuple:
+    date, station_uuid, diesel, e5, e10, diesel_change, e5_change, e10_change = row
+    fuels = [(price, date) if change in ('1', '3') else (None, None) for price, change in [(diesel, diesel_change), (e5, e5_change), (e10, e10_change)]]
+    return (station_uuid, date, *fuels[0], *fuels[1], *fuels[2])
+
+def upsert_current_prices(conn : pg.Connection, rows : list[PriceRow]):
+    with conn.cursor() as cur, conn.pipeline():
+        cur.executemany(UPSERT_CURRENT_PRICE, [current_price_row(row) for row in rows])
+
+
+# inserts the rows (and updates current_prices) in one transaction
+def insert_rows(conn : pg.Connection, rows : list[PriceRow], insert_mode : str, current_prices : bool = False, station_ids : StationIds | None = None):
+    if station_ids is not None:
+        INSERT_COMPACT_FUNCTIONS[insert_mode](conn, compact_rows(conn, rows, station_ids))
+    else:
+        INSERT_FUNCTIONS[insert_mode](conn, rows)
+    if current_prices:
+        upsert_current_prices(conn, rows)
+    conn.commit()
+
+
+def shard_of(station_uuid : str, n_shards : int) -> int:
+    return int(station_uuid[:8], 16) % n_shards
+
+
+class ShardedInserter:
+    """
+    Inserts each batch through n_workers connections, sharding rows by station_uuid.
+    A station always goes to the same worker and insert() returns only once every
+    worker committed its slice, so per-station ordering is kept across time steps.
+    With a single worker rows are inserted directly by the caller.
+    With compact, rows go to the compact layout, every connection with its own cache of station ids.
+    """
+    def __init__(self, n_workers : int, insert_mode : str, current_prices : bool = False, compact : bool = False):
+        self.n_workers, self.insert_mode, self.current_prices, self.compact = n_workers, insert_mode, current_prices, compact
+        self.conn : pg.Connection | None = None
+        self.station_ids : StationIds | None = None
+        self.jobs : list[Queue] = []
+        self.threads : list[threading.Thread] = []
+        self.errors : list[Exception] = []
+
+        conn_str = CONN_STR + COMPACT_OPTIONS if compact else CONN_STR
+        if n_workers == 1:
+            self.conn = pg.connect(conn_str)
+            self.station_ids = StationIds(self.conn) if compact else None
+            return
+        
+        for _ in range(n_workers):
+            jobs : Queue = Queue()
+            thread = threading.Thread(target=self._work, args=(pg.connect(conn_str), jobs), daemon=True)
+            thread.start()
+            self.jobs.append(jobs)
+            self.threads.append(thread)
+
+    def _work(self, conn : pg.Connection, jobs : Queue):
+        with conn:
+            station_ids = StationIds(conn) if self.compact else None
+            while True:
+                rows = jobs.get()
+                try:
+                    if rows is None:
+                        return
+                    insert_rows(conn, rows, self.insert_mode, self.current_prices, station_ids)
+                except Exception as e:
+                    self.errors.append(e)
+                finally:
+                    jobs.task_done()
 
-    start_time = start_time.replace(tzinfo=timezone.utc)
+    def insert(self, rows : list[PriceRow]):
+        if self.conn is not None:
+            insert_rows(self.conn, rows, self.insert_mode, self.current_prices, self.station_ids)
+            return
+
+        shards : list[list[PriceRow]] = [[] for _ in range(self.n_workers)]
+        for row in rows:
+            shards[shard_of(row[1], self.n_workers)].append(row)
+
+        for jobs, shard in zip(self.jobs, shards):
+            if len(shard) > 0:
+                jobs.put(shard)
+        for jobs in self.jobs:
+            jobs.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+        for jobs in self.jobs:
+            jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def first_of_month(t : datetime) -> datetime:
+    return floor_hour(t).replace(day=1, hour=0)
+
+# partitions of the month of t and of the next one (created ahead, while no worker is inserting into it yet)
+def create_partitions(conn : pg.Connection, t : datetime) -> int:
+    n_months = conn.execute("SELECT compact.create_partitions(%s, %s);", (first_of_month(t), first_of_month(t) + timedelta(days=31))).fetchone()[0]  # type: ignore
+    conn.commit()
+    return n_months
+
+
+# batches of the files after start_epoch, seeking straight to it in the first file
+def batches_after(files : list[str], start_epoch : float) -> Iterator[PriceBatch]:
     found_start = False
-    with pg.connect(CONN_STR) as conn:
-        for file in files:
-            print(f"\nReading file: {file}")
-            with open(file, 'r') as f:
-                reader = DictReader(f)
-
-                to_insert = []  # Buffer rows to insert
-                for row in reader:
-                    row_time = datetime.fromisoformat(row['date'])
-
-                    if not found_start:
-                        if row_time > start_time:
-                            found_start = True
-                            base_time = row_time
-                            current_time = row_time
-                            real_start_time = time.time()
-                            print(f"Starting Worload from {current_time}  with speed factor {speed_factor}X")
-                    else:
-                        if row_time <= current_time:
-                            to_insert.append(row)
-                        else:
-                            if len(to_insert) > 0:
-                                for entry in to_insert:
-                                    conn.execute(insert_row(entry))  # type: ignore
-                                conn.commit()
-                                
-                                print(f"Inserted {len(to_insert)} updates at {current_time}")
-                                to_insert.clear()
-
-                            current_time = row_time #move time to next row time
-
-                            
-                            elapsed_real = time.time() - real_start_time
-                            elapsed_fake = (current_time - base_time).total_seconds() 
-                            time_to_sleep = (elapsed_fake / speed_factor) - elapsed_real
-                            if time_to_sleep > 0:
-                                print(f"Elapsed fake: {elapsed_fake}, Elapsed real: {elapsed_real}, -> sleep for {round(time_to_sleep,4)}s\n")
-                                time.sleep(time_to_sleep)
-
-                            to_insert.append(row)
-
-                for entry in to_insert:
-                    conn.execute(insert_row(entry))  # type: ignore
-                conn.commit()
+    for file in files:
+        print(f"\nReading file: {file}")
+        for batch in read_batches(file, after_epoch=None if found_start else start_epoch):
+            if not found_start:
+                if batch.epoch <= start_epoch:
+                    continue
+                found_start = True
+                print(f"Starting Worload from {batch.time}")
+            yield batch
+
+
+class ReplayWriter:
+    """
+    Insert of the scheduler: one transaction for the batches it groups (several when catching up), creating the
+    partitions of their months first (compact) and rolling up every hour once its updates are committed (rollup).
+    """
+    def __init__(self, start_time : datetime, insert_mode : str, n_workers : int, rollup : bool = False, current_prices : bool = False, compact : bool = False):
+        conn_str = CONN_STR + COMPACT_OPTIONS if compact else CONN_STR
+        self.inserter = ShardedInserter(n_workers, insert_mode, current_prices, compact)
+        self.rollup_conn = pg.connect(conn_str) if rollup else None
+        self.rolled_until = floor_hour(start_time)
+        self.partitions_conn = pg.connect(conn_str) if compact else None
+        self.partitioned_month : datetime | None = None
+
+    def insert(self, batches : list[PriceBatch]):
+        for batch in batches:
+            if self.partitions_conn is not None and first_of_month(batch.time) != self.partitioned_month:
+                self.partitioned_month = first_of_month(batch.time)
+                create_partitions(self.partitions_conn, batch.time)
 
+        self.inserter.insert(batches[0].rows if len(batches) == 1 else [row for batch in batches for row in batch.rows])
+
+        #first update of a new hour: all updates of the previous hours are committed, roll them up
+        last_time = batches[-1].time
+        if self.rollup_conn is not None and floor_hour(last_time) > self.rolled_until:
+            self.rolled_until = floor_hour(last_time)
+            n_hours = roll_up(self.rollup_conn, self.rolled_until, since=self.rolled_until - HOUR)
+            print(f"Rolled up {n_hours} hours into {ROLLUP_TABLE} until {self.rolled_until}")
+
+    def close(self):
+        self.inserter.close()
+        if self.rollup_conn is not None:
+            self.rollup_conn.close()
+        if self.partitions_conn is not None:
+            self.partitions_conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def transactional_workload(files : list[str], speed_factor : float | None, start_time : datetime, insert_mode : str, n_workers : int, rollup : bool = False, current_prices : bool = False, compact : bool = False,
+                           policy : str = DEFAULT_POLICY, max_lag : float = DEFAULT_MAX_LAG, progress_interval : float = DEFAULT_PROGRESS_INTERVAL, metrics : ReplayMetrics | None = None):
+    print(f"Similating Workload: from {files[0]} to {files[-1]} , start_time : {start_time}, speed : {speed_factor or 'max'}, policy : {policy}, insert mode : {insert_mode}, workers : {n_workers}, rollup : {rollup}, current prices : {current_prices}, compact : {compact}")   
+
+    start_epoch = start_time.replace(tzinfo=timezone.utc).timestamp()
+    with ReplayWriter(start_time, insert_mode, n_workers, rollup, current_prices, compact) as writer:
+        scheduler = ReplayScheduler(writer.insert, speed_factor, policy, max_lag, progress_interval, metrics)
+        stats = scheduler.run(batches_after(files, start_epoch))
+
+    if stats.batches > 0:
+        print(f"Total: {scheduler.progress_str()}")
     print("Transactional workload simulation finished")
 
 
+# time of the latest price in the db (None if there is none), the replay starts after it
+def latest_time(compact : bool = False) -> datetime | None:
+    with pg.connect(CONN_STR) as conn:
+        record = conn.execute("select compact.latest_time();" if compact else "select max(time) from prices;").fetchone()
+    return None if record is None else record[0]
+
+
 
 def main():
     parser = argparse.ArgumentParser(description="Process an optional price folder argument.")
     parser.add_argument("-p", "--price-folder", type=str, help="Path to the price folder", default=DEFUALT_PRICES_FOLDER)
-    parser.add_argument("-s", "--speed", type=int, help="Speed Factor", default=DEFAULT_SPEED_FACTOR)
+    parser.add_argument("-s", "--speed", type=parse_speed, help="Speed Factor, or max to insert as fast as possible", default=DEFAULT_SPEED_FACTOR)
+    parser.add_argument("--policy", choices=POLICIES, help="What to do when the replay is more than --max-lag seconds behind", default=DEFAULT_POLICY)
+    parser.add_argument("--max-lag", type=float, help="Seconds behind schedule tolerated before applying --policy", default=DEFAULT_MAX_LAG)
+    parser.add_argument("--progress", type=float, help="Seconds between progress lines", default=DEFAULT_PROGRESS_INTERVAL)
+    parser.add_argument("-m", "--metrics-port", type=int, help=f"Serve prometheus metrics on http://localhost:PORT{METRICS_PATH} (e.g. {DEFAULT_METRICS_PORT}, scraped by the prometheus service)", default=None)
+    parser.add_argument("-w", "--workers", type=int, help="Number of connections inserting concurrently (updates sharded by station)", default=DEFAULT_WORKERS)
+    parser.add_argument("-i", "--insert-mode", choices=INSERT_MODES, help="How each batch is sent to the db", default=DEFAULT_INSERT_MODE)
+    parser.add_argument("-r", "--rollup", action='store_true', help=f"Keep {ROLLUP_TABLE} up to date, rolling up every hour once it is complete")
+    parser.add_argument("--no-current-prices", action='store_true', help=f"Do not upsert the latest price of every station in {CURRENT_PRICES_TABLE} with each insert")
+    parser.add_argument("-k", "--compact", action='store_true', help=f"Insert into the compact layout {COMPACT_PRICES_TABLE} (sql/compact_schema.sql)")
 
     args = parser.parse_args()
 
-    with pg.connect(CONN_STR) as conn:
-        with conn.cursor() as cur:
-            record = cur.execute("select max(time) from prices;").fetchone()
+    metrics = None
+    if args.metrics_port is not None:
+        metrics = ReplayMetrics()
+        serve_metrics(metrics, args.metrics_port)
+        print(f"Serving metrics on http://localhost:{args.metrics_port}{METRICS_PATH}")
+
+    latest = latest_time(args.compact)
 
     max_time_str : str = ""
-    if (record is None or record[0] is None):
+    if latest is None:
         print("Result is empty")
     else:
-        max_time_str = record[0].strftime("%Y-%m-%d")
-        print("Latest time:", record[0])
-
-    price_files : list[tuple[str,str]] = []
-    for root, _, files in os.walk(args.price_folder):
-        for file in files:
-            if file.endswith("-prices.csv"):
-                if file.split("-prices.csv")[0] >= max_time_str:
-                    price_files.append((file,os.path.join(root, file)))
+        max_time_str = latest.strftime("%Y-%m-%d")
+        print("Latest time:", latest)
 
-    price_files = sorted(price_files, key=lambda x: x[0])
-    file_list = [file for _, file in price_files]
+    file_list = list_price_files(args.price_folder, max_time_str)
 
 
     if len(file_list) == 0:
         print(f"0 files found in {args.price_folder}")       
     else:
-        max_time : datetime = record[0]
-        if (record is None or record[0] is None):
-            max_time = datetime.strptime(price_files[0][0].split("-prices.csv")[0], "%Y-%m-%d") 
+        max_time : datetime = latest if latest is not None else datetime.strptime(os.path.basename(file_list[0]).split("-prices.csv")[0], "%Y-%m-%d")
 
-        transactional_workload(file_list, args.speed,max_time)
+        transactional_workload(file_list, args.speed,max_time, args.insert_mode, args.workers, args.rollup, not args.no_current_prices, args.compact,
+                               args.policy, args.max_lag, args.progress, metrics)
     
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import os
+from bisect import bisect_right
+from datetime import datetime
+
+
+INDEX_SUFFIX = ".idx"
+PRICES_SUFFIX = "-prices.csv"
+
+ResumeIndex = tuple[list[int], list[int]] #(epochs, byte offsets) of the first row of every timestamp
+
+
+def index_path(price_file : str) -> str:
+    return price_file + INDEX_SUFFIX
+
+def file_signature(price_file : str) -> str:
+    stat = os.stat(price_file)
+    return f"{stat.st_size},{stat.st_mtime_ns}"
+
+
+# One pass over the file in binary mode, recording the offset where each new timestamp starts
+def build_index(price_file : str) -> ResumeIndex:
+    epochs, offsets = [], []
+    with open(price_file, 'rb') as f:
+        offset = len(f.readline()) #skip header
+        date = b""
+        for line in f:
+            line_date = line[:line.find(b",")]
+            if line_date != date:
+                date = line_date
+                epochs.append(int(datetime.fromisoformat(date.decode()).timestamp()))
+                offsets.append(offset)
+            offset += len(line)
+
+    return epochs, offsets
+
+
+def write_index(price_file : str, index : ResumeIndex):
+    tmp_file = index_path(price_file) + ".tmp"
+    with open(tmp_file, 'w') as f:
+        f.write(file_signature(price_file) + "\n")
+        for epoch, offset in zip(*index):
+            f.write(f"{epoch},{offset}\n")
+    os.replace(tmp_file, index_path(price_file))
+
+
+# Returns None if there is no sidecar or it was built for a different version of the file
+def read_index(price_file : str) -> ResumeIndex | None:
+    try:
+        with open(index_path(price_file), 'r') as f:
+            if f.readline().strip() != file_signature(price_file):
+                return None
+            epochs, offsets = [], []
+            for line in f:
+                epoch, offset = line.split(",")
+                epochs.append(int(epoch))
+                offsets.append(int(offset))
+            return epochs, offsets
+    except (OSError, ValueError):
+        return None
+
+
+# Loads the sidecar next to the price file, building (and caching) it on first use
+def load_index(price_file : str) -> ResumeIndex:
+    index = read_index(price_file)
+    if index is None:
+        index = build_index(price_file)
+        try:
+            write_index(price_file, index)
+        except OSError as e:
+            print(f"Cannot cache resume index for {price_file}: {e}")
+    return index
+
+
+# Byte offset of the first row strictly after after_epoch (file size if there is none)
+def seek_offset(price_file : str, after_epoch : float) -> int:
+    epochs, offsets = load_index(price_file)
+    i = bisect_right(epochs, after_epoch)
+    return offsets[i] if i < len(offsets) else os.path.getsize(price_file)
+
+
+#----------------------------------------------------------
+# Price files from from_date (YYYY-MM-DD) on, sorted by date (none if the folder does not exist).
+# With the <folder>/YYYY/MM/YYYY-MM-DD-prices.csv layout only the year/month folders not before from_date are listed,
+# other layouts fall back to a full walk.
+def list_price_files(price_folder : str, from_date : str = "") -> list[str]:
+    if not os.path.isdir(price_folder):
+        return []
+
+    def sorted_dirs(path : str, min_name : str) -> list[str]:
+        return sorted(d for d in os.listdir(path) if d.isdigit() and d >= min_name and os.path.isdir(os.path.join(path, d)))
+
+    from_year, from_month = (from_date.split("-")[:2]) if from_date else ("", "")
+    years = sorted_dirs(price_folder, from_year)
+
+    price_files : list[tuple[str,str]] = []
+    if len(years) > 0:
+        for year in years:
+            year_folder = os.path.join(price_folder, year)
+            for month in sorted_dirs(year_folder, from_month if year == from_year else ""):
+                month_folder = os.path.join(year_folder, month)
+                for file in os.listdir(month_folder):
+                    if file.endswith(PRICES_SUFFIX) and file[:-len(PRICES_SUFFIX)] >= from_date:
+                        price_files.append((file, os.path.join(month_folder, file)))
+    else:
+        for root, _, files in os.walk(price_folder):
+            for file in files:
+                if file.endswith(PRICES_SUFFIX) and file[:-len(PRICES_SUFFIX)] >= from_date:
+                    price_files.append((file, os.path.join(root, file)))
+
+    return [path for _, path in sorted(price_files)]
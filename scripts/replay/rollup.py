@@ -0,0 +1,135 @@
+import os
+import time
+import argparse
+from datetime import datetime, timedelta
+import psycopg as pg
+
+
+ROLLUP_TABLE = "prices_hourly"
+PRICES_TABLE = "prices"
+FUELS = ['diesel', 'e5', 'e10']
+PORT = 5432
+COMPACT_OPTIONS = " options='-c search_path=compact,public'" #prices is the view of the compact layout (sql/compact_schema.sql)
+
+HOUR = timedelta(hours=1)
+
+
+# price of each station at the start of the hour: the last price of the previous hour in the rollup
+START_PRICES = f"""
+        SELECT station_id, start_t AS valid_from, {{fuel}}_last AS price
+        FROM {ROLLUP_TABLE}, param
+        WHERE hour = start_t - INTERVAL '1 hour' AND {{fuel}}_last IS NOT NULL"""
+
+# same, for the first hour rolled up: the last change in the 3 days before it
+SEED_PRICES = f"""
+        SELECT station_uuid AS station_id, start_t AS valid_from, price
+        FROM param, (
+            SELECT station_uuid, {{fuel}} AS price, ROW_NUMBER() OVER (PARTITION BY station_uuid ORDER BY time DESC) AS rn
+            FROM {PRICES_TABLE}, param
+            WHERE {{fuel}}_change IN (1,3) AND time < start_t AND time >= start_t - INTERVAL '3 day'
+        ) last_change
+        WHERE rn = 1"""
+
+FUEL_HOUR = f"""
+{{fuel}}_events AS (
+        SELECT station_uuid AS station_id, time AS valid_from, {{fuel}} AS price
+        FROM {PRICES_TABLE}, param
+        WHERE {{fuel}}_change IN (1,3) AND time >= start_t AND time < end_t
+
+        UNION ALL
+{{start_prices}}
+),
+{{fuel}}_intervals AS (
+    SELECT station_id, price,
+        EXTRACT(EPOCH FROM (LEAD(valid_from, 1, end_t) OVER (PARTITION BY station_id ORDER BY valid_from) - valid_from)) AS seconds,
+        FIRST_VALUE(price) OVER (PARTITION BY station_id ORDER BY valid_from DESC) AS last_price
+    FROM {{fuel}}_events, param
+),
+{{fuel}}_hour AS (
+    SELECT station_id, SUM(price * seconds) AS {{fuel}}_sum, SUM(seconds) AS {{fuel}}_seconds, MAX(last_price) AS {{fuel}}_last
+    FROM {{fuel}}_intervals
+    GROUP BY station_id
+),"""
+
+
+# Rolls up one hour [start_t, start_t + 1h): per station, time-weighted sum and seconds of every fuel price,
+# the last price (the start price of the next hour) and the number of updates received.
+def rollup_statement(seed : bool) -> str:
+    start_prices = SEED_PRICES if seed else START_PRICES
+    fuel_ctes = "".join(FUEL_HOUR.format(fuel=fuel, start_prices=start_prices.format(fuel=fuel)) for fuel in FUELS)
+    fuel_stations = " UNION ".join(f"SELECT station_id FROM {fuel}_hour" for fuel in FUELS)
+    fuel_columns = ", ".join(f"{fuel}_sum, {fuel}_seconds, {fuel}_last" for fuel in FUELS)
+    fuel_joins = "\n    ".join(f"LEFT JOIN {fuel}_hour ON {fuel}_hour.station_id = hs.station_id" for fuel in FUELS)
+
+    return f"""
+INSERT INTO {ROLLUP_TABLE}
+WITH param AS (
+    SELECT %(hour)s::TIMESTAMP AS start_t, start_t + INTERVAL '1 hour' AS end_t
+),
+updates AS (
+    SELECT station_uuid AS station_id, COUNT(*) AS n_updates
+    FROM {PRICES_TABLE}, param
+    WHERE time >= start_t AND time < end_t
+    GROUP BY station_uuid
+),{fuel_ctes}
+hour_stations AS (
+    SELECT station_id FROM updates UNION {fuel_stations}
+)
+SELECT hs.station_id, start_t AS hour, COALESCE(n_updates, 0) AS n_updates, {fuel_columns}
+FROM param, hour_stations hs
+    LEFT JOIN updates ON updates.station_id = hs.station_id
+    {fuel_joins};"""
+
+
+def floor_hour(t : datetime) -> datetime:
+    return t.replace(minute=0, second=0, microsecond=0, tzinfo=None)
+
+def last_rolled_hour(conn : pg.Connection) -> datetime | None:
+    record = conn.execute(f"SELECT max(hour) FROM {ROLLUP_TABLE};").fetchone()
+    return None if record is None else record[0]
+
+
+# Rolls up every complete hour before until that is not in the rollup yet, one transaction per hour.
+# An empty rollup starts from since (or the hour before until), seeding the start prices from prices.
+def roll_up(conn : pg.Connection, until : datetime, since : datetime | None = None) -> int:
+    until = floor_hour(until)
+    last = last_rolled_hour(conn)
+    hour = last + HOUR if last is not None else floor_hour(since or until - HOUR)
+
+    n_hours = 0
+    while hour + HOUR <= until:
+        conn.execute(rollup_statement(seed=(last is None and n_hours == 0)), {'hour': hour})  # type: ignore
+        conn.commit()
+        hour += HOUR
+        n_hours += 1
+    return n_hours
+
+
+def main():
+    parser = argparse.ArgumentParser(description=f"Backfills {ROLLUP_TABLE} with every complete hour in prices")
+    parser.add_argument("--from", dest="since", type=str, help="first hour to roll up if the rollup is empty (default: first price)", default=None)
+    parser.add_argument("--to", dest="until", type=str, help="first hour not to roll up (default: latest price)", default=None)
+    parser.add_argument("-k", "--compact", action='store_true', help="Roll up the prices of the compact layout (sql/compact_schema.sql)")
+    args = parser.parse_args()
+
+    user, user_pswd, db = os.getenv('CEDAR_USER'),os.getenv('CEDAR_PASSWORD'), os.getenv('CEDAR_DB')
+    if not all([user, user_pswd, db]):
+        print("Missing env variables")
+        exit(1)
+
+    conn_str = f"host=localhost port={PORT} user={user} password={user_pswd} dbname={db}"
+    with pg.connect(conn_str + COMPACT_OPTIONS if args.compact else conn_str) as conn:
+        first, latest = conn.execute(f"SELECT min(time), max(time) FROM {PRICES_TABLE};").fetchone()  # type: ignore
+        if latest is None:
+            print("No prices to roll up")
+            return
+
+        since = datetime.fromisoformat(args.since) if args.since else first
+        until = datetime.fromisoformat(args.until) if args.until else latest
+        start = time.perf_counter()
+        n_hours = roll_up(conn, until, since)
+        print(f"Rolled up {n_hours} hours in {time.perf_counter() - start:.2f}s (until {floor_hour(until)})")
+
+
+if __name__ == "__main__":
+    main()
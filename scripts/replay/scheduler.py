@@ -0,0 +1,206 @@
+import time
+import asyncio
+import itertools
+from dataclasses import dataclass
+from typing import Callable, Iterator
+
+from prices_reader import PriceBatch
+from metrics import ReplayMetrics
+
+
+POLICIES = ['catchup', 'drop', 'report']
+DEFAULT_POLICY = 'report'
+DEFAULT_MAX_LAG = 1.0 #seconds behind schedule before the policy applies
+DEFAULT_PROGRESS_INTERVAL = 5.0 #seconds between progress lines
+MAX_MERGED_ROWS = 10_000 #catchup: rows of one merged insert at most
+PREFETCH = 64 #batches read ahead of the inserts
+READ_CHUNK = 16 #batches read by one call in the worker thread
+
+
+# speed factor of -s/--speed, None for max (no pacing)
+def parse_speed(speed : str) -> float | None:
+    if speed == 'max':
+        return None
+    factor = float(speed)
+    if factor <= 0:
+        raise ValueError(f"speed must be positive or max, not {speed}")
+    return factor
+
+
+# up to n batches, and the error that stopped the iterator before (the batches read until then are still inserted)
+def next_batches(iterator : Iterator[PriceBatch], n : int) -> tuple[list[PriceBatch], Exception | None]:
+    batches = []
+    try:
+        batches.extend(itertools.islice(iterator, n))
+    except Exception as e:
+        return batches, e
+    return batches, None
+
+
+class Pacer:
+    """
+    Virtual time (epoch of the batches) on the monotonic clock: the batch at epoch e is due at start + (e - base_epoch) / speed.
+    Every batch is scheduled from the same origin, so a late wake up or a slow insert never shifts the following ones.
+    Without speed (max) every batch is due right away and nothing is ever late.
+    """
+    def __init__(self, base_epoch : float, speed : float | None):
+        self.base_epoch, self.speed = base_epoch, speed
+        self.start = time.monotonic()
+
+    # seconds behind schedule (negative: ahead, to sleep)
+    def lag(self, epoch : float) -> float:
+        if self.speed is None:
+            return 0.0
+        return time.monotonic() - (self.start + (epoch - self.base_epoch) / self.speed)
+
+
+@dataclass
+class ReplayStats:
+    rows : int = 0
+    batches : int = 0
+    inserts : int = 0 #transactions, fewer than batches when catching up
+    merged : int = 0 #batches inserted together with an earlier one
+    dropped_batches : int = 0
+    dropped_rows : int = 0
+    lag : float = 0.0 #seconds behind schedule when the last insert started
+    max_lag : float = 0.0
+    virtual_seconds : float = 0.0 #replayed so far
+    real_seconds : float = 0.0
+    last_time : str = ""
+
+    def rates_str(self, speed : float | None) -> str:
+        achieved = self.rows / self.real_seconds if self.real_seconds > 0 else 0
+        if speed is None:
+            return f"achieved {achieved:.1f} rows/s"
+        target = self.rows / (self.virtual_seconds / speed) if self.virtual_seconds > 0 else 0
+        return f"achieved {achieved:.1f} rows/s, target {target:.1f} rows/s"
+
+
+class ReplayScheduler:
+    """
+    Replays batches at speed x their original pace (or as fast as possible with speed None), calling insert with
+    the batches of each transaction in a worker thread while the next batches are read.
+    When an insert starts more than max_lag seconds late, the policy decides:
+    catchup merges it with the following batches already due (one insert, at most MAX_MERGED_ROWS rows),
+    drop skips it (back to real time, rows lost), report inserts it anyway and only reports the lag.
+    Progress (rates, lag, merged and dropped batches) is printed every progress_interval seconds,
+    metrics (if given) also get the time of every insert and of reading every batch.
+    The replay ends with the batches, at most prefetch batches (already read) after the iterator stops.
+    """
+    def __init__(self, insert : Callable[[list[PriceBatch]], None], speed : float | None, policy : str = DEFAULT_POLICY,
+                 max_lag : float = DEFAULT_MAX_LAG, progress_interval : float = DEFAULT_PROGRESS_INTERVAL, metrics : ReplayMetrics | None = None,
+                 prefetch : int = PREFETCH):
+        self.insert, self.speed, self.policy, self.max_lag = insert, speed, policy, max_lag
+        self.progress_interval, self.prefetch = progress_interval, prefetch
+        self.stats = ReplayStats()
+        self.pacer : Pacer | None = None
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.set_speed(speed)
+
+    def run(self, batches : Iterator[PriceBatch]) -> ReplayStats:
+        return asyncio.run(self.replay(batches))
+
+    async def replay(self, batches : Iterator[PriceBatch]) -> ReplayStats:
+        queue : asyncio.Queue[PriceBatch | None] = asyncio.Queue(maxsize=self.prefetch)
+        reader = asyncio.create_task(self._read(batches, queue))
+        progress = asyncio.create_task(self._print_progress())
+        try:
+            await self._insert_batches(queue)
+            await reader #reraises read errors
+        finally:
+            reader.cancel()
+            progress.cancel()
+        self._update_times()
+        return self.stats
+
+    # files are parsed in a worker thread (a few batches per call), so the sleeps of the pacing are not delayed by it
+    async def _read(self, batches : Iterator[PriceBatch], queue : 'asyncio.Queue[PriceBatch | None]'):
+        iterator = iter(batches)
+        try:
+            while True:
+                start = time.perf_counter()
+                chunk, error = await asyncio.to_thread(next_batches, iterator, min(self.prefetch, READ_CHUNK))
+                if self.metrics is not None:
+                    for _ in chunk:
+                        self.metrics.observe_read((time.perf_counter() - start) / len(chunk))
+                for batch in chunk:
+                    await queue.put(batch)
+                if error is not None:
+                    raise error
+                if len(chunk) == 0:
+                    await queue.put(None)
+                    return
+        except Exception:
+            await queue.put(None) #ends the inserts, replay reraises the error
+            raise
+
+    async def _insert_batches(self, queue : 'asyncio.Queue[PriceBatch | None]'):
+        pending : list[PriceBatch | None] = [] #taken from the queue while merging but not due yet (or the end)
+        while True:
+            batch = pending.pop() if pending else await queue.get()
+            if batch is None:
+                return
+            if self.pacer is None:
+                self.pacer = Pacer(batch.epoch, self.speed)
+
+            lag = self.pacer.lag(batch.epoch)
+            if lag < 0:
+                await asyncio.sleep(-lag)
+                lag = self.pacer.lag(batch.epoch)
+
+            if lag > self.max_lag and self.policy == 'drop':
+                self.stats.dropped_batches += 1
+                self.stats.dropped_rows += len(batch)
+                if self.metrics is not None:
+                    self.metrics.observe_drop(len(batch), lag)
+                continue
+
+            group = [batch]
+            if lag > self.max_lag and self.policy == 'catchup':
+                n_rows = len(batch)
+                while n_rows < MAX_MERGED_ROWS and not queue.empty():
+                    next_batch = queue.get_nowait()
+                    if next_batch is None or self.pacer.lag(next_batch.epoch) < 0:
+                        pending.append(next_batch)
+                        break
+                    group.append(next_batch)
+                    n_rows += len(next_batch)
+
+            self.stats.lag, self.stats.max_lag = lag, max(self.stats.max_lag, lag)
+            start = time.perf_counter()
+            await asyncio.to_thread(self.insert, group)
+            seconds = time.perf_counter() - start
+
+            n_rows = sum(len(b) for b in group)
+            self.stats.inserts += 1
+            self.stats.batches += len(group)
+            self.stats.merged += len(group) - 1
+            self.stats.rows += n_rows
+            self.stats.last_time = group[-1].date
+            self.stats.virtual_seconds = group[-1].epoch - self.pacer.base_epoch
+            self._update_times()
+            if self.metrics is not None:
+                self.metrics.observe_insert(n_rows, len(group), seconds, lag, group[-1].epoch)
+
+    def _update_times(self):
+        if self.pacer is not None:
+            self.stats.real_seconds = time.monotonic() - self.pacer.start
+
+    async def _print_progress(self):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            self._update_times()
+            print(self.progress_str())
+
+    def progress_str(self) -> str:
+        stats = self.stats
+        line = (f"[{stats.real_seconds:.0f}s] {stats.rows} updates until {stats.last_time or '-'} in {stats.inserts} inserts "
+                f"({stats.rates_str(self.speed)}), lag {stats.lag:.2f}s (max {stats.max_lag:.2f}s)")
+        if stats.merged > 0:
+            line += f", {stats.merged} batches merged"
+        if stats.dropped_batches > 0:
+            line += f", {stats.dropped_batches} batches ({stats.dropped_rows} updates) dropped"
+        if self.speed is not None and stats.lag > self.max_lag:
+            line += " -> falling behind"
+        return line
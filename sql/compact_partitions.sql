@@ -0,0 +1,60 @@
+-- postgres only (load.sh -o -k), after sql/compact_schema.sql: recreates compact.prices_data (empty) partitioned by month,
+-- so a time range only reads its months, with the index on (station_id, time) and a BRIN index on time in every partition
+-- (prices arrive in time order, a few pages summarize a whole block range).
+-- Rows of a month without partition land in prices_default, the clients create the months they insert into first.
+drop view if exists compact.prices;
+drop table if exists compact.prices_data;
+
+create table compact.prices_data (
+    time timestamp not null,
+    station_id int not null,
+    diesel int not null,
+    e5 int not null,
+    e10 int not null,
+    diesel_change smallint not null,
+    e5_change smallint not null,
+    e10_change smallint not null
+) partition by range (time);
+
+create table compact.prices_default partition of compact.prices_data default;
+
+create index prices_data_station_time on compact.prices_data (station_id, time);
+create index prices_data_time_brin on compact.prices_data using brin (time);
+
+create view compact.prices as
+    select p.time, s.station_uuid,
+        (p.diesel / 1000.0)::numeric(5,3) as diesel, (p.e5 / 1000.0)::numeric(5,3) as e5, (p.e10 / 1000.0)::numeric(5,3) as e10,
+        p.diesel_change, p.e5_change, p.e10_change
+    from compact.prices_data p left join compact.station_ids s on s.station_id = p.station_id;
+
+
+-- partitions are named prices_yyyy_mm, returns the number of months covered
+create or replace function compact.create_partitions(from_time timestamp, to_time timestamp)
+    returns int language plpgsql AS $$
+declare
+    month timestamp;
+    n_months int := 0;
+begin
+    for month in select generate_series(date_trunc('month', from_time), to_time, interval '1 month') loop
+        execute format('create table if not exists compact.%I partition of compact.prices_data for values from (%L) to (%L)',
+            'prices_' || to_char(month, 'YYYY_MM'), month, month + interval '1 month');
+        n_months := n_months + 1;
+    end loop;
+    return n_months;
+end $$;
+
+-- max(time) of the newest non empty month instead of scanning every partition (BRIN does not answer max)
+create or replace function compact.latest_time()
+    returns timestamp language plpgsql AS $$
+declare
+    part text;
+    latest timestamp;
+begin
+    for part in select c.relname from pg_inherits i join pg_class c on c.oid = i.inhrelid
+                where i.inhparent = 'compact.prices_data'::regclass and c.relname <> 'prices_default'
+                order by c.relname desc loop
+        execute format('select max(time) from compact.%I', part) into latest;
+        exit when latest is not null;
+    end loop;
+    return greatest(latest, (select max(time) from compact.prices_default));
+end $$;
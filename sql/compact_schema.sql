@@ -0,0 +1,55 @@
+-- optional compact layout of prices in the schema compact (load.sh -k): stations as int surrogates, prices as integers
+-- in tenths of a cent (1.759 -> 1759) and an index on (station_id, time), the filter of every query on prices.
+-- compact.prices shows it with the columns of prices, so a connection with search_path = compact, public runs the queries unchanged.
+-- On postgres, sql/compact_partitions.sql also splits compact.prices_data in monthly partitions.
+drop schema if exists compact cascade;
+create schema compact;
+
+create table compact.station_ids (
+    station_id serial primary key,
+    station_uuid uuid not null unique
+);
+
+create table compact.prices_data (
+    time timestamp not null,
+    station_id int not null,
+    diesel int not null,
+    e5 int not null,
+    e10 int not null,
+    diesel_change smallint not null,
+    e5_change smallint not null,
+    e10_change smallint not null
+);
+
+create index prices_data_station_time on compact.prices_data (station_id, time);
+
+-- same as prices_manifest, for the files loaded in the compact layout
+create table compact.prices_manifest (
+    file text primary key,
+    checksum text not null,
+    n_rows bigint not null,
+    min_time timestamp,
+    max_time timestamp,
+    loaded_at timestamp not null
+);
+
+-- known stations get their id up front, prices of other stations register them while loading
+insert into compact.station_ids (station_uuid) select id from stations order by id;
+
+-- left join: queries not reading station_uuid (e.g. max(time)) do not touch station_ids
+create view compact.prices as
+    select p.time, s.station_uuid,
+        (p.diesel / 1000.0)::numeric(5,3) as diesel, (p.e5 / 1000.0)::numeric(5,3) as e5, (p.e10 / 1000.0)::numeric(5,3) as e10,
+        p.diesel_change, p.e5_change, p.e10_change
+    from compact.prices_data p left join compact.station_ids s on s.station_id = p.station_id;
+
+-- monthly partitions covering [from_time, to_time], called by the loader and the replayer before inserting.
+-- Nothing to do without partitions, sql/compact_partitions.sql replaces it.
+create function compact.create_partitions(from_time timestamp, to_time timestamp)
+    returns int language sql AS
+    'SELECT 0';
+
+-- latest price update (the replayer starts after it)
+create function compact.latest_time()
+    returns timestamp language sql AS
+    'SELECT max(time) FROM compact.prices_data';
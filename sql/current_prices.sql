@@ -0,0 +1,37 @@
+-- rebuilds current_prices from prices: last update of every station and its last changed (1) or new (3) price of each fuel
+DELETE FROM current_prices;
+
+INSERT INTO current_prices
+WITH last_update AS (
+    SELECT station_uuid AS station_id, MAX(time) AS last_update
+    FROM prices GROUP BY station_uuid
+),
+last_diesel AS (
+    SELECT station_id, diesel, diesel_time
+    FROM (
+        SELECT station_uuid AS station_id, diesel, time AS diesel_time, ROW_NUMBER() OVER (PARTITION BY station_uuid ORDER BY time DESC) AS rn
+        FROM prices WHERE diesel_change IN (1,3)
+    ) p
+    WHERE rn = 1
+),
+last_e5 AS (
+    SELECT station_id, e5, e5_time
+    FROM (
+        SELECT station_uuid AS station_id, e5, time AS e5_time, ROW_NUMBER() OVER (PARTITION BY station_uuid ORDER BY time DESC) AS rn
+        FROM prices WHERE e5_change IN (1,3)
+    ) p
+    WHERE rn = 1
+),
+last_e10 AS (
+    SELECT station_id, e10, e10_time
+    FROM (
+        SELECT station_uuid AS station_id, e10, time AS e10_time, ROW_NUMBER() OVER (PARTITION BY station_uuid ORDER BY time DESC) AS rn
+        FROM prices WHERE e10_change IN (1,3)
+    ) p
+    WHERE rn = 1
+)
+SELECT lu.station_id, last_update, diesel, diesel_time, e5, e5_time, e10, e10_time
+FROM last_update lu
+    LEFT JOIN last_diesel d ON d.station_id = lu.station_id
+    LEFT JOIN last_e5 e5 ON e5.station_id = lu.station_id
+    LEFT JOIN last_e10 e10 ON e10.station_id = lu.station_id;
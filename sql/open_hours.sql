@@ -0,0 +1,49 @@
+-- rebuilds stations.open_hours from stations and stations_times: the weekly opening hours of every station as a bitmap.
+-- Element h + 1 is hour h of the week (monday 00:00 is hour 0), its bit m is set if the station is open during minute m of that hour
+-- (60 bits used). Always open stations have every bit set, intervals closing before they open (e.g. 06:00 - 02:00) go on past midnight.
+DROP FUNCTION IF EXISTS is_open_at;
+CREATE FUNCTION
+    is_open_at(open_hours bigint[], t timestamp)
+    returns boolean language sql AS
+    '((open_hours[((CASE WHEN EXTRACT(dow FROM t) = 0 THEN 6 ELSE EXTRACT(dow FROM t) - 1 END) * 24 + EXTRACT(hour FROM t) + 1)::int] >> EXTRACT(minute FROM t)::int) & 1) = 1';
+
+-- seconds of [lo, hi) (seconds from the start of an hour, 0 <= lo <= hi <= 3600) the station is open, bits being the hour in open_hours
+DROP FUNCTION IF EXISTS open_seconds;
+CREATE FUNCTION
+    open_seconds(bits bigint, lo bigint, hi bigint)
+    returns bigint language sql AS
+    'CASE WHEN lo / 60 = hi / 60 THEN (hi - lo) * ((bits >> (lo / 60)::int) & 1)
+    ELSE ((60 - lo % 60) % 60) * ((bits >> (lo / 60)::int) & 1)
+        + 60 * bit_count((bits & ((1::bigint << (hi / 60)::int) - (1::bigint << ((lo + 59) / 60)::int)))::bit(64))
+        + (hi % 60) * ((bits >> (hi / 60)::int) & 1)
+    END';
+
+
+WITH intervals AS ( -- minutes of the week [from_minute, to_minute) of every interval, on every day it applies to
+    SELECT station_id,
+        d * 1440 + FLOOR(EXTRACT(EPOCH FROM open_time) / 60)::int AS from_minute,
+        d * 1440 + CEIL(EXTRACT(EPOCH FROM close_time) / 60)::int + (CASE WHEN close_time < open_time THEN 1440 ELSE 0 END) AS to_minute
+    FROM stations_times, generate_series(0, 6) AS d
+    WHERE (days & (1 << d)) > 0
+),
+interval_hours AS ( -- minutes [lo, hi) of every hour an interval covers
+    SELECT station_id, h % 168 AS hour_of_week, GREATEST(from_minute - h * 60, 0) AS lo, LEAST(to_minute - h * 60, 60) AS hi
+    FROM intervals, generate_series(0, 168 + 24) AS h
+    WHERE h BETWEEN from_minute / 60 AND (to_minute - 1) / 60
+),
+hours AS (
+    SELECT station_id, hour_of_week, BIT_OR(((1::bigint << hi) - 1) & ~((1::bigint << lo) - 1)) AS bits
+    FROM interval_hours
+    WHERE lo < hi
+    GROUP BY station_id, hour_of_week
+),
+bitmaps AS (
+    SELECT s.id AS station_id,
+        ARRAY_AGG(CASE WHEN s.always_open THEN (1::bigint << 60) - 1 ELSE COALESCE(h.bits, 0) END ORDER BY hw) AS open_hours
+    FROM stations s CROSS JOIN generate_series(0, 167) AS hw
+        LEFT JOIN hours h ON h.station_id = s.id AND h.hour_of_week = hw
+    GROUP BY s.id
+)
+UPDATE stations s SET open_hours = b.open_hours
+FROM bitmaps b
+WHERE s.id = b.station_id;
@@ -1,6 +1,10 @@
 drop table if exists stations;
 drop table if exists prices;
 drop table if exists stations_times;
+drop table if exists prices_manifest;
+drop table if exists prices_hourly;
+drop table if exists current_prices;
+drop table if exists stations_cells;
 
 create table stations (
     id uuid primary key,
@@ -13,7 +17,8 @@ create table stations (
     latitude double precision not null,
     longitude double precision not null,
     first_active timestamp not null,
-    always_open boolean not null
+    always_open boolean not null,
+    open_hours bigint[] -- weekly opening hours as a bitmap (168 hours x 60 minutes), filled by sql/open_hours.sql
 );
 
 create table prices (
@@ -36,5 +41,48 @@ create table stations_times (
     close_time time not null
 );
 
+create table prices_manifest (
+    file text primary key,
+    checksum text not null,
+    n_rows bigint not null,
+    min_time timestamp,
+    max_time timestamp,
+    loaded_at timestamp not null
+);
 
+-- hourly rollup of prices, maintained by the replayer (scripts/replay/rollup.py)
+create table prices_hourly (
+    station_id uuid not null,
+    hour timestamp not null,
+    n_updates int not null,
+    diesel_sum numeric(12,3),
+    diesel_seconds int,
+    diesel_last numeric(5,3),
+    e5_sum numeric(12,3),
+    e5_seconds int,
+    e5_last numeric(5,3),
+    e10_sum numeric(12,3),
+    e10_seconds int,
+    e10_last numeric(5,3),
+    primary key (station_id, hour)
+);
 
+-- latest price of every station, upserted by the replayer with each insert (refreshed from prices by sql/current_prices.sql)
+create table current_prices (
+    station_id uuid primary key,
+    last_update timestamp not null,
+    diesel numeric(5,3),
+    diesel_time timestamp,
+    e5 numeric(5,3),
+    e5_time timestamp,
+    e10 numeric(5,3),
+    e10_time timestamp
+);
+
+-- stations by grid cell of 0.1 x 0.1 degrees (cell = FLOOR(degrees * 10)), filled by sql/stations_cells.sql
+create table stations_cells (
+    cell_lat int not null,
+    cell_lon int not null,
+    station_id uuid not null,
+    primary key (cell_lat, cell_lon, station_id)
+);
@@ -0,0 +1,6 @@
+-- rebuilds stations_cells from stations: every station in its grid cell of 0.1 x 0.1 degrees
+DELETE FROM stations_cells;
+
+INSERT INTO stations_cells
+SELECT FLOOR(latitude * 10)::int AS cell_lat, FLOOR(longitude * 10)::int AS cell_lon, id AS station_id
+FROM stations;